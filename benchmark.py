@@ -0,0 +1,412 @@
+'''
+File Database benchmark suite
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import contextlib
+import platform
+import tempfile
+import statistics
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+DEFAULT_FILES = 10000
+DEFAULT_TEMPLATE = "{prefix}_{year}_{month:02d}_{day:02d}_{index}.txt"
+DEFAULT_QUERIES = 200
+# median milliseconds of `import main` plus FileDB() in a new process
+DEFAULT_STARTUP_BUDGET = 250.0
+# relative slowdown reported as regression by compare
+DEFAULT_THRESHOLD = 0.10
+
+
+def zipf_choices(rng: random.Random, population: list, skew: float,
+                 k: int) -> list:
+    '''@k items of @population, the n-th item has weight 1 / n ** @skew'''
+    weights = [1 / (n + 1) ** skew for n in range(len(population))]
+    return rng.choices(population, weights, k=k)
+
+
+class TreeGenerator:
+    '''
+    Synthetic inbox of files whose names match a rule
+     @template: str.format template of file names, fields are prefix, year,
+                month, day, hour, index
+     @prefixes: number of distinct name prefixes, drawn with @skew
+     @tag_keys / @tag_values: tag vocabulary, tags are "key=value" drawn
+                with @skew, @tags_per_file on each file
+    '''
+    def __init__(self, seed: int = 0, template: str = DEFAULT_TEMPLATE,
+                 years: tuple = (2000, 2023), prefixes: int = 10,
+                 tag_keys: int = 10, tag_values: int = 100,
+                 tags_per_file: int = 2, skew: float = 1.0,
+                 size: int = 64):
+        self.rng = random.Random(seed)
+        self.template = template
+        self.years = years
+        self.prefixes = [f"data{n}" for n in range(max(1, prefixes))]
+        self.keys = [f"key{n}" for n in range(max(1, tag_keys))]
+        self.values = [f"value{n}" for n in range(max(1, tag_values))]
+        self.tags_per_file = tags_per_file
+        self.skew = skew
+        self.size = size
+
+    def names(self, count: int, start: int = 0) -> list:
+        '''@count file names'''
+        prefixes = zipf_choices(self.rng, self.prefixes, self.skew, count)
+        names = []
+        for n in range(count):
+            names.append(self.template.format(
+                prefix=prefixes[n],
+                year=self.rng.randint(*self.years),
+                month=self.rng.randint(1, 12),
+                day=self.rng.randint(1, 28),
+                hour=self.rng.randint(0, 23),
+                index=start + n))
+        return names
+
+    def tags(self) -> list:
+        '''Tags of one file'''
+        keys = zipf_choices(self.rng, self.keys, self.skew,
+                            self.tags_per_file)
+        values = zipf_choices(self.rng, self.values, self.skew,
+                              self.tags_per_file)
+        return [f"{key}={value}" for key, value in zip(keys, values)]
+
+    def generate(self, inbox: str | Path, count: int, start: int = 0,
+                 workers: int = 8) -> dict:
+        '''Write @count files into @inbox, return filepath -> tags'''
+        Path(inbox).mkdir(parents=True, exist_ok=True)
+        files = {str(Path(inbox, name)): self.tags()
+                 for name in self.names(count, start)}
+
+        def write(path):
+            with open(path, "wb") as f:
+                f.write(path.encode()[-self.size:].ljust(self.size, b"\n"))
+
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(write, files.keys()))
+        return files
+
+
+class Benchmark:
+    '''
+    Time the FileDB operations on a synthetic tree in @workdir
+    Every phase works on its own storage root.
+    '''
+    def __init__(self, config: str, workdir: str, rulename: str,
+                 generator: TreeGenerator, files: int, queries: int,
+                 startup_budget: float = DEFAULT_STARTUP_BUDGET):
+        with open(config, encoding="utf-8") as f:
+            self.base = json.load(f)
+        if rulename not in self.base["rules"]:
+            raise SystemExit(f"rule `{rulename}` is not in {config}")
+        self.workdir = Path(workdir)
+        self.rulename = rulename
+        self.generator = generator
+        self.files = files
+        self.queries = queries
+        self.startup_budget = startup_budget
+        self.results = {}
+
+    def config(self, name: str) -> str:
+        '''Config file of phase @name, with root inside workdir'''
+        cfg = dict(self.base, root=str(Path(self.workdir, name, "out")))
+        cfg.pop("result_cache", None)
+        path = Path(self.workdir, name, "config.json")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(cfg, f)
+        return str(path)
+
+    def record(self, name: str, count: int, seconds: float,
+               latencies: None | list = None, **extra):
+        '''Store result of one operation'''
+        result = {"count": count, "seconds": round(seconds, 6),
+                  "ops_per_sec": round(count / seconds, 2) if seconds else 0}
+        if latencies:
+            cuts = statistics.quantiles(latencies, n=100) \
+                if len(latencies) > 1 else latencies * 99
+            result["p50_ms"] = round(cuts[49] * 1000, 4)
+            result["p95_ms"] = round(cuts[94] * 1000, 4)
+        result.update(extra)
+        self.results[name] = result
+        print(f"{name:>14}: {count} in {seconds:.3f}s", file=sys.stderr)
+
+    def run(self, phases: list):
+        '''Run benchmark @phases in order'''
+        for phase in phases:
+            getattr(self, f"bench_{phase}")()
+        return self.results
+
+    def bench_match(self):
+        '''Rule matching only'''
+        from main import FileDB
+        db = FileDB(self.config("match"))
+        names = self.generator.names(self.files)
+        start = time.perf_counter()
+        matched = sum(db.finder.match(name) is not None for name in names)
+        self.record("match", len(names), time.perf_counter() - start,
+                    matched=matched)
+
+    def _filled(self, name: str, method: str, count: int):
+        '''Helper function: generate files and add them with @method'''
+        from main import FileDB
+        cfg = self.config(name)
+        files = self.generator.generate(Path(self.workdir, name, "inbox"),
+                                        count)
+        db = FileDB(cfg)
+        start = time.perf_counter()
+        if method == "add":
+            latencies = []
+            for path, tags in files.items():
+                begin = time.perf_counter()
+                db.add(path, tags)
+                latencies.append(time.perf_counter() - begin)
+        else:
+            latencies = None
+            getattr(db, method)(list(files.keys()), files)
+        self.record(name, count, time.perf_counter() - start, latencies)
+        return db, cfg
+
+    def bench_add(self):
+        '''FileDB.add one file at a time'''
+        self._filled("add", "add", min(self.files, 2000))
+
+    def bench_add_many(self):
+        '''FileDB.add_many bulk add'''
+        self._filled("add_many", "add_many", self.files)
+
+    def bench_ingest(self):
+        '''FileDB.ingest parallel bulk add'''
+        self._filled("ingest", "ingest", self.files)
+
+    def bench_search(self):
+        '''Time range and tag queries on one populated cache'''
+        db, self.search_config = self._filled("populate", "ingest",
+                                              self.files)
+        rng = random.Random(1)
+        low, high = self.generator.years
+
+        def timed(name, metas):
+            latencies = []
+            rows = 0
+            for meta in metas:
+                begin = time.perf_counter()
+                rows += len(db.search(self.rulename, meta))
+                latencies.append(time.perf_counter() - begin)
+            self.record(name, len(metas), sum(latencies), latencies,
+                        rows=rows)
+
+        windows = []
+        for _ in range(self.queries):
+            year = rng.randint(low, high)
+            month = rng.randint(1, 12)
+            windows.append({"parameter": ["path"],
+                            "starttime": f"{year}-{month:02d}-01T00:00:00",
+                            "endtime": f"{year}-{month:02d}-28T00:00:00"})
+        timed("search_time", windows)
+        timed("search_tag", [
+            {"parameter": ["path"], "tags": rng.choice(
+                [f"{key}={value}" for key in self.generator.keys[:3]
+                 for value in self.generator.values[:10]])}
+            for _ in range(self.queries)])
+        common = f"{self.generator.keys[0]}={self.generator.values[0]}"
+        timed("search_tag_time", [dict(meta, tags=common)
+                                  for meta in windows])
+
+    def bench_cold_start(self, runs: int = 5):
+        '''
+        New process: import, open a lazy FileDB and run the first search.
+        Import plus open is checked against the startup budget.
+        '''
+        cfg = getattr(self, "search_config", None)
+        if cfg is None:
+            _, cfg = self._filled("populate", "ingest", self.files)
+        code = (
+            "import time\n"
+            "start = time.perf_counter()\n"
+            "import main\n"
+            "imported = time.perf_counter()\n"
+            f"db = main.FileDB({cfg!r}, lazy=True)\n"
+            "opened = time.perf_counter()\n"
+            f"db.search({self.rulename!r}, {{'parameter': ['path'], "
+            "'starttime': '2001-01-01T00:00:00', "
+            "'endtime': '2001-02-01T00:00:00'})\n"
+            "done = time.perf_counter()\n"
+            "import sys\n"
+            "print(len(sys.modules), imported - start, opened - imported, "
+            "done - opened)\n")
+        walls = []
+        parts = []
+        for _ in range(runs):
+            begin = time.perf_counter()
+            out = subprocess.run([sys.executable, "-c", code], cwd=HERE,
+                                 env=os.environ, check=True,
+                                 capture_output=True, text=True).stdout
+            walls.append(time.perf_counter() - begin)
+            parts.append([float(ele) for ele in out.split()[-4:]])
+        startup = statistics.median(ele[1] + ele[2] for ele in parts) * 1000
+        self.record("cold_start", runs, sum(walls), walls,
+                    modules=int(parts[-1][0]),
+                    import_ms=round(statistics.median(
+                        [ele[1] for ele in parts]) * 1000, 3),
+                    open_ms=round(statistics.median(
+                        [ele[2] for ele in parts]) * 1000, 3),
+                    first_search_ms=round(statistics.median(
+                        [ele[3] for ele in parts]) * 1000, 3),
+                    startup_ms=round(startup, 3),
+                    budget_ms=self.startup_budget,
+                    over_budget=startup > self.startup_budget)
+
+
+PHASES = ["match", "add", "add_many", "ingest", "search", "cold_start"]
+# metrics compared between runs, and whether larger is better
+METRICS = {"ops_per_sec": True, "p50_ms": False, "p95_ms": False,
+           "import_ms": False, "open_ms": False, "first_search_ms": False,
+           "startup_ms": False}
+
+
+def _git_version() -> None | str:
+    '''Helper function: git commit of this tree, None if unknown'''
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"],
+                              cwd=HERE, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old: dict, new: dict, threshold: float) -> list:
+    '''
+    Compare two benchmark outputs
+    Return list of (operation, metric, old, new, change), change > 0 is
+    better, and regressions worse than @threshold are marked
+    '''
+    rows = []
+    for name, result in new["results"].items():
+        before = old["results"].get(name)
+        if before is None:
+            continue
+        for metric, larger in METRICS.items():
+            if metric not in result or not before.get(metric):
+                continue
+            change = (result[metric] - before[metric]) / before[metric]
+            if not larger:
+                change = -change
+            rows.append((name, metric, before[metric], result[metric],
+                         change, change < -threshold))
+    return rows
+
+
+def main(argv: None | list = None) -> int:
+    '''Command line interface, return exit status'''
+    parser = argparse.ArgumentParser(prog="benchmark",
+                                     description="File Database benchmark")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run benchmarks, print JSON")
+    generate = commands.add_parser("generate",
+                                   help="only write a synthetic inbox")
+    for command in (run, generate):
+        command.add_argument("-n", "--files", type=int, default=DEFAULT_FILES)
+        command.add_argument("--seed", type=int, default=0)
+        command.add_argument("--template", default=DEFAULT_TEMPLATE,
+                             help="file name template, fields: prefix, "
+                                  "year, month, day, hour, index")
+        command.add_argument("--years", type=int, nargs=2,
+                             default=[2000, 2023])
+        command.add_argument("--prefixes", type=int, default=10)
+        command.add_argument("--tag-keys", type=int, default=10)
+        command.add_argument("--tag-values", type=int, default=100)
+        command.add_argument("--tags-per-file", type=int, default=2)
+        command.add_argument("--skew", type=float, default=1.0,
+                             help="zipf exponent of names and tags")
+        command.add_argument("--size", type=int, default=64,
+                             help="bytes per file")
+    run.add_argument("-c", "--config", default=str(HERE / "config.json"))
+    run.add_argument("-r", "--rule", default="general")
+    run.add_argument("-q", "--queries", type=int, default=DEFAULT_QUERIES)
+    run.add_argument("-p", "--phase", action="append", choices=PHASES,
+                     help="phases to run, default all")
+    run.add_argument("-o", "--output", help="write JSON to file")
+    run.add_argument("--workdir", help="keep generated trees here")
+    run.add_argument("--startup-budget", type=float,
+                     default=DEFAULT_STARTUP_BUDGET,
+                     help="max milliseconds of import plus FileDB() in a new "
+                          "process, exit status 1 if exceeded")
+    generate.add_argument("inbox")
+
+    cmp = commands.add_parser("compare", help="compare two JSON outputs")
+    cmp.add_argument("old")
+    cmp.add_argument("new")
+    cmp.add_argument("-t", "--threshold", type=float,
+                     default=DEFAULT_THRESHOLD,
+                     help="relative slowdown reported as regression")
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        with open(args.old, encoding="utf-8") as f:
+            old = json.load(f)
+        with open(args.new, encoding="utf-8") as f:
+            new = json.load(f)
+        if old.get("params") != new.get("params"):
+            print("warning: runs have different parameters", file=sys.stderr)
+        rows = compare(old, new, args.threshold)
+        for name, metric, before, after, change, regressed in rows:
+            mark = "REGRESSION" if regressed else ""
+            print(f"{name:>16} {metric:>16} {before:>12} {after:>12} "
+                  f"{change:+8.1%} {mark}")
+        return 1 if any(row[5] for row in rows) else 0
+
+    generator = TreeGenerator(args.seed, args.template, tuple(args.years),
+                              args.prefixes, args.tag_keys, args.tag_values,
+                              args.tags_per_file, args.skew, args.size)
+    if args.command == "generate":
+        generator.generate(args.inbox, args.files)
+        return 0
+
+    sys.path.insert(0, str(HERE))
+    workdir = args.workdir or tempfile.mkdtemp(prefix="filedb-bench-")
+    try:
+        bench = Benchmark(args.config, workdir, args.rule, generator,
+                          args.files, args.queries, args.startup_budget)
+        # keep stdout clean for the JSON output
+        with contextlib.redirect_stdout(sys.stderr):
+            results = bench.run(args.phase or PHASES)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = {
+        "version": _git_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {key: value for key, value in vars(args).items()
+                   if key not in ("command", "output", "workdir")},
+        "results": results,
+    }
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if results.get("cold_start", {}).get("over_budget"):
+        print("startup budget exceeded", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
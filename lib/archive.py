@@ -0,0 +1,215 @@
+'''
+Archive subsystem
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import os
+import time
+import zlib
+import shutil
+import struct
+import zipfile
+from pathlib import Path
+from lib.common import ARCHIVE_SEP
+from lib.error import GeneralException
+from lib.partition import Partition
+
+ARCHIVE_FOLDER = "archive"
+DEFAULT_LEVEL = 6
+LOCAL_SIGNATURE = b"PK\x03\x04"
+# signature, version, flags, method, time, date, crc32, compressed size,
+# size, name length, extra length
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+FLAG_DATA_DESCRIPTOR = 0x08
+
+
+def reference(container: str | Path, member: str) -> str:
+    '''Path of archived @member of @container'''
+    return f"{container}{ARCHIVE_SEP}{member}"
+
+
+def split_reference(path: str) -> None | tuple:
+    '''(container, member) of archived @path, None for plain files'''
+    container, sep, member = str(path).partition(ARCHIVE_SEP)
+    if not sep:
+        return None
+    return container, member
+
+
+def read_member(container: str | Path, offset: int, size: int,
+                method: int) -> bytes:
+    '''
+    Content of the zip member whose local header is at @offset, without
+    reading the central directory
+     @size: compressed size of the member
+     @method: zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED
+    '''
+    with open(container, "rb") as f:
+        f.seek(offset)
+        header = f.read(LOCAL_HEADER.size)
+        if len(header) != LOCAL_HEADER.size:
+            raise GeneralException(
+                f"[Archive] truncated member header: {container}@{offset}")
+        fields = LOCAL_HEADER.unpack(header)
+        if fields[0] != LOCAL_SIGNATURE:
+            raise GeneralException(
+                f"[Archive] no member header at {container}@{offset}")
+        f.seek(fields[9] + fields[10], os.SEEK_CUR)
+        data = f.read(size)
+    if method == zipfile.ZIP_STORED:
+        content = data
+    elif method == zipfile.ZIP_DEFLATED:
+        content = zlib.decompress(data, -zlib.MAX_WBITS)
+    else:
+        raise GeneralException(
+            f"[Archive] unsupported compression method: {method}")
+    if not fields[2] & FLAG_DATA_DESCRIPTOR and \
+       zlib.crc32(content) != fields[6]:
+        raise GeneralException(
+            f"[Archive] CRC mismatch of member at {container}@{offset}")
+    return content
+
+
+def read(path: str, member: None | tuple = None) -> bytes:
+    '''
+    Content of @path, a plain file or an archived "<container>::<member>"
+     @member: (offset, size, method) from the index, read with one seek
+              instead of the zip central directory
+    '''
+    ref = split_reference(path)
+    if ref is None:
+        with open(path, "rb") as f:
+            return f.read()
+    container, name = ref
+    if member is not None and member[0] is not None:
+        return read_member(container, *member)
+    with zipfile.ZipFile(container) as zf:
+        return zf.read(name)
+
+
+def period_span(period: str) -> tuple:
+    '''(first, last) epoch of @period, "2001" or "2001-01"'''
+    partition = Partition.MONTH if "-" in period else Partition.YEAR
+    ordinal = partition.parse(period)
+    if ordinal is None:
+        raise GeneralException(f"[Archive] invalid period: {period}")
+    return partition.span(ordinal)
+
+
+class Archiver:
+    '''
+    Pack the files of one closed period of a rule into one zip container
+
+    The container is `root/<rule folder>/archive/<period>.zip`, its members
+    are named by their path under root. Packed rows get the path
+    `<container>::<member>` and the local header offset, compressed size
+    and method of their member, so one member is read with a single seek
+    (read_member). Files are deleted after their rows are updated.
+    Packing a period again appends files stored since then.
+    '''
+    def __init__(self, db, level: int = DEFAULT_LEVEL,
+                 compression: int = zipfile.ZIP_DEFLATED,
+                 batch_size: int = 1000):
+        self.db = db
+        self.level = level
+        self.compression = compression
+        self.batch_size = batch_size
+        self.root = Path(self.db.config.get()["root"]).absolute()
+
+    def container(self, rule: dict, period: str) -> Path:
+        '''Container file of @period of @rule'''
+        return Path(self.root, rule["folder"][0], ARCHIVE_FOLDER,
+                    f"{period}.zip")
+
+    def pack(self, rulename: str, period: str, force: bool = False) -> dict:
+        '''
+        Archive the files of @rulename whose datetime is in @period
+         @period: "2001" or "2001-01"
+         @force: also pack a period which is not over yet
+        Return {"container", "files", "bytes", "packed", "missing"}
+        '''
+        first, last = period_span(period)
+        if not force and last >= time.time():
+            raise GeneralException(f"[Archive] period {period} is not over")
+        if not self.db.load_module(rulename):
+            raise GeneralException(f"[Archive] unknown rule: {rulename}")
+        rule = self.db.config.get()["rules"][rulename]
+        cache = self.db.groups[rulename]["db"]
+        container = self.container(rule, period)
+        report = {"container": str(container), "files": 0, "bytes": 0,
+                  "packed": 0, "missing": []}
+
+        rows = cache.search({"parameter": ["id", "path"],
+                             "starttime": first, "endtime": last})
+        files = []
+        for file_id, path in rows:
+            if split_reference(path) is not None:
+                continue
+            if not os.path.isfile(path):
+                report["missing"].append(path)
+                continue
+            try:
+                name = Path(path).relative_to(self.root).as_posix()
+            except ValueError:
+                name = Path(path).name
+            files.append((file_id, path, name))
+        if len(files) == 0:
+            return report
+
+        infos = self._write(container, files)
+        members = []
+        for file_id, _, name in files:
+            info = infos[name]
+            members.append((file_id, reference(container, name),
+                            info.header_offset, info.compress_size,
+                            info.compress_type))
+            report["bytes"] += info.file_size
+            report["packed"] += info.compress_size
+        cache.set_members(members, self.batch_size)
+
+        for _, path, _ in files:
+            os.remove(path)
+            self._prune(Path(path).parent, Path(self.root, rule["folder"][0]))
+        report["files"] = len(files)
+        return report
+
+    def _write(self, container: Path, files: list) -> dict:
+        '''
+        Helper function: add @files to @container through a temporary copy
+        Return member name -> ZipInfo
+        '''
+        container.parent.mkdir(parents=True, exist_ok=True)
+        tmp = container.with_name(container.name + ".part")
+        mode = "w"
+        if container.exists():
+            shutil.copyfile(container, tmp)
+            mode = "a"
+        try:
+            with zipfile.ZipFile(tmp, mode, self.compression,
+                                 allowZip64=True,
+                                 compresslevel=self.level) as zf:
+                present = set(zf.namelist())
+                for _, path, name in files:
+                    if name not in present:
+                        zf.write(path, name)
+                infos = {info.filename: info for info in zf.infolist()}
+            with open(tmp, "rb+") as f:
+                os.fsync(f.fileno())
+            os.replace(tmp, container)
+        except BaseException:
+            if tmp.exists():
+                os.remove(tmp)
+            raise
+        return infos
+
+    @staticmethod
+    def _prune(path: Path, top: Path):
+        '''Helper function: remove empty directories from @path up to @top'''
+        while path != top and top in path.parents:
+            try:
+                path.rmdir()
+            except OSError:
+                return
+            path = path.parent
@@ -0,0 +1,354 @@
+'''
+Columnar snapshot subsystem
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import os
+import threading
+from lib.error import GeneralException
+from plugins.general import to_epoch, label_value, split_tag, ID_SPAN, \
+    TIME_LABELS
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DEFAULT_LOAD_SIZE = 10000
+# value of integer label columns which are NULL
+NULL_INT = -2 ** 63
+SNAPSHOT_COLUMNS = ["id", "datetime", "path", "tags", "epoch"]
+
+
+def _tag_match(term: str, key: str, value: None | str) -> bool:
+    '''Helper function: one tag (@key, @value) matches query @term'''
+    term_key, term_value = split_tag(term)
+    if term_value is None:
+        if term_key.endswith('*'):
+            return key.startswith(term_key[:-1])
+        return key == term_key or value == term_key
+    if term_value.endswith('*'):
+        found = value is not None and value.startswith(term_value[:-1])
+    else:
+        found = value == term_value
+    return found if len(term_key) == 0 else key == term_key and found
+
+
+class Dictionary:
+    '''Distinct values of one column, rows keep int32 codes (-1 is NULL)'''
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def encode(self, values: list):
+        '''Codes of @values, unknown values are added'''
+        codes = self.codes
+        out = np.empty(len(values), dtype=np.int32)
+        for idx, value in enumerate(values):
+            if value is None:
+                out[idx] = -1
+                continue
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(self.values)
+                self.values.append(value)
+            out[idx] = code
+        return out
+
+    def lookup(self, predicate) -> 'np.ndarray':
+        '''
+        Boolean table of codes whose value satisfies @predicate, with one
+        more False entry at the end so that code -1 (NULL) indexes it
+        '''
+        table = np.zeros(len(self.values) + 1, dtype=bool)
+        for code, value in enumerate(self.values):
+            table[code] = predicate(value)
+        return table
+
+    def decode(self, codes) -> list:
+        '''Values of @codes'''
+        values = self.values
+        return [values[code] if code >= 0 else None for code in codes]
+
+
+class ColumnarSnapshot:
+    '''
+    Read-only in-memory snapshot of the `contents` table of a rule cache
+
+    Rows are kept sorted by (epoch, id) in NumPy arrays: int64 id and
+    epoch, int64 time labels, and int32 codes of dictionary encoded
+    directories, tags and other labels. File names are stored in one
+    byte buffer. Time ranges are found with searchsorted, labels and tags
+    are filtered with vectorized masks over the dictionary codes.
+
+    refresh() loads rows inserted since the snapshot (by id), rows deleted
+    from the cache stay until reload(). Queries which need other columns
+    (e.g. hash) or meta keys are passed to the cache.
+    '''
+    def __init__(self, cache, load_size: int = DEFAULT_LOAD_SIZE):
+        if np is None:
+            raise GeneralException(
+                "[ColumnarSnapshot] numpy is needed for columnar snapshots")
+        self.cache = cache
+        self.load_size = max(1, load_size)
+        self.labels = [label for label in cache.labels if label != "epoch"]
+        self.lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        '''Drop the snapshot and load every row again'''
+        with self.lock:
+            self.ids = np.empty(0, dtype=np.int64)
+            self.epochs = np.empty(0, dtype=np.int64)
+            self.dirs = np.empty(0, dtype=np.int32)
+            self.name_start = np.empty(0, dtype=np.int64)
+            self.name_size = np.empty(0, dtype=np.int32)
+            self.names = np.empty(0, dtype=np.uint8)
+            self.tags = np.empty(0, dtype=np.int32)
+            self.values = {}
+            self.dictionaries = {"dir": Dictionary(), "tags": Dictionary()}
+            for label in self.labels:
+                if label in TIME_LABELS:
+                    self.values[label] = np.empty(0, dtype=np.int64)
+                else:
+                    self.values[label] = np.empty(0, dtype=np.int32)
+                    self.dictionaries[label] = Dictionary()
+            # id block (id // ID_SPAN) -> largest loaded id
+            self.seen = {}
+            self._load()
+
+    def refresh(self) -> int:
+        '''Load rows inserted since the last load, return their number'''
+        with self.lock:
+            return self._load()
+
+    def _load(self) -> int:
+        '''Helper function: append new rows and sort again'''
+        columns = ", ".join(["id", "epoch", "path", "tags"] + self.labels)
+        names = ["ids", "epochs", "dirs", "name_start", "name_size", "names",
+                 "tags"]
+        parts = {name: [getattr(self, name)] for name in names}
+        parts.update({f"label:{label}": [self.values[label]]
+                      for label in self.labels})
+        size = len(self.names)
+        count = 0
+        for batch in self.cache.rows(columns, self.load_size,
+                                     dict(self.seen)):
+            size = self._encode(batch, parts, size)
+            count += len(batch)
+        if count == 0:
+            return 0
+
+        for name in names:
+            setattr(self, name, np.concatenate(parts[name]))
+        for label in self.labels:
+            self.values[label] = np.concatenate(parts[f"label:{label}"])
+        # merge of two sorted runs, nearly linear with the stable sort
+        order = np.lexsort((self.ids, self.epochs))
+        for name in names:
+            if name != "names":
+                setattr(self, name, getattr(self, name)[order])
+        for label in self.labels:
+            self.values[label] = self.values[label][order]
+        return count
+
+    def _encode(self, batch: list, parts: dict, size: int) -> int:
+        '''
+        Helper function: encode one batch of rows into @parts
+        Return size of the file name buffer
+        '''
+        columns = list(zip(*batch))
+        ids = np.fromiter(columns[0], dtype=np.int64, count=len(batch))
+        for block in np.unique(ids // ID_SPAN).tolist():
+            top = int(ids[ids // ID_SPAN == block].max())
+            self.seen[block] = max(self.seen.get(block, 0), top)
+
+        dirs = []
+        names = []
+        for path in columns[2]:
+            folder, name = os.path.split(path)
+            dirs.append(folder)
+            names.append(name.encode("utf-8"))
+        sizes = np.fromiter((len(name) for name in names), dtype=np.int32,
+                            count=len(names))
+        buffer = np.frombuffer(b"".join(names), dtype=np.uint8)
+
+        parts["ids"].append(ids)
+        parts["epochs"].append(np.fromiter(
+            (NULL_INT if ele is None else ele for ele in columns[1]),
+            dtype=np.int64, count=len(batch)))
+        parts["dirs"].append(self.dictionaries["dir"].encode(dirs))
+        parts["name_start"].append(
+            np.cumsum(sizes, dtype=np.int64) - sizes + size)
+        parts["name_size"].append(sizes)
+        parts["names"].append(buffer)
+        parts["tags"].append(self.dictionaries["tags"].encode(
+            list(columns[3])))
+        for idx, label in enumerate(self.labels):
+            values = columns[4 + idx]
+            if label in TIME_LABELS:
+                parts[f"label:{label}"].append(np.fromiter(
+                    (NULL_INT if ele is None else ele for ele in values),
+                    dtype=np.int64, count=len(batch)))
+            else:
+                parts[f"label:{label}"].append(
+                    self.dictionaries[label].encode(list(values)))
+        return size + len(buffer)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        '''Bytes of the NumPy arrays'''
+        arrays = [self.ids, self.epochs, self.dirs, self.name_start,
+                  self.name_size, self.names, self.tags] + \
+            list(self.values.values())
+        return sum(array.nbytes for array in arrays)
+
+    def supports(self, meta: dict) -> bool:
+        '''True if @meta can be answered from the snapshot'''
+        if any(key not in ("parameter", "starttime", "endtime", "labels",
+                           "tags") for key in meta):
+            return False
+        for label in meta.get("labels", {}):
+            if label not in self.labels and label in self.cache.labels:
+                return False
+        parameter = meta.get("parameter")
+        if not parameter:
+            return False
+        if isinstance(parameter, str):
+            parameter = [ele.strip() for ele in parameter.split(',')]
+        return all(column in SNAPSHOT_COLUMNS or column in self.labels
+                   for column in parameter)
+
+    def _tags_mask(self, tags: str | list | dict):
+        '''Helper function: lookup table of tag codes matching @tags'''
+        if isinstance(tags, str):
+            tags = {"any": tags.split(',')}
+        elif isinstance(tags, (list, tuple)):
+            tags = {"any": tags}
+        elif not isinstance(tags, dict):
+            return None
+        groups = []
+        if tags.get("any"):
+            groups.append(tags["any"])
+        groups.extend([[tag] for tag in tags.get("all", [])])
+        if len(groups) == 0:
+            return None
+
+        def predicate(value: str) -> bool:
+            pairs = [split_tag(tag) for tag in value.split(',')
+                     if len(tag) > 0]
+            return all(any(_tag_match(term, key, tag_value)
+                           for term in group for key, tag_value in pairs)
+                       for group in groups)
+        return self.dictionaries["tags"].lookup(predicate)
+
+    def select(self, meta: dict):
+        '''Positions of rows matching @meta, in (epoch, id) order'''
+        with self.lock:
+            return self._select(meta)
+
+    def _select(self, meta: dict):
+        '''Helper function: select, caller holds lock'''
+        lower = 0
+        upper = len(self.epochs)
+        if "starttime" in meta:
+            lower = int(np.searchsorted(self.epochs,
+                                        to_epoch(meta["starttime"]), "left"))
+        if "endtime" in meta:
+            upper = int(np.searchsorted(self.epochs,
+                                        to_epoch(meta["endtime"]), "right"))
+        if lower >= upper:
+            return np.empty(0, dtype=np.int64)
+        mask = np.ones(upper - lower, dtype=bool)
+        for label, value in meta.get("labels", {}).items():
+            if label not in self.labels:
+                continue
+            wanted = value if isinstance(value, (list, tuple)) else [value]
+            # like SQL, NULL matches nothing and text columns compare text
+            wanted = [label_value(label, ele) for ele in wanted
+                      if ele is not None]
+            column = self.values[label][lower:upper]
+            if label in TIME_LABELS:
+                mask &= np.isin(column, wanted)
+            else:
+                codes = self.dictionaries[label].codes
+                mask &= np.isin(column, [
+                    codes[str(ele)] for ele in wanted if str(ele) in codes])
+        if "tags" in meta:
+            table = self._tags_mask(meta["tags"])
+            if table is not None:
+                mask &= table[self.tags[lower:upper]]
+        return np.flatnonzero(mask) + lower
+
+    def _column(self, name: str, rows) -> list:
+        '''Helper function: Python values of column @name at @rows'''
+        if name == "id":
+            return self.ids[rows].tolist()
+        if name == "epoch":
+            return self.epochs[rows].tolist()
+        if name == "datetime":
+            text = np.datetime_as_string(
+                self.epochs[rows].astype("datetime64[s]"), unit="s")
+            return [ele.replace("T", " ") for ele in text.tolist()]
+        if name == "path":
+            names = self.names
+            dirs = self.dictionaries["dir"].values
+            return [os.path.join(dirs[folder], bytes(
+                names[start:start + size]).decode("utf-8"))
+                for folder, start, size in zip(
+                    self.dirs[rows].tolist(), self.name_start[rows].tolist(),
+                    self.name_size[rows].tolist())]
+        if name == "tags":
+            return self.dictionaries["tags"].decode(self.tags[rows].tolist())
+        values = self.values[name][rows]
+        if name in TIME_LABELS:
+            return [None if ele == NULL_INT else ele
+                    for ele in values.tolist()]
+        return self.dictionaries[name].decode(values.tolist())
+
+    def arrays(self, meta: dict) -> dict:
+        '''
+        Matching rows as column -> NumPy array (strings as object arrays)
+        of the columns in meta "parameter", default id and epoch
+        '''
+        parameter = meta.get("parameter") or ["id", "epoch"]
+        if isinstance(parameter, str):
+            parameter = [ele.strip() for ele in parameter.split(',')]
+        with self.lock:
+            rows = self._select(meta)
+            result = {}
+            for name in parameter:
+                if name == "id":
+                    result[name] = self.ids[rows]
+                elif name == "epoch":
+                    result[name] = self.epochs[rows]
+                elif name in TIME_LABELS and name in self.values:
+                    result[name] = self.values[name][rows]
+                else:
+                    result[name] = np.array(self._column(name, rows),
+                                            dtype=object)
+            return result
+
+    def search(self, meta: dict) -> list:
+        '''
+        Same rows as Cache.search, ordered by (epoch, id). Meta which is
+        not supported by the snapshot is searched in the cache.
+        '''
+        if not self.supports(meta):
+            return self.cache.search(meta)
+        parameter = meta["parameter"]
+        if isinstance(parameter, str):
+            parameter = [ele.strip() for ele in parameter.split(',')]
+        with self.lock:
+            rows = self._select(meta)
+            columns = [self._column(name, rows) for name in parameter]
+        return list(zip(*columns))
+
+    def count(self, meta: dict) -> int:
+        '''Number of rows matching @meta'''
+        return len(self.select(meta))
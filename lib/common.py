@@ -0,0 +1,28 @@
+'''
+Shared constants and helpers, cheap to import
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import datetime
+import calendar
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_FETCH_SIZE = 1000
+DEFAULT_PAGE_SIZE = 100
+# path of an archived file is "<container>::<member>", see lib.archive
+ARCHIVE_SEP = "::"
+
+
+def to_epoch(value) -> int:
+    '''Convert datetime, date, epoch number or ISO time string into epoch'''
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value.strip())
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime(value.year, value.month, value.day)
+    if value.tzinfo is not None:
+        return calendar.timegm(value.utctimetuple())
+    return calendar.timegm(value.timetuple())
@@ -1,178 +1,306 @@
-'''
-Config manager subsystem
-
-Author: Weiru Chen <flamingm321@gmail.com>
-Date: 2024-01-21
-'''
-
-import re
-import os
-import json
-from pathlib import Path
-from enum import Enum
-import toml
-
-
-class ConfigType(Enum):
-    '''Config file type'''
-    UNKNOWN = 0
-    TEXT = 1
-    INI = 2
-    JSON = 3
-    TOML = 4
-
-    @staticmethod
-    def get(suffix: str):
-        """Retrieve config file enum type"""
-        suffix = suffix.lower()
-        if suffix == 'txt':
-            return ConfigType.TEXT
-        if suffix == 'ini':
-            return ConfigType.INI
-        if suffix == 'json':
-            return ConfigType.JSON
-        if suffix == 'toml':
-            return ConfigType.TOML
-        return ConfigType.UNKNOWN
-
-
-class ConfigManager:
-    '''
-    Config Manager use to manager config file
-
-    Note. current only support Json
-    '''
-    def __init__(self, config):
-        self.path = Path(config)
-        self.file = self.path.name
-        self.type = ConfigType.get(self.path.suffix[1:])
-
-        if self.type == ConfigType.JSON:
-            with open(config, 'r', encoding='utf-8') as f:
-                self.config = json.load(f)
-        elif self.type == ConfigType.TOML:
-            with open(config, 'r', encoding='utf-8') as f:
-                self.config = toml.load(f)
-        else:
-            raise f"[ConfigManager] not support config format: {self.type}\
-                  (file: {self.file})"
-
-    def save(self):
-        '''Save config to file'''
-        if self.type == ConfigType.JSON:
-            with open(self.path, 'w', encoding='utf-8') as f:
-                json.dump(self.config, f)
-        elif self.type == ConfigType.TOML:
-            with open(self.path, 'w', encoding='utf-8') as f:
-                toml.dump(self.config, f)
-        else:
-            raise f"[ConfigManager] not support config format: {self.type}\
-                  (file: {self.file})"
-
-    def delete(self):
-        '''Remove config file'''
-        os.remove(self.path)
-
-    def reload(self):
-        '''Reload config'''
-        if self.type == ConfigType.JSON:
-            with open(self.path, 'r', encoding='utf-8') as f:
-                self.config = json.load(f)
-        elif self.type == ConfigType.TOML:
-            with open(self.path, 'r', encoding='utf-8') as f:
-                self.config = toml.load(f)
-        else:
-            raise f"[ConfigManager] not support config format: {self.type}\
-                  (file: {self.file})"
-
-    def get(self) -> dict:
-        '''Get config from RAM'''
-        return self.config
-
-    def set(self, keys: str | list, value):
-        '''Set config'''
-        if isinstance(keys, str):
-            self.config[keys] = value
-        elif isinstance(keys, list):
-            cfg = self.config
-            for key in keys[:-1]:
-                cfg = cfg[key]
-            cfg[keys[-1]] = value
-
-
-class ConfigFinder:
-    '''
-    Config Finder use to find specifed rule in config
-    '''
-    def __init__(self, config):
-        self.config = ConfigManager(config)
-        self.re_match = None
-        self.rule = None
-        self.file = None
-        self.rulename = None
-
-    def clear(self):
-        '''Clear all config in RAM and reload from file'''
-        self.re_match = None
-        self.rule = None
-        self.file = None
-        self.rulename = None
-        self.config.reload()
-
-    def set_rule(self, rule):
-        '''Helper function: setup rule with init root information'''
-        self.rule = rule
-        self.rule['root'] = self.config.config['root']
-
-    def find_rule(self, rulename: str) -> bool:
-        '''Find specified rule in config'''
-        if rulename not in self.config.get()["rules"].keys():
-            return False
-        self.rulename = rulename
-        self.set_rule(self.config.get()["rules"][rulename])
-        return True
-
-    def find_match(self, filepath: str) -> bool:
-        '''Find rule which the filter rule match filepath'''
-        self.clear()
-        for rulename in self.config.get()["rules"].keys():
-            rule = self.config.get()["rules"][rulename]
-            if "format" not in rule:
-                continue
-            self.re_match = re.match(rule["format"], filepath)
-            if self.re_match is not None:
-                self.rulename = rulename
-                self.set_rule(rule)
-                self.file = Path(filepath)
-                return True
-        return False
-
-    def dump_result(self):
-        '''Dump debug info'''
-        if self.file is None or self.re_match is None:
-            return
-
-        print(f"file: {self.file}")
-        print(f"match result: {self.re_match}")
-        # print(self.rule)
-        print("folder layer:")
-        for folder in self.rule["folder"][1:]:
-            print(f"\t{folder}: {self.re_match.group(folder)}")
-        print()
-
-    def get_destination(self) -> None | str | Path:
-        '''Helper function: Generate destination path which is matched'''
-        if self.re_match is None or self.rule["folder"] is None:
-            return None
-        root = self.config.get()["root"]
-        folders = [self.rule["folder"][0]]
-        folders.extend(
-            [self.re_match.group(key) for key in self.rule["folder"][1:]]
-        )
-        return Path(root, *folders, self.file.name)
-
-
-if __name__ == "__main__":
-    cfg = ConfigManager("./config.json")
-    cfg.set(['rules', 'unknown', 'type'], '123')
-    print(cfg.get())
+'''
+Config manager subsystem
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import os
+import json
+import time
+import threading
+from pathlib import Path
+from enum import Enum
+from types import MappingProxyType
+from lib.error import GeneralException
+from lib.rule_matcher import RuleMatcher, RuleMatch
+from lib import metrics
+
+# Seconds between two config file stat checks on the hot path
+DEFAULT_CHECK_INTERVAL = 1.0
+
+
+class ConfigType(Enum):
+    '''Config file type'''
+    UNKNOWN = 0
+    TEXT = 1
+    INI = 2
+    JSON = 3
+    TOML = 4
+
+    @staticmethod
+    def get(suffix: str):
+        """Retrieve config file enum type"""
+        suffix = suffix.lower()
+        if suffix == 'txt':
+            return ConfigType.TEXT
+        if suffix == 'ini':
+            return ConfigType.INI
+        if suffix == 'json':
+            return ConfigType.JSON
+        if suffix == 'toml':
+            return ConfigType.TOML
+        return ConfigType.UNKNOWN
+
+
+def _freeze(value):
+    '''Helper function: convert dict/list into read-only mapping/tuple'''
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _thaw(value):
+    '''Helper function: convert frozen config back into dict/list'''
+    if isinstance(value, MappingProxyType):
+        return {k: _thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    return value
+
+
+class ConfigSnapshot:
+    '''
+    Immutable content of one config file version, never changed once
+    published: reload() and save() publish a new snapshot even when only
+    the file stat changed
+
+     @data: read-only config mapping (dict -> mappingproxy, list -> tuple)
+     @version: increased whenever the content changes
+     @mtime_ns, @size: config file stat which the content was read at
+    '''
+    __slots__ = ("data", "version", "mtime_ns", "size")
+
+    def __init__(self, data: dict, version: int, mtime_ns: int, size: int):
+        self.data = _freeze(data)
+        self.version = version
+        self.mtime_ns = mtime_ns
+        self.size = size
+
+    def restat(self, stat: os.stat_result) -> 'ConfigSnapshot':
+        '''Same content and version read at file @stat, as a new snapshot'''
+        return ConfigSnapshot(self.data, self.version, stat.st_mtime_ns,
+                              stat.st_size)
+
+
+class ConfigManager:
+    '''
+    Config Manager use to manager config file
+
+    The config content is kept as an immutable ConfigSnapshot which is
+    replaced as a whole on reload or set, so readers never see a partially
+    updated config. Use ConfigManager.shared to reuse one manager (and one
+    parsed config) per config file in the process.
+
+    Note. current only support Json
+    '''
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, config,
+                 check_interval: float = DEFAULT_CHECK_INTERVAL):
+        self.path = Path(config)
+        self.file = self.path.name
+        self.type = ConfigType.get(self.path.suffix[1:])
+        self.check_interval = check_interval
+        self.checked_at = time.monotonic()
+        self.snapshot = None
+        self.reload()
+
+    @classmethod
+    def shared(cls, config) -> 'ConfigManager':
+        '''Get the process wide manager of @config file'''
+        key = Path(config).resolve()
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(config)
+            return cls._shared[key]
+
+    @property
+    def config(self) -> MappingProxyType:
+        '''Config content of current snapshot'''
+        return self.snapshot.data
+
+    @property
+    def version(self) -> int:
+        '''Version of current snapshot'''
+        return self.snapshot.version
+
+    def _read(self) -> dict:
+        '''Helper function: parse config file'''
+        if self.type == ConfigType.JSON:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        if self.type == ConfigType.TOML:
+            # imported here, JSON configs do not pay for it
+            import toml
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return toml.load(f)
+        raise GeneralException(
+            f"[ConfigManager] not support config format: {self.type} "
+            f"(file: {self.file})")
+
+    def _replace(self, config: dict, stat: os.stat_result):
+        '''Helper function: publish @config as a new snapshot'''
+        version = 0 if self.snapshot is None else self.snapshot.version + 1
+        self.snapshot = ConfigSnapshot(config, version, stat.st_mtime_ns,
+                                       stat.st_size)
+
+    def save(self):
+        '''Save config to file'''
+        if self.type == ConfigType.JSON:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(_thaw(self.config), f)
+        elif self.type == ConfigType.TOML:
+            import toml
+            with open(self.path, 'w', encoding='utf-8') as f:
+                toml.dump(_thaw(self.config), f)
+        else:
+            raise GeneralException(
+                f"[ConfigManager] not support config format: {self.type} "
+                f"(file: {self.file})")
+        self.snapshot = self.snapshot.restat(os.stat(self.path))
+
+    def delete(self):
+        '''Remove config file'''
+        os.remove(self.path)
+
+    def reload(self):
+        '''Reload config, version is bumped only if the content changed'''
+        with metrics.timer("config_reload"):
+            stat = os.stat(self.path)
+            config = self._read()
+        if self.snapshot is not None and config == _thaw(self.config):
+            self.snapshot = self.snapshot.restat(stat)
+            return
+        self._replace(config, stat)
+
+    def refresh(self) -> bool:
+        '''
+        Reload config if the file mtime or size changed. The file is stat-ed
+        at most once per @check_interval seconds.
+        Return True if the file was reloaded
+        '''
+        now = time.monotonic()
+        if now - self.checked_at < self.check_interval:
+            return False
+        self.checked_at = now
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        if stat.st_mtime_ns == self.snapshot.mtime_ns and \
+           stat.st_size == self.snapshot.size:
+            return False
+        self.reload()
+        return True
+
+    def get(self) -> MappingProxyType:
+        '''Get config from RAM'''
+        return self.config
+
+    def set(self, keys: str | list, value):
+        '''Set config, which publishes a new snapshot'''
+        config = _thaw(self.config)
+        if isinstance(keys, str):
+            config[keys] = value
+        elif isinstance(keys, list):
+            cfg = config
+            for key in keys[:-1]:
+                cfg = cfg[key]
+            cfg[keys[-1]] = value
+        self.snapshot = ConfigSnapshot(config, self.snapshot.version + 1,
+                                       self.snapshot.mtime_ns,
+                                       self.snapshot.size)
+
+
+class ConfigFinder:
+    '''
+    Config Finder use to find specifed rule in config
+    '''
+    def __init__(self, config: str | Path | ConfigManager):
+        self.config = config if isinstance(config, ConfigManager)\
+            else ConfigManager.shared(config)
+        self.result = None
+        self.re_match = None
+        self.rule = None
+        self.file = None
+        self.rulename = None
+        self.matcher = None
+        self.matcher_version = None
+
+    def clear(self):
+        '''Clear last match result'''
+        self.result = None
+        self.re_match = None
+        self.rule = None
+        self.file = None
+        self.rulename = None
+
+    def set_rule(self, rule):
+        '''Helper function: setup rule with init root information'''
+        self.rule = dict(rule)
+        self.rule['root'] = self.config.config['root']
+
+    def find_rule(self, rulename: str) -> bool:
+        '''Find specified rule in config'''
+        if rulename not in self.config.get()["rules"].keys():
+            return False
+        self.rulename = rulename
+        self.set_rule(self.config.get()["rules"][rulename])
+        return True
+
+    def get_matcher(self) -> RuleMatcher:
+        '''Get the compiled rule matcher of current config version'''
+        if self.matcher is None or self.matcher_version != self.config.version:
+            self.matcher = RuleMatcher(self.config.get()["rules"])
+            self.matcher_version = self.config.version
+        return self.matcher
+
+    def match(self, filepath: str) -> None | RuleMatch:
+        '''Find rule which match @filepath without touching finder state'''
+        with metrics.timer("match"):
+            return self.get_matcher().match(filepath)
+
+    def find_match(self, filepath: str) -> bool:
+        '''Find rule which the filter rule match filepath'''
+        self.clear()
+        self.config.refresh()
+        result = self.match(filepath)
+        if result is None:
+            return False
+        self.result = result
+        self.re_match = result.match
+        self.rulename = result.rulename
+        self.set_rule(result.rule)
+        self.file = result.file
+        return True
+
+    def dump_result(self):
+        '''Dump debug info'''
+        if self.file is None or self.re_match is None:
+            return
+
+        print(f"file: {self.file}")
+        print(f"match result: {self.re_match}")
+        # print(self.rule)
+        print("folder layer:")
+        for folder in self.rule["folder"][1:]:
+            print(f"\t{folder}: {self.re_match.group(folder)}")
+        print()
+
+    def get_destination(self) -> None | str | Path:
+        '''
+        Helper function: Generate destination path which is matched, the
+        same path ingest and reconcile derive from the rule match
+        '''
+        if self.result is None:
+            return None
+        return self.result.get_destination(self.config.get()["root"])
+
+if __name__ == "__main__":
+    cfg = ConfigManager("./config.json")
+    cfg.set(['rules', 'unknown', 'type'], '123')
+    print(cfg.get())
@@ -0,0 +1,58 @@
+'''
+Content hash subsystem
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import os
+import mmap
+import hashlib
+from enum import Enum
+from pathlib import Path
+
+DEFAULT_ALGORITHM = "sha256"
+CHUNK_SIZE = 1024 * 1024
+# Files larger than this are hashed through mmap instead of read chunks
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+
+class DedupPolicy(Enum):
+    '''
+    What to do with a file whose content is already stored
+        SKIP = 1: leave the source file, nothing is stored
+        LINK = 2: store a hard link (or symlink) to the stored file
+        KEEP = 3: store both copies
+    '''
+    SKIP = 1
+    LINK = 2
+    KEEP = 3
+
+    @staticmethod
+    def get(name: None | str):
+        '''Retrieve policy enum from config string, default SKIP'''
+        if name is None:
+            return DedupPolicy.SKIP
+        return DedupPolicy[name.upper()]
+
+
+def file_digest(path: str | Path, algorithm: str = DEFAULT_ALGORITHM,
+                chunk_size: int = CHUNK_SIZE,
+                mmap_threshold: int = MMAP_THRESHOLD) -> str:
+    '''Streaming content hash of @path in hex'''
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= mmap_threshold > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                digest.update(mm)
+            return digest.hexdigest()
+
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        while True:
+            size = f.readinto(buf)
+            if not size:
+                break
+            digest.update(view[:size])
+    return digest.hexdigest()
@@ -1,35 +1,171 @@
-'''
-File manager subsystem
-
-Author: Weiru Chen <flamingm321@gmail.com>
-Date: 2024-01-21
-'''
-
-from pathlib import Path
-from lib.config_manager import ConfigManager
-
-
-class FileManager:
-    '''
-    File Manager use to manager file-base database
-    '''
-    def __init__(self, config):
-        self.config = ConfigManager(config)
-        if self.config.get()["root"] is not None:
-            return
-        self.root = Path.absolute("./output/")
-        self.config.set("root", str(self.root))
-        self.config.save()
-
-    def check_or_create_folder(self, path: str | Path):
-        '''Create all directories in specified path which may not exist'''
-        Path(path).mkdir(parents=True, exist_ok=True)
-
-    def move(self, dst: str | Path, src: str | Path):
-        '''
-        Move @src file into @dst which @dst included filename and suffix type
-        '''
-        src_path = Path(src)
-        dst_path = Path(dst)
-        self.check_or_create_folder(dst_path.parent)
-        src_path.rename(dst_path)
+'''
+File manager subsystem
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import os
+import errno
+import shutil
+import filecmp
+import uuid
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from lib.config_manager import ConfigManager
+from lib import metrics
+
+DEFAULT_MOVE_WORKERS = 4
+# Bytes per copy_file_range/sendfile call
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+# errno which mean the kernel copy is not usable for these files
+_FALLBACK_ERRNO = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF,
+                   errno.EOPNOTSUPP, errno.ENOTSUP, errno.EPERM}
+
+
+def _copy_fd(infd: int, outfd: int):
+    '''
+    Helper function: copy content of @infd into @outfd
+    Try copy_file_range, then sendfile (both zero-copy in kernel), then
+    plain read/write.
+    '''
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while True:
+                size = os.copy_file_range(infd, outfd, COPY_CHUNK_SIZE)
+                if size == 0:
+                    return
+                copied += size
+        except OSError as err:
+            if copied > 0 or err.errno not in _FALLBACK_ERRNO:
+                raise
+
+    if hasattr(os, "sendfile"):
+        try:
+            while True:
+                size = os.sendfile(outfd, infd, copied, COPY_CHUNK_SIZE)
+                if size == 0:
+                    return
+                copied += size
+        except OSError as err:
+            if copied > 0 or err.errno not in _FALLBACK_ERRNO:
+                raise
+
+    while True:
+        buf = os.read(infd, COPY_CHUNK_SIZE)
+        if not buf:
+            return
+        view = memoryview(buf)
+        while view:
+            view = view[os.write(outfd, view):]
+
+
+def _fsync_dir(path: Path):
+    '''Helper function: persist directory entry changes of @path'''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class FileManager:
+    '''
+    File Manager use to manager file-base database
+    '''
+    def __init__(self, config: str | Path | ConfigManager,
+                 verify: bool = False):
+        self.config = config if isinstance(config, ConfigManager)\
+            else ConfigManager.shared(config)
+        self.verify = verify
+        if self.config.get()["root"] is not None:
+            return
+        self.root = Path.absolute("./output/")
+        self.config.set("root", str(self.root))
+        self.config.save()
+
+    def check_or_create_folder(self, path: str | Path):
+        '''Create all directories in specified path which may not exist'''
+        Path(path).mkdir(parents=True, exist_ok=True)
+
+    def move(self, dst: str | Path, src: str | Path,
+             verify: None | bool = None):
+        '''
+        Move @src file into @dst which @dst included filename and suffix type
+         @verify: compare the copy with @src before deleting @src when the
+                  move crosses filesystems (default: FileManager.verify)
+        '''
+        src_path = Path(src)
+        dst_path = Path(dst)
+        with metrics.timer("mkdir"):
+            self.check_or_create_folder(dst_path.parent)
+        try:
+            with metrics.timer("move", kind="rename"):
+                src_path.rename(dst_path)
+            return
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+        verify = self.verify if verify is None else verify
+        with metrics.timer("move", kind="copy"):
+            self._move_across(dst_path, src_path, verify)
+
+    def link(self, dst: str | Path, target: str | Path, src: str | Path):
+        '''
+        Store @dst as a hard link (symlink if not possible) to the already
+        stored @target, which has the same content as @src, and remove @src
+        '''
+        dst_path = Path(dst)
+        self.check_or_create_folder(dst_path.parent)
+        with metrics.timer("link"):
+            try:
+                os.link(target, dst_path)
+            except OSError:
+                os.symlink(target, dst_path)
+            Path(src).unlink()
+
+    def _move_across(self, dst: Path, src: Path, verify: bool):
+        '''
+        Helper function: move between filesystems. Copy into a temporary
+        file next to @dst, fsync it, then atomically rename it into place.
+        '''
+        tmp = dst.with_name(f".{dst.name}.{uuid.uuid4().hex}.part")
+        try:
+            with open(src, 'rb') as fsrc, open(tmp, 'xb') as fdst:
+                _copy_fd(fsrc.fileno(), fdst.fileno())
+                os.fsync(fdst.fileno())
+            shutil.copystat(src, tmp)
+            if verify and not filecmp.cmp(src, tmp, shallow=False):
+                raise OSError(errno.EIO, f"copy of {src} is corrupted", tmp)
+            os.replace(tmp, dst)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        _fsync_dir(dst.parent)
+        src.unlink()
+
+    def move_many(self, pairs: list, workers: int = DEFAULT_MOVE_WORKERS,
+                  verify: None | bool = None) -> dict:
+        '''
+        Move many files concurrently
+         @pairs: list of (dst, src)
+        Return dict of dst -> None or the raised OSError
+        '''
+        def run(pair):
+            try:
+                self.move(pair[0], pair[1], verify)
+            except OSError as err:
+                return err
+            return None
+
+        if workers <= 1 or len(pairs) <= 1:
+            return {dst: run((dst, src)) for dst, src in pairs}
+        with ThreadPoolExecutor(workers, "FileDB-move") as pool:
+            errors = pool.map(run, pairs)
+            return {dst: err for (dst, _), err in zip(pairs, errors)}
@@ -0,0 +1,333 @@
+'''
+Ingest pipeline subsystem
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import os
+import queue
+import threading
+from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from lib.error import FileExistInDataBase, UnknownFileType
+from lib.digest import DedupPolicy, file_digest, DEFAULT_ALGORITHM
+from lib.common import ARCHIVE_SEP
+from lib import metrics
+
+DEFAULT_WORKERS = 8
+DEFAULT_QUEUE_SIZE = 1024
+# Number of locks which serialize files of the same content hash
+DEDUP_LOCKS = 64
+
+
+class AddStatus(Enum):
+    '''
+    Result of adding one file
+        ADDED = 1
+        EXISTS = 2
+        UNKNOWN = 3
+        FAILED = 4
+        DUPLICATE = 5
+    '''
+    ADDED = 1
+    EXISTS = 2
+    UNKNOWN = 3
+    FAILED = 4
+    DUPLICATE = 5
+
+
+def _exists(path: str | Path) -> bool:
+    '''Helper function: timed os.path.exists'''
+    with metrics.timer("exists"):
+        return os.path.exists(path)
+
+
+def _digest(path: str | Path, algorithm: str) -> str:
+    '''Helper function: timed file_digest'''
+    with metrics.timer("hash"):
+        return file_digest(path, algorithm)
+
+
+def plan_dedup(rule: dict, src: Path, dst: Path, lookup,
+               digest: None | str = None) -> tuple:
+    '''
+    Decide where and how @src is stored, using the rule `dedup` config
+     @lookup: function of content hash -> path of the stored file or None
+     @digest: content hash of @src if it is already computed
+    Return (AddStatus if the file is not stored else None, destination,
+            stored path to link to or None, content hash or None)
+    '''
+    dedup = rule.get("dedup")
+    if not dedup:
+        if _exists(dst):
+            return AddStatus.EXISTS, dst, None, None
+        return None, dst, None, None
+
+    algorithm = dedup.get("hash", DEFAULT_ALGORITHM)
+    policy = DedupPolicy.get(dedup.get("policy"))
+    if digest is None:
+        digest = _digest(src, algorithm)
+    same = lookup(digest)
+
+    if _exists(dst):
+        if same is None and _digest(dst, algorithm) == digest:
+            same = str(dst)
+        if same is not None and policy != DedupPolicy.KEEP:
+            return AddStatus.DUPLICATE, dst, None, digest
+        # same name but other content (or KEEP): store beside it
+        dst = dst.with_name(f"{dst.stem}.{digest[:12]}{dst.suffix}")
+        if _exists(dst):
+            return AddStatus.DUPLICATE, dst, None, digest
+
+    if same is None or policy == DedupPolicy.KEEP:
+        return None, dst, None, digest
+    # archived members can not be linked to
+    if policy == DedupPolicy.SKIP or ARCHIVE_SEP in same:
+        return AddStatus.DUPLICATE, dst, None, digest
+    return None, dst, same, digest
+
+
+class RuleWriter(threading.Thread):
+    '''
+    Dedicated index writer thread of one rule cache
+
+    Every row of the rule is funneled through its bounded queue into the
+    rule cache of FileDB, which is shared with searches; its writes are
+    serialized by the index lock.
+    '''
+    def __init__(self, rulename: str, factory, rule: dict, report,
+                 queue_size: int, batch_size: int, lookup=None):
+        super().__init__(name=f"FileDB-writer-{rulename}", daemon=True)
+        self.rulename = rulename
+        self.factory = factory
+        self.rule = rule
+        self.report = report
+        self.lookup = lookup
+        self.batch_size = max(1, batch_size)
+        self.queue = queue.Queue(queue_size)
+
+    def put(self, item: tuple):
+        '''
+        Queue (filepath, dst, tags, match, digest), blocks while queue is full
+        '''
+        self.queue.put(item)
+
+    def close(self):
+        '''Flush queued rows and stop the writer'''
+        self.queue.put(None)
+        self.join()
+
+    def _next_batch(self) -> list:
+        '''Helper function: wait for one row and take what is queued'''
+        batch = [self.queue.get()]
+        while batch[-1] is not None and len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        try:
+            db = self.factory()
+        except Exception as err:
+            db = None
+            self.report.log.error(f"[{self.rulename}] open cache: {err}")
+
+        while True:
+            batch = self._next_batch()
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            if len(batch) > 0:
+                self._write(db, batch)
+            if stop:
+                return
+
+    def _write(self, db, batch: list):
+        '''Helper function: insert one batch of rows'''
+        if db is None:
+            for item in batch:
+                self.report.set(item[0], AddStatus.FAILED)
+            return
+        try:
+            with metrics.timer("index_write", rule=self.rulename) as timer:
+                timer.count("index_rows", len(batch))
+                db.add_cache_many(
+                    [item[1] for item in batch], self.rule,
+                    {item[1]: item[2] for item in batch},
+                    self.batch_size,
+                    {item[1]: item[3] for item in batch},
+                    {item[1]: item[4] for item in batch})
+        except Exception as err:
+            self.report.log.error(f"[{self.rulename}] insert failed: {err}")
+            for item in batch:
+                self.report.set(item[0], AddStatus.FAILED)
+            return
+        for item in batch:
+            self.report.set(item[0], AddStatus.ADDED)
+
+
+class IngestReport:
+    '''Thread-safe filepath -> AddStatus report'''
+    def __init__(self, filepaths: list, log):
+        self.log = log
+        self.lock = threading.Lock()
+        self.result = {filepath: None for filepath in filepaths}
+
+    def set(self, filepath: str, status: AddStatus):
+        '''Record @status of @filepath'''
+        with self.lock:
+            self.result[filepath] = status
+
+
+class IngestPipeline:
+    '''
+    Parallel ingest pipeline of FileDB
+
+    Rule matching runs in the calling thread, stat/mkdir/move work runs in
+    a thread pool and index rows are written by one RuleWriter per rule.
+    At most @queue_size files are in flight in the pool and in each writer
+    queue, so a slow stage pushes back on the stages before it.
+
+    Unlike FileDB.add, a file is moved first and indexed afterwards, so a
+    failed move never leaves a row behind.
+
+    For rules with `dedup`, content hashes are computed in the pool. Files
+    sharing a content hash or a destination are serialized by striped
+    locks, so duplicates inside one run are found as well.
+    '''
+    def __init__(self, db, workers: int = DEFAULT_WORKERS,
+                 queue_size: int = DEFAULT_QUEUE_SIZE,
+                 batch_size: int = 1000):
+        self.db = db
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.batch_size = batch_size
+        self.locks = [threading.Lock() for _ in range(DEDUP_LOCKS)]
+        self.seen = {}
+
+    def _cache(self, rulename: str):
+        '''Helper function: rule cache of FileDB, loaded on first use'''
+        self.db.load_module(rulename)
+        return self.db.groups[rulename]["db"]
+
+    def _writer(self, writers: dict, report: IngestReport,
+                rulename: str, rule: dict) -> RuleWriter:
+        '''Helper function: get or start the writer of @rulename'''
+        if rulename not in writers:
+            lookup = None
+            if rule.get("dedup"):
+                cache = self._cache(rulename)
+
+                def lookup(digest):
+                    return self.seen.get((rulename, digest)) or \
+                        cache.find_hash(digest)
+
+            writer = RuleWriter(
+                rulename, lambda: self._cache(rulename),
+                rule, report, self.queue_size, self.batch_size, lookup)
+            writer.start()
+            writers[rulename] = writer
+        return writers[rulename]
+
+    def _stage(self, writer: RuleWriter, report: IngestReport,
+               item: tuple, src: Path):
+        '''Helper function: filesystem stage of one file in worker thread'''
+        if writer.lookup is None:
+            self._store(writer, report, item, src, None)
+            return
+
+        dedup = writer.rule["dedup"]
+        try:
+            digest = _digest(src, dedup.get("hash", DEFAULT_ALGORITHM))
+        except OSError as err:
+            report.log.error(f"hash {src} failed: {err}")
+            report.set(item[0], AddStatus.FAILED)
+            return
+        stripes = sorted({hash(digest) % DEDUP_LOCKS,
+                          hash(str(item[1])) % DEDUP_LOCKS})
+        for idx in stripes:
+            self.locks[idx].acquire()
+        try:
+            self._store(writer, report, item, src, digest)
+        finally:
+            for idx in reversed(stripes):
+                self.locks[idx].release()
+
+    def _store(self, writer: RuleWriter, report: IngestReport,
+               item: tuple, src: Path, digest: None | str):
+        '''Helper function: move or link one file and queue its row'''
+        filepath, dst = item[0], item[1]
+        status, dst, link, digest = plan_dedup(
+            writer.rule, src, dst, writer.lookup, digest)
+        if status == AddStatus.EXISTS:
+            report.log.error(FileExistInDataBase(f"{src} is exist in {dst}"))
+        elif status == AddStatus.DUPLICATE:
+            report.log.warn(f"{src} is duplicate of a stored file")
+        if status is not None:
+            report.set(filepath, status)
+            return
+        try:
+            if link is None:
+                self.db.manager.move(dst, src)
+            else:
+                self.db.manager.link(dst, link, src)
+        except OSError as err:
+            report.log.error(f"move {src} -> {dst} failed: {err}")
+            report.set(filepath, AddStatus.FAILED)
+            return
+        if digest is not None:
+            self.seen[(writer.rulename, digest)] = str(dst)
+        writer.put((filepath, dst, item[2], item[3], digest))
+
+    def run(self, filepaths: list, tags: None | list | dict = None) -> dict:
+        '''
+        Ingest @filepaths
+         @tags: tags list for all files, or a dict of filepath -> tags list
+        Return dict of filepath -> AddStatus
+        '''
+        report = IngestReport(filepaths, self.db.log)
+        root = self.db.config.get()["root"]
+        writers = {}
+        claimed = set()
+        slots = threading.BoundedSemaphore(self.queue_size)
+
+        def release(_):
+            slots.release()
+
+        try:
+            with ThreadPoolExecutor(self.workers,
+                                    "FileDB-ingest") as pool:
+                for filepath in filepaths:
+                    result = self.db.finder.match(filepath)
+                    if result is None or "plugin" not in result.rule:
+                        report.log.warn(UnknownFileType(f"File: {filepath}"))
+                        report.set(filepath, AddStatus.UNKNOWN)
+                        continue
+
+                    dst = result.get_destination(root)
+                    if dst in claimed and not result.rule.get("dedup"):
+                        report.log.error(FileExistInDataBase(
+                            f"{result.file} is exist in {dst}"))
+                        report.set(filepath, AddStatus.EXISTS)
+                        continue
+                    claimed.add(dst)
+
+                    rule = dict(result.rule, root=root)
+                    writer = self._writer(writers, report,
+                                          result.rulename, rule)
+                    file_tags = tags.get(filepath) if isinstance(tags, dict)\
+                        else tags
+                    slots.acquire()
+                    future = pool.submit(
+                        self._stage, writer, report,
+                        (filepath, dst, file_tags, result.match),
+                        result.file)
+                    future.add_done_callback(release)
+        finally:
+            for writer in writers.values():
+                writer.close()
+        return report.result
@@ -1,54 +1,246 @@
-'''
-File Database basic data structure
-
-Author: Weiru Chen <flamingm321@gmail.com>
-Date: 2024-01-21
-'''
-import sqlite3
-from pathlib import Path
-import re
-
-
-class Index:
-    '''File Database index which wrap sqlite3 function'''
-    def __init__(self, path: str | Path) -> None:
-        self.db = sqlite3.connect(path)
-        self.cur = self.db.cursor()
-        self.exe = self.cur.execute
-        self.fa = self.cur.fetchall
-
-    def init(self, tablename: str = "contents"):
-        '''create database table'''
-        raw_query = f"""
-            CREATE TABLE IF NOT EXISTS {tablename} (
-                id integer primary key autoincrement,
-                datetime text,
-                path text NOT NULL,
-                tags text
-            );"""
-        query = re.sub(r"\n?\s+", " ", raw_query)
-        self.exe(query)
-
-    def query(self, cmd: str):
-        '''SQL query'''
-        query = re.sub(r"\n?\s+", " ", cmd)
-        self.exe(query)
-        self.db.commit()
-
-    def add_column(self, tablename: str, column: str, dtype: str,
-                   opts: str = ""):
-        '''Add new column into sql'''
-        query = f"""
-            ALTER TABLE {tablename} ADD {column} {dtype} {opts};
-            """
-        self.exe(query)
-
-    def get_default_tablename(self) -> str:
-        '''Get default tablename'''
-        return "contents"
-
-    def get_columns(self, tablename: str) -> list:
-        '''Get all column in specified @tablename'''
-        query = f"PRAGMA table_info({tablename});"
-        self.exe(query)
-        return [row[1] for row in self.fa()]
+'''
+File Database basic data structure
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+import sqlite3
+import threading
+import queue
+from contextlib import contextmanager
+from pathlib import Path
+import re
+from lib import metrics
+
+
+DEFAULT_READERS = 4
+# Pragmas of writer connection if rule config does not set them
+DEFAULT_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout": 5000,
+}
+# Pragmas which are also applied to read-only connections
+READER_PRAGMAS = ["cache_size", "mmap_size", "busy_timeout", "temp_store"]
+PRAGMAS = ["journal_mode", "synchronous", "wal_autocheckpoint"] + \
+    READER_PRAGMAS
+
+
+def _timer(query: str):
+    '''Helper function: SQL timer labeled with the statement kind'''
+    if not metrics.METRICS.enabled:
+        return metrics.NULL
+    return metrics.timer("sql", op=query.split(None, 1)[0].lower())
+
+
+def apply_pragmas(db: sqlite3.Connection, pragmas: dict):
+    '''Apply known @pragmas to connection @db'''
+    for key, value in pragmas.items():
+        if key not in PRAGMAS:
+            continue
+        if not isinstance(value, int) and \
+           re.fullmatch(r"\w+", str(value)) is None:
+            continue
+        db.execute(f"PRAGMA {key} = {value};").fetchall()
+
+
+class ReadPool:
+    '''Thread-safe pool of read-only connections of one database'''
+    def __init__(self, path: str | Path, size: int = DEFAULT_READERS,
+                 pragmas: None | dict = None):
+        self.uri = Path(path).absolute().as_uri() + "?mode=ro"
+        self.pragmas = {key: value for key, value in (pragmas or {}).items()
+                        if key in READER_PRAGMAS}
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(max(1, size))
+        self.conns = []
+        self.lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        '''Helper function: open one read-only connection'''
+        conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+        apply_pragmas(conn, self.pragmas)
+        with self.lock:
+            self.conns.append(conn)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        '''Borrow one connection, blocks while all are in use'''
+        self.slots.acquire()
+        try:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+            finally:
+                self.idle.put(conn)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        '''Close all connections'''
+        with self.lock:
+            for conn in self.conns:
+                conn.close()
+            self.conns = []
+        self.idle = queue.LifoQueue()
+
+
+class Index:
+    '''
+    File Database index which wrap sqlite3 function
+
+    One writer connection (guarded by @lock) and a pool of read-only
+    connections. With WAL journaling (default) the readers run in parallel
+    with each other and with the writer.
+    '''
+    def __init__(self, path: str | Path, pragmas: None | dict = None,
+                 readers: int = DEFAULT_READERS) -> None:
+        self.path = Path(path)
+        self.pragmas = dict(DEFAULT_PRAGMAS, **(pragmas or {}))
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        apply_pragmas(self.db, self.pragmas)
+        self.lock = threading.RLock()
+        self.cur = self.db.cursor()
+        self.exe = self.cur.execute
+        self.fa = self.cur.fetchall
+        self.readers = ReadPool(path, readers, self.pragmas)
+
+    def close(self):
+        '''Close all connections'''
+        self.readers.close()
+        with self.lock:
+            self.db.close()
+
+    def init(self, tablename: str = "contents"):
+        '''create database table'''
+        raw_query = f"""
+            CREATE TABLE IF NOT EXISTS {tablename} (
+                id integer primary key autoincrement,
+                datetime text,
+                path text NOT NULL,
+                tags text,
+                hash text
+            );"""
+        query = re.sub(r"\n?\s+", " ", raw_query)
+        self.exe(query)
+
+    def query(self, cmd: str, params: tuple | dict = ()):
+        '''SQL query'''
+        query = re.sub(r"\n?\s+", " ", cmd)
+        with _timer(query) as timer:
+            self.exe(query, params)
+            self.db.commit()
+            timer.count("sql_rows", max(0, self.cur.rowcount))
+
+    def executemany(self, cmd: str, rows: list):
+        '''SQL query for each parameter row, committed as one transaction'''
+        query = re.sub(r"\n?\s+", " ", cmd)
+        with self.lock, self.db, _timer(query) as timer:
+            self.db.executemany(query, rows)
+            timer.count("sql_rows", len(rows))
+
+    @contextmanager
+    def transaction(self):
+        '''Write transaction which holds the database write lock'''
+        with self.lock, metrics.timer("sql_transaction"):
+            if self.db.in_transaction:
+                self.db.commit()
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.rollback()
+                raise
+            with metrics.timer("sql_commit"):
+                self.db.commit()
+
+    def has_table(self, tablename: str) -> bool:
+        '''Check table exist or not'''
+        rows = self.fetch("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                          "AND name = ?;", (tablename,))
+        return len(rows) > 0
+
+    def read(self, cmd: str, params: tuple | dict = ()) -> list:
+        '''SQL select on a pooled read-only connection'''
+        query = re.sub(r"\n?\s+", " ", cmd)
+        with self.readers.connection() as conn, _timer(query) as timer:
+            rows = conn.execute(query, params).fetchall()
+            timer.count("sql_rows", len(rows))
+            return rows
+
+    def iterate(self, cmd: str, params: tuple | dict = (),
+                batch_size: int = 1000):
+        '''
+        SQL select on a pooled read-only connection, which yields lists of
+        up to @batch_size rows. The connection is held until exhausted.
+        '''
+        query = re.sub(r"\n?\s+", " ", cmd)
+        with self.readers.connection() as conn:
+            cur = conn.execute(query, params)
+            try:
+                while True:
+                    with _timer(query) as timer:
+                        rows = cur.fetchmany(batch_size)
+                        timer.count("sql_rows", len(rows))
+                    if len(rows) == 0:
+                        return
+                    yield rows
+            finally:
+                cur.close()
+
+    def get_version(self) -> int:
+        '''Get schema version'''
+        return self.fetch("PRAGMA user_version;")[0][0]
+
+    def migrate(self, migrations: list) -> int:
+        '''
+        Upgrade schema: @migrations[n] is a function of the connection which
+        upgrades version n to n+1. Pending migrations run in one transaction.
+        Return schema version
+        '''
+        if self.get_version() >= len(migrations):
+            return self.get_version()
+        with self.transaction() as db:
+            version = db.execute("PRAGMA user_version;").fetchone()[0]
+            for migration in migrations[version:]:
+                migration(db)
+            version = max(version, len(migrations))
+            db.execute(f"PRAGMA user_version = {version};")
+        return version
+
+    def fetch(self, cmd: str, params: tuple | dict = ()) -> list:
+        '''Thread-safe SQL select which returns all rows'''
+        query = re.sub(r"\n?\s+", " ", cmd)
+        with self.lock, _timer(query) as timer:
+            rows = self.db.execute(query, params).fetchall()
+            timer.count("sql_rows", len(rows))
+            return rows
+
+    def add_column(self, tablename: str, column: str, dtype: str,
+                   opts: str = ""):
+        '''Add new column into sql'''
+        query = f"""
+            ALTER TABLE {tablename} ADD {column} {dtype} {opts};
+            """
+        self.exe(query)
+
+    def add_index(self, tablename: str, column: str):
+        '''Create index on @column if it does not exist'''
+        query = f"""
+            CREATE INDEX IF NOT EXISTS idx_{tablename}_{column}
+            ON {tablename} ({column});
+            """
+        self.exe(query)
+
+    def get_default_tablename(self) -> str:
+        '''Get default tablename'''
+        return "contents"
+
+    def get_columns(self, tablename: str) -> list:
+        '''Get all column in specified @tablename'''
+        query = f"PRAGMA table_info({tablename});"
+        return [row[1] for row in self.fetch(query)]
@@ -0,0 +1,241 @@
+'''
+Bulk data loader subsystem
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from lib.error import GeneralException
+from lib.log import SystemLog
+from lib.archive import read as read_archived, split_reference
+from plugins.general import ARCHIVE_COLUMNS
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DEFAULT_WORKERS = 8
+DEFAULT_DELIMITER = ","
+# files are read sequentially in blocks of this size
+READ_SIZE = 1024 * 1024
+LOAD_COLUMNS = ["path", "epoch"] + ARCHIVE_COLUMNS
+
+
+def read_table(path: str, member: None | tuple = None,
+               options: None | dict = None):
+    '''
+    Parse delimited file @path into a 2-D array, one row per line
+     @member: (offset, size, method) of an archived @path
+     @options: delimiter, header, skiprows, comments, usecols, dtype
+    Return (column names or None, array)
+    '''
+    options = options or {}
+    delimiter = options.get("delimiter", DEFAULT_DELIMITER)
+    if split_reference(path) is not None:
+        f = io.BytesIO(read_archived(path, member))
+    else:
+        f = open(path, "rb", buffering=READ_SIZE)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    with f:
+        names = None
+        if options.get("header"):
+            line = f.readline().decode("utf-8").strip()
+            names = [name.strip() for name in line.split(delimiter)]
+        if not _at_end(f):
+            values = np.loadtxt(f, dtype=options.get("dtype", "float64"),
+                                delimiter=delimiter,
+                                comments=options.get("comments", "#"),
+                                skiprows=options.get("skiprows", 0),
+                                usecols=options.get("usecols"), ndmin=2)
+        else:
+            values = np.empty((0, 0), dtype=options.get("dtype", "float64"))
+    if names is not None and options.get("usecols") is not None:
+        names = [names[idx] for idx in options["usecols"]]
+    return names, values
+
+
+def _at_end(f) -> bool:
+    '''Helper function: nothing is left to read in @f'''
+    if isinstance(f, io.BytesIO):
+        return f.tell() >= len(f.getbuffer())
+    return len(f.peek(1)) == 0
+
+
+def _read_job(job: tuple) -> tuple:
+    '''Helper function: (names, array, error) of one (path, member, options)'''
+    path, member, options = job
+    try:
+        names, values = read_table(path, member, options)
+    except (OSError, ValueError, GeneralException) as err:
+        return None, None, str(err)
+    return names, values, None
+
+
+class Frame:
+    '''
+    Delimited content of loaded files, concatenated in datetime order
+
+     paths: loaded files in (datetime, id) order
+     epochs: int64 datetime (epoch) of each file
+     offsets: int64, rows of file i are offsets[i]:offsets[i + 1]
+     values: 2-D array of all rows
+     columns: column names of the header, None without header
+     skipped: (path, reason) of files which could not be loaded
+    '''
+    def __init__(self, paths: list, epochs, offsets, values,
+                 columns: None | list = None, skipped: None | list = None):
+        self.paths = paths
+        self.epochs = epochs
+        self.offsets = offsets
+        self.values = values
+        self.columns = columns
+        self.skipped = skipped or []
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    @property
+    def counts(self):
+        '''Number of rows of each file'''
+        return np.diff(self.offsets)
+
+    @property
+    def datetime(self):
+        '''int64 datetime (epoch) of the file of each row'''
+        return np.repeat(self.epochs, self.counts)
+
+    @property
+    def file(self):
+        '''Index into paths of the file of each row'''
+        return np.repeat(np.arange(len(self.paths)), self.counts)
+
+    def split(self):
+        '''Yield (path, epoch, rows) of each file'''
+        for idx, path in enumerate(self.paths):
+            yield path, int(self.epochs[idx]), \
+                self.values[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def to_records(self):
+        '''Structured array: datetime64[s] "datetime" and a field per column'''
+        names = self.columns or [f"c{idx}"
+                                 for idx in range(self.values.shape[1])]
+        dtype = [("datetime", "datetime64[s]")] + \
+            [(name, self.values.dtype) for name in names]
+        records = np.empty(len(self.values), dtype=dtype)
+        records["datetime"] = self.datetime.astype("datetime64[s]")
+        for idx, name in enumerate(names):
+            records[name] = self.values[:, idx]
+        return records
+
+
+class BulkLoader:
+    '''
+    Load delimited files of a rule (CSV, txt) into one NumPy array
+
+    Files are given by a search query or by result rows and loaded in
+    (datetime, id) order. Each file is read sequentially in large blocks
+    (archived members with one seek) and parsed by numpy.loadtxt in
+    @workers threads, or processes with @processes. Files whose column
+    count differs from the first loaded file are skipped.
+     @options: delimiter (default ","), header (first line has column
+               names), skiprows, comments, usecols, dtype (default float64)
+    '''
+    def __init__(self, db, workers: int = DEFAULT_WORKERS,
+                 processes: bool = False, **options):
+        if np is None:
+            raise GeneralException(
+                "[BulkLoader] numpy is needed for bulk loading")
+        self.db = db
+        self.workers = max(1, workers)
+        self.processes = processes
+        self.options = options
+        self.log = SystemLog("BulkLoader")
+
+    def _files(self, rulename: str, meta: None | dict,
+               rows: None | list) -> list:
+        '''Helper function: (path, epoch, member) of files to load'''
+        if not self.db.load_module(rulename):
+            raise GeneralException(f"[BulkLoader] unknown rule: {rulename}")
+        cache = self.db.groups[rulename]["db"]
+        if rows is None:
+            meta = dict(meta or {}, parameter=LOAD_COLUMNS)
+            return [(path, epoch,
+                     tuple(member) if member[0] is not None else None)
+                    for path, epoch, *member in
+                    self.db.iter_search(rulename, meta)]
+
+        # search rows start with the id (default parameter, "id") or the
+        # path (parameter "path"), both are looked up in one query
+        ids, paths = [], []
+        for row in rows:
+            key = row if isinstance(row, str) else \
+                row[0] if isinstance(row, (list, tuple)) and \
+                len(row) > 0 else None
+            if isinstance(key, str):
+                paths.append(key)
+            elif isinstance(key, int) and not isinstance(key, bool):
+                ids.append(key)
+            else:
+                raise GeneralException(
+                    f"[BulkLoader] rows must be paths or search rows "
+                    f"starting with id or path, got {row!r}")
+        files = []
+        for keys, column in [(ids, "id"), (paths, "path")]:
+            found = cache.find_files(keys, column) if len(keys) > 0 else {}
+            for key in keys:
+                if key not in found:
+                    raise GeneralException(
+                        f"[BulkLoader] {key} is no file of rule {rulename}")
+                files.append(found[key])
+        files.sort(key=lambda ele: ele[1])
+        return files
+
+    def load(self, rulename: str, meta: None | dict = None,
+             rows: None | list = None) -> Frame:
+        '''
+        Load files of @rulename matching search @meta, or the files of
+        @rows (paths, or search rows whose first value is the id or path)
+        '''
+        files = self._files(rulename, meta, rows)
+        jobs = [(path, member, self.options) for path, _, member in files]
+        executor = ProcessPoolExecutor if self.processes and \
+            len(jobs) > 1 else ThreadPoolExecutor
+        with executor(min(self.workers, max(1, len(jobs)))) as pool:
+            results = list(pool.map(_read_job, jobs,
+                                    chunksize=max(1, len(jobs) //
+                                                  (self.workers * 4))))
+
+        paths, epochs, parts, skipped = [], [], [], []
+        columns = None
+        width = None
+        for (path, epoch, _), (names, values, error) in zip(files, results):
+            if error is None and len(values) > 0:
+                if width is None:
+                    width = values.shape[1]
+                    columns = names
+                elif values.shape[1] != width:
+                    error = f"{values.shape[1]} columns, expected {width}"
+            if error is not None:
+                self.log.warn(f"skip {path}: {error}")
+                skipped.append((path, error))
+                continue
+            paths.append(path)
+            epochs.append(epoch)
+            parts.append(values)
+
+        counts = [len(values) for values in parts]
+        offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        parts = [values for values in parts if len(values) > 0]
+        if len(parts) > 0:
+            values = np.concatenate(parts)
+        else:
+            values = np.empty((0, width or 0),
+                              dtype=self.options.get("dtype", "float64"))
+        return Frame(paths, np.array(epochs, dtype=np.int64), offsets,
+                     values, columns, skipped)
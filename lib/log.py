@@ -1,64 +1,339 @@
-'''
-Log system for File Database
-
-Author: Weiru Chen <flamingm321@gmail.com>
-Date: 2024-01-21
-'''
-
-
-import datetime
-from enum import Enum
-
-TIMEFORMAT = "%Y-%m-%d %H:%M:%S"
-
-
-# Base on system time zone
-def _get_current_time():
-    return datetime.datetime.now()
-
-
-class LogLevel(Enum):
-    '''
-    Log level
-        INFO = 1
-        WARN = 2
-        DEBUG = 3
-        ERROR = 4
-    '''
-    INFO = 1
-    WARN = 2
-    DEBUG = 3
-    ERROR = 4
-
-    def to_str(self):
-        '''convert log level into string'''
-        return self.name
-
-
-class SystemLog:
-    '''SystemLog class'''
-    def __init__(self, title: str, show: bool = False) -> None:
-        self.title = title
-        self.show = show
-
-    def _print(self, level: LogLevel, msg):
-        if not self.show:
-            return
-        time = _get_current_time().strftime(TIMEFORMAT)
-        print(f"{time} - [{level.name}] [{self.title}] {str(msg)}")
-
-    def info(self, msg: str):
-        '''log info message'''
-        self._print(LogLevel.INFO, msg)
-
-    def warn(self, msg: str):
-        '''log warning message'''
-        self._print(LogLevel.WARN, msg)
-
-    def debug(self, msg: str):
-        '''log debug message'''
-        self._print(LogLevel.DEBUG, msg)
-
-    def error(self, msg: str):
-        '''log error message'''
-        self._print(LogLevel.ERROR, msg)
+'''
+Log system for File Database
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+
+import os
+import re
+import sys
+import json
+import time
+import queue
+import atexit
+import datetime
+import threading
+from enum import Enum
+
+TIMEFORMAT = "%Y-%m-%d %H:%M:%S"
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUPS = 5
+# At most BURST similar warnings per WINDOW seconds, the rest are counted
+DEFAULT_BURST = 10
+DEFAULT_WINDOW = 10.0
+
+
+# Base on system time zone
+def _get_current_time():
+    return datetime.datetime.now()
+
+
+class LogLevel(Enum):
+    '''
+    Log level
+        INFO = 1
+        WARN = 2
+        DEBUG = 3
+        ERROR = 4
+    '''
+    INFO = 1
+    WARN = 2
+    DEBUG = 3
+    ERROR = 4
+
+    def to_str(self):
+        '''convert log level into string'''
+        return self.name
+
+    @property
+    def severity(self) -> int:
+        '''Order of levels: DEBUG < INFO < WARN < ERROR'''
+        return SEVERITY[self]
+
+    @staticmethod
+    def get(name: str | int):
+        '''Retrieve log level from config name ("info", "warning", ...)'''
+        if isinstance(name, LogLevel):
+            return name
+        name = str(name).upper()
+        return LogLevel["WARN" if name == "WARNING" else name]
+
+
+SEVERITY = {LogLevel.DEBUG: 10, LogLevel.INFO: 20, LogLevel.WARN: 30,
+            LogLevel.ERROR: 40}
+
+
+class RotatingFile:
+    '''Append-only log file rotated to @path.1 .. @path.@backups'''
+    def __init__(self, path: str, max_bytes: int = DEFAULT_MAX_BYTES,
+                 backups: int = DEFAULT_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        self.f = open(path, "a", encoding="utf-8")
+        self.size = self.f.tell()
+
+    def write(self, line: str):
+        data = line + "\n"
+        size = len(data.encode("utf-8"))
+        if self.max_bytes > 0 and self.size > 0 and \
+           self.size + size > self.max_bytes:
+            self.rotate()
+        self.f.write(data)
+        self.size += size
+
+    def rotate(self):
+        '''Shift backups and start a new file'''
+        self.f.close()
+        for idx in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{idx}"):
+                os.replace(f"{self.path}.{idx}", f"{self.path}.{idx + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.f = open(self.path, "a", encoding="utf-8")
+        self.size = 0
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class LogWriter(threading.Thread):
+    '''
+    Background writer of all SystemLog records
+
+    Callers only put (time, level, title, message, show) into a bounded
+    queue; formatting, console and file output happen in this thread. When
+    the queue is full records are dropped and counted. Repeated warnings
+    of one logger (same exception type, or same text with paths and
+    numbers masked) are limited to @burst per @window seconds, and a
+    summary of the suppressed ones is written when the window ends.
+    '''
+    def __init__(self, queue_size: int = DEFAULT_QUEUE_SIZE):
+        super().__init__(name="FileDB-log", daemon=True)
+        self.queue = queue.Queue(queue_size)
+        self.file = None
+        self.json = False
+        self.burst = DEFAULT_BURST
+        self.window = DEFAULT_WINDOW
+        self.windows = {}       # key -> [start, count, suppressed, record]
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def put(self, record: tuple):
+        '''Queue @record without blocking'''
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def flush(self):
+        '''Wait until every queued record is written'''
+        self.queue.join()
+        if self.file is not None:
+            self.file.flush()
+
+    def run(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=self.window or None)
+            except queue.Empty:
+                self._sweep(time.time())
+                continue
+            try:
+                if record is None:
+                    self._sweep(None)
+                    return
+                if self._allow(record):
+                    self._emit(record)
+                if self.queue.empty():
+                    if self.file is not None:
+                        self.file.flush()
+                    sys.stdout.flush()
+            except Exception as err:
+                print(f"log writer failed: {err}", file=sys.stderr)
+            finally:
+                self.queue.task_done()
+
+    @staticmethod
+    def _key(record: tuple) -> tuple:
+        '''Helper function: similarity key of a warning'''
+        _, level, title, msg, _ = record
+        if isinstance(msg, Exception):
+            return title, level, type(msg).__name__
+        text = re.sub(r"\S*[/\\]\S*|\d+", "*", str(msg))
+        return title, level, text
+
+    def _allow(self, record: tuple) -> bool:
+        '''Helper function: rate limit repeated warnings'''
+        if record[1] != LogLevel.WARN or self.burst <= 0:
+            return True
+        key = self._key(record)
+        entry = self.windows.get(key)
+        if entry is None or record[0] - entry[0] >= self.window:
+            if entry is not None:
+                self._summary(entry)
+            entry = self.windows[key] = [record[0], 0, 0, record]
+        entry[1] += 1
+        if entry[1] <= self.burst:
+            return True
+        entry[2] += 1
+        entry[3] = record
+        return False
+
+    def _sweep(self, now: None | float):
+        '''Helper function: summaries of ended windows (all if @now None)'''
+        for key, entry in list(self.windows.items()):
+            if now is None or now - entry[0] >= self.window:
+                self._summary(entry)
+                del self.windows[key]
+        with self.lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped > 0:
+            self._emit((time.time(), LogLevel.WARN, "SystemLog",
+                        f"log queue full, dropped {dropped} records", True))
+
+    def _summary(self, entry: list):
+        '''Helper function: record counting suppressed warnings'''
+        if entry[2] == 0:
+            return
+        _, level, title, msg, show = entry[3]
+        kind = type(msg).__name__ if isinstance(msg, Exception) else \
+            "similar"
+        self._emit((time.time(), level, title,
+                    f"suppressed {entry[2]} {kind} messages in "
+                    f"{self.window:g}s, last one: {msg}", show))
+
+    def _emit(self, record: tuple):
+        '''Helper function: write one record'''
+        stamp, level, title, msg, show = record
+        moment = datetime.datetime.fromtimestamp(stamp)
+        text = f"{moment.strftime(TIMEFORMAT)} - [{level.name}] [{title}] " \
+               f"{str(msg)}"
+        if show:
+            print(text)
+        if self.file is None:
+            return
+        if self.json:
+            data = {"time": moment.isoformat(timespec="milliseconds"),
+                    "level": level.name, "logger": title,
+                    "message": str(msg)}
+            if isinstance(msg, Exception):
+                data["type"] = type(msg).__name__
+            text = json.dumps(data, ensure_ascii=False)
+        self.file.write(text)
+
+    def stop(self):
+        '''Write what is queued and stop'''
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class _Settings:
+    '''Process wide log settings'''
+    level = LogLevel.DEBUG
+    writer = None
+    lock = threading.Lock()
+
+
+def _writer() -> LogWriter:
+    '''Helper function: start the background writer once'''
+    if _Settings.writer is None:
+        with _Settings.lock:
+            if _Settings.writer is None:
+                writer = LogWriter()
+                writer.start()
+                _Settings.writer = writer
+                atexit.register(writer.stop)
+    return _Settings.writer
+
+
+def configure(level: None | str | LogLevel = None, file: None | str = None,
+              max_bytes: int = DEFAULT_MAX_BYTES,
+              backups: int = DEFAULT_BACKUPS, json_format: bool = False,
+              burst: int = DEFAULT_BURST, window: float = DEFAULT_WINDOW):
+    '''
+    Configure all SystemLog instances
+     @level: lowest level which is logged, default DEBUG
+     @file: also write records to this rotating file
+     @json_format: write file records as JSON lines
+     @burst / @window: at most @burst similar warnings per @window seconds,
+                       0 burst turns rate limiting off
+    '''
+    writer = _writer()
+    writer.flush()
+    if level is not None:
+        _Settings.level = LogLevel.get(level)
+    if writer.file is not None and (file is None or
+                                    writer.file.path != file):
+        writer.file.close()
+        writer.file = None
+    if file is not None and writer.file is None:
+        writer.file = RotatingFile(file, max_bytes, backups)
+    writer.json = json_format
+    writer.burst = burst
+    writer.window = window
+
+
+def flush():
+    '''Wait until queued records are written'''
+    if _Settings.writer is not None:
+        _Settings.writer.flush()
+
+
+class SystemLog:
+    '''
+    SystemLog class
+
+    Records below the configured level, or with neither console (@show)
+    nor file output, are dropped before any formatting. The rest are
+    written by the background LogWriter.
+    '''
+    def __init__(self, title: str, show: bool = False,
+                 level: None | str | LogLevel = None) -> None:
+        self.title = title
+        self.show = show
+        self.level = None if level is None else LogLevel.get(level)
+
+    def enabled(self, level: LogLevel) -> bool:
+        '''Check records of @level are written'''
+        threshold = self.level or _Settings.level
+        if SEVERITY[level] < SEVERITY[threshold]:
+            return False
+        return self.show or (_Settings.writer is not None and
+                             _Settings.writer.file is not None)
+
+    def _print(self, level: LogLevel, msg):
+        if not self.enabled(level):
+            return
+        _writer().put((time.time(), level, self.title, msg, self.show))
+
+    def info(self, msg: str):
+        '''log info message'''
+        self._print(LogLevel.INFO, msg)
+
+    def warn(self, msg: str):
+        '''log warning message'''
+        self._print(LogLevel.WARN, msg)
+
+    def debug(self, msg: str):
+        '''log debug message'''
+        self._print(LogLevel.DEBUG, msg)
+
+    def error(self, msg: str):
+        '''log error message'''
+        self._print(LogLevel.ERROR, msg)
@@ -0,0 +1,82 @@
+'''
+Parallel merge of sorted streams
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import heapq
+import itertools
+import queue
+import threading
+
+DEFAULT_READ_AHEAD = 4
+DEFAULT_CHUNK_SIZE = 256
+_DONE = object()
+
+
+class _Producer(threading.Thread):
+    '''Consume one iterable in its own thread into a bounded queue'''
+    def __init__(self, iterable, stop: threading.Event, read_ahead: int,
+                 chunk_size: int):
+        super().__init__(name="FileDB-merge", daemon=True)
+        self.iterable = iterable
+        self.stop = stop
+        self.chunk_size = max(1, chunk_size)
+        self.queue = queue.Queue(max(1, read_ahead))
+
+    def _put(self, item) -> bool:
+        '''Helper function: put @item unless the consumer stopped'''
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(self):
+        items = iter(self.iterable)
+        try:
+            while True:
+                chunk = list(itertools.islice(items, self.chunk_size))
+                if len(chunk) == 0 or not self._put(chunk):
+                    break
+        except Exception as err:
+            self._put(err)
+        finally:
+            close = getattr(items, "close", None)
+            if close is not None:
+                close()
+        self._put(_DONE)
+
+    def drain(self):
+        '''Yield items in order, re-raise error of the producer'''
+        while True:
+            chunk = self.queue.get()
+            if chunk is _DONE:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield from chunk
+
+
+def merge_sorted(iterables: list, key=None, reverse: bool = False,
+                 read_ahead: int = DEFAULT_READ_AHEAD,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE):
+    '''
+    Merge sorted @iterables into one sorted stream (see heapq.merge). Each
+    iterable is consumed concurrently in its own thread, at most
+    @read_ahead chunks of @chunk_size items ahead of the consumer.
+    Closing the stream stops and closes all iterables.
+    '''
+    stop = threading.Event()
+    producers = [_Producer(iterable, stop, read_ahead, chunk_size)
+                 for iterable in iterables]
+    for producer in producers:
+        producer.start()
+    try:
+        yield from heapq.merge(*[producer.drain() for producer in producers],
+                               key=key, reverse=reverse)
+    finally:
+        stop.set()
@@ -0,0 +1,264 @@
+'''
+Metrics subsystem
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import os
+import time
+import bisect
+import threading
+
+PREFIX = "filedb"
+DEFAULT_INTERVAL = 15.0
+# Upper bounds (seconds) of latency histogram buckets
+DEFAULT_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Histogram:
+    '''Thread-safe fixed bucket histogram'''
+    __slots__ = ("bounds", "counts", "total", "count", "lock")
+
+    def __init__(self, bounds: tuple = DEFAULT_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        '''Record one @value'''
+        idx = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.total += value
+            self.count += 1
+
+    def quantile(self, q: float) -> None | float:
+        '''Estimated @q quantile, interpolated inside its bucket'''
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            if seen + count >= rank and count > 0:
+                lower = self.bounds[idx - 1] if idx > 0 else 0.0
+                if idx == len(self.bounds):
+                    return lower
+                return lower + (self.bounds[idx] - lower) * \
+                    (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+    def to_dict(self) -> dict:
+        '''Snapshot of the histogram'''
+        with self.lock:
+            return {"count": self.count, "sum": self.total,
+                    "mean": self.total / self.count if self.count else None,
+                    "p50": self.quantile(0.5), "p95": self.quantile(0.95),
+                    "p99": self.quantile(0.99),
+                    "buckets": dict(zip(list(self.bounds) + ["+Inf"],
+                                        self.counts))}
+
+
+class Timer:
+    '''Context manager which observes its duration into a histogram'''
+    __slots__ = ("registry", "name", "labels", "start")
+
+    def __init__(self, registry, name: str, labels: tuple):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.histogram(self.name, self.labels).observe(
+            time.perf_counter() - self.start)
+        return False
+
+    def count(self, name: str, value: int = 1):
+        '''Increase counter @name with the labels of this timer'''
+        self.registry.counter(name, self.labels, value)
+
+
+class _NullTimer:
+    '''Timer used while metrics are disabled, does nothing'''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def count(self, name: str, value: int = 1):
+        '''Do nothing'''
+
+
+NULL = _NullTimer()
+
+
+class Metrics:
+    '''
+    Registry of counters and latency histograms, keyed by name and labels
+
+    While disabled, timer() returns a shared no-op timer and count() returns
+    at once, so instrumented code only pays one attribute check.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def timer(self, name: str, **labels) -> Timer | _NullTimer:
+        '''Time a `with` block into histogram @name'''
+        if not self.enabled:
+            return NULL
+        return Timer(self, name, tuple(sorted(labels.items())))
+
+    def count(self, name: str, value: int = 1, **labels):
+        '''Increase counter @name by @value'''
+        if not self.enabled:
+            return
+        self.counter(name, tuple(sorted(labels.items())), value)
+
+    def counter(self, name: str, labels: tuple, value: int = 1):
+        '''Increase counter (@name, @labels) by @value'''
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def histogram(self, name: str, labels: tuple) -> Histogram:
+        '''Get or create histogram (@name, @labels)'''
+        key = (name, labels)
+        hist = self.histograms.get(key)
+        if hist is None:
+            with self.lock:
+                hist = self.histograms.setdefault(key, Histogram())
+        return hist
+
+    def reset(self):
+        '''Drop all recorded values'''
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def snapshot(self) -> dict:
+        '''
+        Recorded values: {"counters": {name: [{labels, value}]},
+                          "timers": {name: [{labels, count, sum, p50, ...}]}}
+        '''
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = list(self.histograms.items())
+        result = {"counters": {}, "timers": {}}
+        for (name, labels), value in sorted(counters):
+            result["counters"].setdefault(name, []).append(
+                {"labels": dict(labels), "value": value})
+        for (name, labels), hist in sorted(histograms, key=lambda x: x[0]):
+            result["timers"].setdefault(name, []).append(
+                dict(hist.to_dict(), labels=dict(labels)))
+        return result
+
+    def to_prometheus(self) -> str:
+        '''Recorded values in Prometheus text exposition format'''
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda x: x[0])
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            metric = f"{PREFIX}_{name}_total"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{_labels(labels)} {value}")
+        for (name, labels), hist in histograms:
+            metric = f"{PREFIX}_{name}_seconds"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            data = hist.to_dict()
+            cumulative = 0
+            for bound, count in data["buckets"].items():
+                cumulative += count
+                lines.append(f"{metric}_bucket"
+                             f"{_labels(labels + (('le', bound),))} "
+                             f"{cumulative}")
+            lines.append(f"{metric}_sum{_labels(labels)} {data['sum']}")
+            lines.append(f"{metric}_count{_labels(labels)} {data['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        '''Write text exposition to @path atomically (textfile collector)'''
+        tmp = f"{path}.part"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp, path)
+
+
+def _labels(labels: tuple) -> str:
+    '''Helper function: Prometheus label set of @labels'''
+    if len(labels) == 0:
+        return ""
+    items = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        items.append(f'{key}="{value}"')
+    return "{" + ",".join(items) + "}"
+
+
+class PrometheusExporter(threading.Thread):
+    '''Write the metrics of @registry to @path every @interval seconds'''
+    def __init__(self, registry: Metrics, path: str,
+                 interval: float = DEFAULT_INTERVAL):
+        super().__init__(name="FileDB-metrics", daemon=True)
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.registry.write_prometheus(self.path)
+
+    def stop(self):
+        '''Stop and write the last values'''
+        self.stopped.set()
+        self.join()
+        self.registry.write_prometheus(self.path)
+
+
+METRICS = Metrics()
+
+
+def enable(on: bool = True):
+    '''Turn recording of the process wide registry on or off'''
+    METRICS.enabled = on
+
+
+def timer(name: str, **labels) -> Timer | _NullTimer:
+    '''Time a `with` block into histogram @name of the process registry'''
+    if not METRICS.enabled:
+        return NULL
+    return Timer(METRICS, name, tuple(sorted(labels.items())))
+
+
+def count(name: str, value: int = 1, **labels):
+    '''Increase counter @name of the process registry'''
+    if METRICS.enabled:
+        METRICS.counter(name, tuple(sorted(labels.items())), value)
+
+
+def snapshot() -> dict:
+    '''Recorded values of the process registry'''
+    return METRICS.snapshot()
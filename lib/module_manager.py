@@ -1,37 +1,52 @@
-'''
-Module manager subsystem
-
-Author: Weiru Chen <flamingm321@gmail.com>
-Date: 2024-01-21
-'''
-
-import importlib
-import sys
-
-
-class ModuleManager:
-    '''
-    Module Manager use to manage python plugin
-    '''
-    def __init__(self):
-        self.modules = {}
-
-    def is_exist(self, module: str) -> bool:
-        '''Check module loaded or not'''
-        if module in sys.modules:
-            return True
-        return False
-
-    def active(self, module: str):
-        '''Active the module in ~/plugins'''
-        if self.is_exist(module):
-            print("Module `{module}` is already loaded.")
-            return
-        self.modules[module] = importlib.import_module(f".{module}", "plugins")
-
-    def call(self, module: str, func: str, *args, **argv):
-        '''Execute module function with arguments'''
-        try:
-            return self.modules[module].__getattribute__(func)(*args, **argv)
-        except Exception as err:
-            raise err
+'''
+Module manager subsystem
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import importlib
+import sys
+import threading
+
+PACKAGE = "plugins"
+
+
+class ModuleManager:
+    '''
+    Module Manager use to manage python plugin
+
+    Imported plugins are kept in a process wide registry, so every manager
+    (and every FileDB) imports a plugin and looks up its functions once.
+    '''
+    _registry = {}
+    _functions = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self):
+        self.modules = {}
+
+    def is_exist(self, module: str) -> bool:
+        '''Check module loaded or not'''
+        if module in self.modules or module in self._registry:
+            return True
+        return f"{PACKAGE}.{module}" in sys.modules
+
+    def active(self, module: str):
+        '''Active the module in ~/plugins'''
+        if module in self.modules:
+            return
+        with self._registry_lock:
+            if module not in self._registry:
+                self._registry[module] = importlib.import_module(
+                    f".{module}", PACKAGE)
+            self.modules[module] = self._registry[module]
+
+    def call(self, module: str, func: str, *args, **argv):
+        '''Execute module function with arguments'''
+        key = (module, func)
+        function = self._functions.get(key)
+        if function is None:
+            function = getattr(self.modules[module], func)
+            self._functions[key] = function
+        return function(*args, **argv)
@@ -0,0 +1,455 @@
+'''
+Time partitioned cache subsystem
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import os
+import bisect
+import datetime
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from enum import Enum
+from pathlib import Path
+from lib.error import GeneralException
+from lib import libindex
+from plugins.general import to_epoch, DEFAULT_BATCH_SIZE, \
+    DEFAULT_FETCH_SIZE, DEFAULT_PAGE_SIZE, ID_SPAN
+
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_OPEN = 8
+# content hash -> shard index of dedup lookups, beside the shard files
+DIGEST_INDEX = "digests"
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class Partition(Enum):
+    '''
+    Time span of one shard
+        YEAR = 1
+        MONTH = 2
+    '''
+    YEAR = 1
+    MONTH = 2
+
+    @staticmethod
+    def get(name: str):
+        '''Retrieve partition from config name ("year" or "month")'''
+        if isinstance(name, Partition):
+            return name
+        try:
+            return Partition[str(name).upper()]
+        except KeyError as err:
+            raise GeneralException(
+                f"[Partition] unknown partition: {name}") from err
+
+    def ordinal(self, epoch: int) -> int:
+        '''Shard of @epoch, as months since year 0 of its first month'''
+        moment = EPOCH + datetime.timedelta(seconds=epoch)
+        month = moment.year * 12 + moment.month - 1
+        return month - month % 12 if self == Partition.YEAR else month
+
+    def label(self, ordinal: int) -> str:
+        '''Shard file name of @ordinal, "2001" or "2001-01"'''
+        year, month = divmod(ordinal, 12)
+        if self == Partition.YEAR:
+            return f"{year:04d}"
+        return f"{year:04d}-{month + 1:02d}"
+
+    def parse(self, label: str) -> None | int:
+        '''Ordinal of shard file name @label, None if it is not one'''
+        try:
+            if self == Partition.YEAR:
+                return int(label) * 12 if len(label) == 4 else None
+            year, month = label.split("-")
+            if len(year) != 4 or not 1 <= int(month) <= 12:
+                return None
+            return int(year) * 12 + int(month) - 1
+        except ValueError:
+            return None
+
+    def span(self, ordinal: int) -> tuple:
+        '''(first, last) epoch of shard @ordinal'''
+        size = 12 if self == Partition.YEAR else 1
+        year, month = divmod(ordinal, 12)
+        end_year, end_month = divmod(ordinal + size, 12)
+        return (to_epoch(datetime.datetime(year, month + 1, 1)),
+                to_epoch(datetime.datetime(end_year, end_month + 1, 1)) - 1)
+
+
+class PartitionedCache:
+    '''
+    Rule cache split by file datetime into one shard per year or month
+
+    Shards are caches of the rule plugin, created by @factory(cfg, lazy),
+    at `<cache_path without suffix>/<label><suffix>`, e.g.
+    `general/cache/2001.db`. Rows go to the shard of their epoch, and ids
+    of a shard start above ordinal * ID_SPAN, so ids are unique per rule
+    and locate their shard.
+
+    Searches only open the shards overlapping starttime / endtime.
+    search() queries them on @workers threads; iter_search() and page()
+    read them one after another, which keeps (epoch, id) order since
+    shards do not overlap. At most @max_open shards are kept open, the
+    least recently used idle ones are closed.
+
+    Content hashes are also kept in a digest index (`digests<suffix>`
+    beside the shards) of hash -> ordinal, so a dedup lookup only opens
+    the shards which stored the hash instead of every shard.
+    '''
+    def __init__(self, cfg: dict, factory,
+                 partition: str | Partition = Partition.YEAR,
+                 workers: int = DEFAULT_WORKERS,
+                 max_open: int = DEFAULT_MAX_OPEN):
+        if not cfg.get("cache_path"):
+            raise GeneralException(
+                "[PartitionedCache] partitioned rule needs cache_path")
+        self.config = cfg
+        self.factory = factory
+        self.partition = Partition.get(partition)
+        self.workers = max(1, workers)
+        self.max_open = max(1, max_open)
+        cache_path = Path(cfg["cache_path"])
+        self.suffix = cache_path.suffix or ".db"
+        self.folder = cache_path.with_suffix("")
+        self.listeners = []
+
+        # builds rows without opening a database, its inserts come here
+        self.template = factory(cfg, True)
+        self.template.insert_records = self.insert_records
+        self.labels = self.template.labels
+        self.columns = self.template.columns
+
+        self.lock = threading.Lock()
+        self.shards = {}                # ordinal -> shard cache
+        self.opened = OrderedDict()     # ordinals of open shards, LRU first
+        self.users = {}                 # ordinal -> running reads / writes
+        self.ordinals = self._discover()
+        self.pool = None
+        self.digests = None
+        self.digest_lock = threading.Lock()
+
+    def _discover(self) -> list:
+        '''Helper function: sorted ordinals of existing shard files'''
+        folder = Path(self.config["root"], self.folder)
+        ordinals = set()
+        if folder.is_dir():
+            for entry in os.scandir(folder):
+                if not entry.name.endswith(self.suffix):
+                    continue
+                ordinal = self.partition.parse(
+                    entry.name[:-len(self.suffix)])
+                if ordinal is not None:
+                    ordinals.add(ordinal)
+        return sorted(ordinals)
+
+    def _shard(self, ordinal: int):
+        '''Helper function: shard cache of @ordinal, caller holds lock'''
+        shard = self.shards.get(ordinal)
+        if shard is not None:
+            return shard
+        name = f"{self.partition.label(ordinal)}{self.suffix}"
+        shard = self.factory(
+            dict(self.config, cache_path=str(Path(self.folder, name))), True)
+        shard.listeners = self.listeners
+        shard.id_base = ordinal * ID_SPAN
+        self.shards[ordinal] = shard
+        index = bisect.bisect_left(self.ordinals, ordinal)
+        if index == len(self.ordinals) or self.ordinals[index] != ordinal:
+            self.ordinals.insert(index, ordinal)
+        return shard
+
+    @contextmanager
+    def _use(self, ordinal: int):
+        '''Helper function: shard of @ordinal, not closed while in use'''
+        with self.lock:
+            shard = self._shard(ordinal)
+            self.users[ordinal] = self.users.get(ordinal, 0) + 1
+            self.opened[ordinal] = None
+            self.opened.move_to_end(ordinal)
+            self._evict()
+        try:
+            yield shard
+        finally:
+            with self.lock:
+                self.users[ordinal] -= 1
+                self._evict()
+
+    def _evict(self):
+        '''Helper function: close idle shards over max_open, caller locks'''
+        for ordinal in list(self.opened.keys()):
+            if len(self.opened) <= self.max_open:
+                return
+            if self.users.get(ordinal, 0) == 0:
+                del self.opened[ordinal]
+                self.shards[ordinal].close()
+
+    def _select(self, meta: dict, after: None | tuple = None,
+                desc: bool = False) -> list:
+        '''Helper function: ordinals of shards overlapping @meta time range'''
+        start = to_epoch(meta["starttime"]) if "starttime" in meta else None
+        end = to_epoch(meta["endtime"]) if "endtime" in meta else None
+        if after is not None:
+            if desc:
+                end = to_epoch(after[0]) if end is None else \
+                    min(end, to_epoch(after[0]))
+            else:
+                start = to_epoch(after[0]) if start is None else \
+                    max(start, to_epoch(after[0]))
+        with self.lock:
+            ordinals = list(self.ordinals)
+        selected = []
+        for ordinal in ordinals:
+            first, last = self.partition.span(ordinal)
+            if (start is None or last >= start) and \
+               (end is None or first <= end):
+                selected.append(ordinal)
+        return selected[::-1] if desc else selected
+
+    def close(self):
+        '''Close all shards and the digest index'''
+        with self.lock:
+            for shard in self.shards.values():
+                shard.close()
+            self.opened.clear()
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown()
+        with self.digest_lock:
+            if self.digests is not None:
+                self.digests.close()
+                self.digests = None
+
+    def _digest_path(self) -> Path:
+        '''Helper function: file of the digest index'''
+        return Path(self.config["root"], self.folder,
+                    f"{DIGEST_INDEX}{self.suffix}")
+
+    def _digest_index(self) -> libindex.Index:
+        '''Helper function: digest index, created and filled on first use'''
+        with self.digest_lock:
+            if self.digests is None:
+                path = self._digest_path()
+                path.parent.mkdir(parents=True, exist_ok=True)
+                sqlite = dict(self.config.get("sqlite", {}))
+                index = libindex.Index(
+                    path, sqlite,
+                    sqlite.pop("readers", libindex.DEFAULT_READERS))
+                try:
+                    index.migrate([self._migrate_digests])
+                except Exception:
+                    index.close()
+                    raise
+                self.digests = index
+            return self.digests
+
+    def _migrate_digests(self, db):
+        '''Version 1: digest table, filled from the existing shards'''
+        db.execute(f"""CREATE TABLE IF NOT EXISTS {DIGEST_INDEX} (
+                       hash text NOT NULL,
+                       ordinal integer NOT NULL,
+                       PRIMARY KEY (hash, ordinal)) WITHOUT ROWID;""")
+        for ordinal in self._select({}):
+            with self._use(ordinal) as shard:
+                for rows in shard.rows("hash"):
+                    db.executemany(
+                        f"INSERT OR IGNORE INTO {DIGEST_INDEX} "
+                        f"VALUES (?, ?);",
+                        [(row[0], ordinal) for row in rows
+                         if row[0] is not None])
+
+    def cache_files(self) -> list:
+        '''Database files of all shards and the digest index'''
+        root = Path(self.config["root"], self.folder).absolute()
+        with self.lock:
+            ordinals = list(self.ordinals)
+        return [str(Path(root, f"{self.partition.label(ordinal)}"
+                               f"{self.suffix}")) for ordinal in ordinals] + \
+            [str(self._digest_path().absolute())]
+
+    def can_match(self, meta: object) -> bool:
+        '''
+        False if no row can match @meta: labels or columns are missing, or
+        no shard overlaps the requested time range. Shards are not opened.
+        '''
+        rest = {key: value for key, value in meta.items()
+                if key not in ("starttime", "endtime")}
+        if not self.template.can_match(rest):
+            return False
+        if "starttime" not in meta and "endtime" not in meta:
+            return True
+        return len(self._select(meta)) > 0
+
+    def _search_shard(self, ordinal: int, meta: object) -> list:
+        '''Helper function: search of one shard'''
+        with self._use(ordinal) as shard:
+            return shard.search(meta)
+
+    def search(self, meta: object) -> list:
+        '''search specified file by @meta data in the overlapping shards'''
+        ordinals = self._select(meta)
+        if len(ordinals) == 1:
+            return self._search_shard(ordinals[0], meta)
+        if len(ordinals) == 0:
+            return []
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(self.workers, "FileDB-shard")
+            pool = self.pool
+        results = pool.map(lambda ordinal: self._search_shard(ordinal, meta),
+                           ordinals)
+        return [row for rows in results for row in rows]
+
+    def iter_search(self, meta: object, batch_size: int = DEFAULT_FETCH_SIZE,
+                    after: None | tuple = None, limit: None | int = None,
+                    order: str = "asc", cursor: None | list = None):
+        '''Same as general.Cache.iter_search, shard after shard'''
+        desc = order.lower() == "desc"
+        for ordinal in self._select(meta, after, desc):
+            if limit is not None and limit <= 0:
+                return
+            with self._use(ordinal) as shard:
+                for row in shard.iter_search(meta, batch_size, after, limit,
+                                             order, cursor):
+                    if limit is not None:
+                        limit -= 1
+                    yield row
+
+    def page(self, meta: object, after: None | tuple = None,
+             limit: int = DEFAULT_PAGE_SIZE, order: str = "asc") -> tuple:
+        '''
+        One page of search result
+        Return (rows, cursor of next page or None if no more rows)
+        '''
+        cursor = []
+        rows = list(self.iter_search(meta, limit, after, limit, order,
+                                     cursor))
+        if len(rows) < limit:
+            return rows, None
+        return rows, tuple(cursor)
+
+    def find_hash(self, digest: str) -> None | str:
+        '''
+        Path of a stored file whose content hash is @digest, only shards
+        which have the hash in the digest index are opened
+        '''
+        with self.lock:
+            known = set(self.ordinals)
+        ordinals = [row[0] for row in self._digest_index().read(
+            f"""SELECT ordinal FROM {DIGEST_INDEX} WHERE hash = ?
+                ORDER BY ordinal DESC;""", (digest,)) if row[0] in known]
+        for ordinal in ordinals:
+            with self._use(ordinal) as shard:
+                path = shard.find_hash(digest)
+            if path is not None:
+                return path
+        return None
+
+    def rows(self, columns: str = "id, path",
+             batch_size: int = DEFAULT_FETCH_SIZE, after: int | dict = 0):
+        '''
+        Yield lists of up to @batch_size rows of @columns of every file
+         @after: only rows whose id is larger, or dict of shard ordinal
+                 (id // ID_SPAN) -> last id
+        '''
+        for ordinal in self._select({}):
+            if isinstance(after, int) and (ordinal + 1) * ID_SPAN <= after:
+                continue
+            with self._use(ordinal) as shard:
+                yield from shard.rows(columns, batch_size, after)
+
+    def max_id(self) -> int:
+        '''Largest id of a row, 0 if empty'''
+        for ordinal in self._select({}, desc=True):
+            with self._use(ordinal) as shard:
+                file_id = shard.max_id()
+            if file_id > 0:
+                return file_id
+        return 0
+
+    def make_record(self, *args, **kwargs) -> tuple:
+        '''Build the row of a file, see the plugin make_record'''
+        return self.template.make_record(*args, **kwargs)
+
+    def insert_records(self, records: list,
+                       batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+        '''Insert rows built by make_record into the shards of their epoch'''
+        groups = {}
+        for record in records:
+            groups.setdefault(self.partition.ordinal(record[4]),
+                              []).append(record)
+        digests = [(record[3], self.partition.ordinal(record[4]))
+                   for record in records if record[3] is not None]
+        if len(digests) > 0:
+            # rows of deleted files may leave stale entries, find_hash
+            # checks the shard anyway
+            self._digest_index().executemany(
+                f"INSERT OR IGNORE INTO {DIGEST_INDEX} VALUES (?, ?);",
+                digests)
+        for ordinal, batch in sorted(groups.items()):
+            with self._use(ordinal) as shard:
+                shard.insert_records(batch, batch_size)
+        return len(records)
+
+    def delete_records(self, ids: list,
+                       batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+        '''Delete rows of @ids and their tags from their shards'''
+        groups = {}
+        for file_id in ids:
+            groups.setdefault(file_id // ID_SPAN, []).append(file_id)
+        with self.lock:
+            known = set(self.ordinals)
+        for ordinal, batch in sorted(groups.items()):
+            if ordinal not in known:
+                continue
+            with self._use(ordinal) as shard:
+                shard.delete_records(batch, batch_size)
+        return len(ids)
+
+    def set_members(self, members: list,
+                    batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+        '''Point rows at archive members, see general.Cache.set_members'''
+        groups = {}
+        for member in members:
+            groups.setdefault(member[0] // ID_SPAN, []).append(member)
+        for ordinal, batch in sorted(groups.items()):
+            with self._use(ordinal) as shard:
+                shard.set_members(batch, batch_size)
+        return len(members)
+
+    def find_member(self, path: str) -> None | tuple:
+        '''(offset, size, method) of archived @path, None if not archived'''
+        for ordinal in self._select({}, desc=True):
+            with self._use(ordinal) as shard:
+                member = shard.find_member(path)
+            if member is not None:
+                return member
+        return None
+
+    def find_files(self, keys: list, column: str = "id",
+                   batch_size: int = DEFAULT_BATCH_SIZE) -> dict:
+        '''Rows of @keys by key, see general.Cache.find_files'''
+        groups = {}
+        if column == "id":
+            for key in keys:
+                groups.setdefault(key // ID_SPAN, []).append(key)
+        files = {}
+        for ordinal in self._select({}, desc=True):
+            batch = groups.get(ordinal, []) if column == "id" else \
+                [key for key in keys if key not in files]
+            if len(batch) == 0:
+                continue
+            with self._use(ordinal) as shard:
+                files.update(shard.find_files(batch, column, batch_size))
+        return files
+
+    def add_cache(self, *args, **kwargs):
+        '''Add file meta data, see the plugin add_cache'''
+        self.template.add_cache(*args, **kwargs)
+
+    def add_cache_many(self, *args, **kwargs) -> int:
+        '''Add meta data of many files, see the plugin add_cache_many'''
+        return self.template.add_cache_many(*args, **kwargs)
@@ -0,0 +1,309 @@
+'''
+Index reconcile subsystem
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from lib.digest import file_digest, DEFAULT_ALGORITHM
+from lib.archive import split_reference
+
+DEFAULT_WORKERS = 16
+STATE_FILE = ".reconcile.json"
+CACHE_SUFFIXES = ("", "-wal", "-shm", "-journal")
+
+
+class Report:
+    '''Consistency of one rule cache with the files under root'''
+    def __init__(self, rulename: str):
+        self.rulename = rulename
+        self.files = 0
+        self.rows = 0
+        self.missing = []       # paths of files on disk without row
+        self.orphaned = []      # (id, path) rows without file
+        self.dirty = set()      # directories of missing files / orphaned rows
+
+    def ok(self) -> bool:
+        '''True if cache and files agree'''
+        return len(self.missing) == 0 and len(self.orphaned) == 0
+
+    def to_dict(self) -> dict:
+        '''Report as JSON compatible dict'''
+        return {"rulename": self.rulename, "files": self.files,
+                "rows": self.rows, "missing": self.missing,
+                "orphaned": [path for _, path in self.orphaned]}
+
+
+class Reconciler:
+    '''
+    Verify or rebuild rule caches from the files under config `root`
+
+    Rule folders are walked by @workers threads with os.scandir, and every
+    file name is mapped back to its rule by the config rules. A file
+    belongs to a rule only if it is stored at the destination the rule
+    computes for it; other files are reported as unknown.
+
+    With incremental runs, directories whose mtime did not change since
+    the last run are not listed again. Rows inserted since then and rows
+    found orphaned last time are checked one by one instead.
+    '''
+    def __init__(self, db, workers: int = DEFAULT_WORKERS,
+                 batch_size: int = 1000):
+        self.db = db
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+        self.root = Path(self.db.config.get()["root"]).absolute()
+        self.unknown = []
+
+    def _rules(self, rulenames: None | list) -> dict:
+        '''Helper function: rulename -> rule of rules with a cache'''
+        rules = self.db.config.get()["rules"]
+        if rulenames is None:
+            rulenames = list(rules.keys())
+        selected = {}
+        for rulename in rulenames:
+            rule = rules.get(rulename)
+            if rule is None or not rule.get("plugin") or \
+               not rule.get("folder") or \
+               not self.db.load_module(rulename):
+                continue
+            selected[rulename] = dict(rule, root=self.db.config.get()["root"])
+        return selected
+
+    def state_path(self) -> Path:
+        '''File of the incremental state'''
+        return Path(self.root, STATE_FILE)
+
+    def load_state(self) -> dict:
+        '''Incremental state of the last run'''
+        try:
+            with open(self.state_path(), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"dirs": {}, "last_id": {}, "orphaned": {}}
+
+    def save_state(self, state: dict):
+        '''Persist incremental state atomically'''
+        tmp = self.state_path().with_suffix(".part")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_path())
+
+    def _list(self, path: str, known: None | list, ignore: set) -> tuple:
+        '''
+        Helper function: one directory in a worker thread
+        Return (path, mtime_ns, files or None if unchanged, subdirs)
+        '''
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return path, None, [], []
+        if known is not None and known[0] == mtime:
+            return path, mtime, None, known[1]
+
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif entry.path not in ignore:
+                        files.append(self._map(entry.path, entry.name))
+        except OSError:
+            return path, None, [], []
+        return path, mtime, files, subdirs
+
+    def _map(self, path: str, name: str) -> tuple:
+        '''
+        Helper function: (path, rulename or None), a file belongs to a rule
+        if add would store a file of this name at @path
+        '''
+        result = self.db.finder.match(name)
+        if result is None or not result.rule.get("plugin"):
+            return path, None
+        dst = result.get_destination(self.root)
+        if dst is None or str(dst) != path:
+            return path, None
+        return path, result.rulename
+
+    def walk(self, tops: list, dirs: dict, ignore: set):
+        '''
+        Walk @tops in parallel, yield (path, mtime_ns, files, subdirs)
+         @dirs: state of unchanged directories, path -> [mtime_ns, subdirs]
+        '''
+        with ThreadPoolExecutor(self.workers, "FileDB-walk") as pool:
+            running = {pool.submit(self._list, top, dirs.get(top), ignore)
+                       for top in tops if os.path.isdir(top)}
+            while running:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, mtime, files, subdirs = future.result()
+                    if mtime is None:
+                        continue
+                    for name in subdirs:
+                        sub = os.path.join(path, name)
+                        running.add(pool.submit(self._list, sub,
+                                                dirs.get(sub), ignore))
+                    yield path, mtime, files, subdirs
+
+    def _rows(self, rulename: str) -> tuple:
+        '''
+        Helper function: rows of the rule cache
+        Return (directory -> {path: id}, container -> [(id, path)] of
+        archived rows)
+        '''
+        cache = self.db.groups[rulename]["db"]
+        rows = {}
+        archived = {}
+        for batch in cache.rows("id, path"):
+            for file_id, path in batch:
+                ref = split_reference(path)
+                if ref is not None:
+                    archived.setdefault(ref[0], []).append((file_id, path))
+                    continue
+                rows.setdefault(os.path.dirname(path), {})[path] = file_id
+        return rows, archived
+
+    def verify(self, rulenames: None | list = None,
+               incremental: bool = False) -> dict:
+        '''
+        Compare rule caches with the files under root
+        Return rulename -> Report, unknown files are in self.unknown
+        '''
+        reports, state = self._verify(self._rules(rulenames), incremental)
+        for report in reports.values():
+            # list these directories again next time
+            for path in report.dirty:
+                state["dirs"].pop(path, None)
+        self.save_state(state)
+        return reports
+
+    def _verify(self, rules: dict, incremental: bool) -> tuple:
+        '''Helper function: (rulename -> Report, new state)'''
+        state = self.load_state() if incremental else \
+            {"dirs": {}, "last_id": {}, "orphaned": {}}
+        ignore = set()
+        for rulename in rules:
+            for path in self.db.groups[rulename]["db"].cache_files():
+                ignore.update(path + suffix for suffix in CACHE_SUFFIXES)
+        tops = sorted({str(Path(self.root, rule["folder"][0]))
+                       for rule in rules.values()})
+
+        reports = {rulename: Report(rulename) for rulename in rules}
+        rows = {}
+        for rulename, report in reports.items():
+            rows[rulename], archived = self._rows(rulename)
+            report.rows = sum(len(ele) for ele in rows[rulename].values())
+            # archived rows are valid as long as their container exists
+            for container, members in archived.items():
+                ignore.add(container)
+                report.rows += len(members)
+                if os.path.isfile(container):
+                    report.files += len(members)
+                else:
+                    report.orphaned.extend(members)
+        self.unknown = []
+        walked = {}
+        unchanged = set()
+        for path, mtime, files, subdirs in self.walk(
+                tops, state["dirs"], ignore):
+            walked[path] = [mtime, subdirs]
+            if files is None:
+                unchanged.add(path)
+                continue
+            found = {rulename: set() for rulename in rules}
+            for file, rulename in files:
+                if rulename not in rules:
+                    if rulename is None:
+                        self.unknown.append(file)
+                    continue
+                found[rulename].add(file)
+                reports[rulename].files += 1
+                if file not in rows[rulename].get(path, {}):
+                    reports[rulename].missing.append(file)
+                    reports[rulename].dirty.add(path)
+            for rulename in rules:
+                for file, file_id in rows[rulename].get(path, {}).items():
+                    if file not in found[rulename]:
+                        reports[rulename].orphaned.append((file_id, file))
+                        reports[rulename].dirty.add(path)
+
+        for rulename, report in reports.items():
+            last_id = state["last_id"].get(rulename, 0)
+            again = {file_id for file_id, _ in
+                     state["orphaned"].get(rulename, [])}
+            for path, files in rows[rulename].items():
+                if path not in walked:
+                    # the directory is gone
+                    report.orphaned.extend(
+                        (file_id, file) for file, file_id in files.items())
+                    continue
+                if path not in unchanged:
+                    continue
+                report.files += len(files)
+                for file, file_id in files.items():
+                    if (file_id > last_id or file_id in again) and \
+                       not os.path.exists(file):
+                        report.orphaned.append((file_id, file))
+                        report.files -= 1
+            state["last_id"][rulename] = max(
+                [last_id] + [file_id for files in rows[rulename].values()
+                             for file_id in files.values()])
+            state["orphaned"][rulename] = report.orphaned
+
+        for path, entry in walked.items():
+            state["dirs"][path] = entry
+        for path in list(state["dirs"].keys()):
+            if path not in walked and any(
+                    path == top or path.startswith(top + os.sep)
+                    for top in tops):
+                del state["dirs"][path]
+        return reports, state
+
+    def _digests(self, rule: dict, files: list) -> dict:
+        '''Helper function: content hash of @files of a dedup rule'''
+        if not rule.get("dedup"):
+            return {}
+        algorithm = rule["dedup"].get("hash", DEFAULT_ALGORITHM)
+        with ThreadPoolExecutor(self.workers, "FileDB-hash") as pool:
+            return dict(zip(files, pool.map(
+                lambda file: file_digest(file, algorithm), files)))
+
+    def repair(self, rulenames: None | list = None,
+               incremental: bool = False, clean: bool = False) -> dict:
+        '''
+        Make rule caches agree with the files under root: insert rows of
+        missing files and delete orphaned rows
+         @clean: delete every row first and rebuild the caches in bulk,
+                 tags of files are lost, archived rows are kept
+        Return rulename -> Report of what was found before repairing
+        '''
+        rules = self._rules(rulenames)
+        if clean:
+            for rulename in rules:
+                cache = self.db.groups[rulename]["db"]
+                ids = [file_id for batch in cache.rows("id, path")
+                       for file_id, path in batch
+                       if split_reference(path) is None]
+                cache.delete_records(ids, self.batch_size)
+            incremental = False
+
+        reports, state = self._verify(rules, incremental)
+        for rulename, report in reports.items():
+            cache = self.db.groups[rulename]["db"]
+            cache.delete_records([file_id for file_id, _ in report.orphaned],
+                                 self.batch_size)
+            step = max(1, self.batch_size)
+            for i in range(0, len(report.missing), step):
+                files = report.missing[i:i + step]
+                cache.add_cache_many(files, rules[rulename], None, step, None,
+                                     self._digests(rules[rulename], files))
+            state["last_id"][rulename] = cache.max_id()
+            state["orphaned"][rulename] = []
+        self.save_state(state)
+        return reports
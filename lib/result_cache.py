@@ -0,0 +1,211 @@
+'''
+Search result cache subsystem
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import bisect
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL = 60.0
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# meta keys which only select rows by their epoch, tags and labels; other
+# keys (e.g. netcdf "coverage") may match rows of any epoch
+EPOCH_KEYS = ("parameter", "labels", "tags", "starttime", "endtime")
+
+
+def _terms(value) -> list:
+    '''Helper function: sorted unique terms of "a,b" or list value'''
+    if isinstance(value, str):
+        value = value.split(',')
+    return sorted({str(ele).strip() for ele in value})
+
+
+def _canonical(value):
+    '''Helper function: @value with tuples as lists, for JSON'''
+    if isinstance(value, dict):
+        return {str(key): _canonical(ele) for key, ele in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(ele) for ele in value]
+    return value
+
+
+def normalize_meta(meta: dict) -> str:
+    '''
+    Canonical text of @meta without its time range, so equivalent queries
+    ("a,b" / ["b", "a"] / {"any": ["a", "b"]} tags, ...) share one key.
+    Meta keys other than those of EPOCH_KEYS are kept as they are.
+    '''
+    norm = {key: _canonical(value) for key, value in meta.items()
+            if key not in EPOCH_KEYS}
+    parameter = meta.get("parameter")
+    if isinstance(parameter, str):
+        parameter = parameter.split(',')
+    if parameter:
+        norm["parameter"] = [str(ele).strip() for ele in parameter]
+
+    labels = {}
+    for label, value in meta.get("labels", {}).items():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        labels[label] = sorted({str(ele) for ele in values})
+    if labels:
+        norm["labels"] = labels
+
+    tags = meta.get("tags")
+    if isinstance(tags, dict):
+        norm["tags"] = {key: _terms(tags[key]) for key in ("any", "all")
+                        if tags.get(key)}
+    elif tags:
+        norm["tags"] = {"any": _terms(tags)}
+    return json.dumps(norm, sort_keys=True, default=str)
+
+
+def _sizeof(rows: list) -> int:
+    '''Helper function: approximate memory of result @rows'''
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row)
+        for value in row:
+            size += sys.getsizeof(value)
+    return size
+
+
+class _Entry:
+    __slots__ = ("rulename", "rows", "start", "end", "expire", "size")
+
+    def __init__(self, rulename: str, rows: list, span: tuple,
+                 expire: float, size: int):
+        self.rulename = rulename
+        self.rows = rows
+        self.start, self.end = span
+        self.expire = expire
+        self.size = size
+
+
+class ResultCache:
+    '''
+    Thread-safe LRU cache of search results
+
+    Entries expire after @ttl seconds and the least recently used ones are
+    evicted above @max_entries or @max_bytes. Each entry records the epoch
+    range (start, end) of its query (None for an open end), and inserted
+    rows only drop the entries of their rule whose range contains them.
+    '''
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 ttl: float = DEFAULT_TTL,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.rules = {}         # rulename -> set of keys
+        self.generations = {}   # rulename -> number of invalidations
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(rulename: str, meta: dict, span: tuple) -> tuple:
+        '''
+        Cache key of a @rulename query @meta over epoch range @span. With
+        meta keys outside EPOCH_KEYS the range is left open, so that any
+        insert of the rule drops the entry.
+        '''
+        if any(key not in EPOCH_KEYS for key in meta):
+            span = (None, None)
+        return (rulename, span, normalize_meta(meta))
+
+    def generation(self, rulename: str) -> int:
+        '''Token to pass to put(), taken before running the query'''
+        with self.lock:
+            return self.generations.get(rulename, 0)
+
+    def get(self, key: tuple) -> None | list:
+        '''Cached rows of @key, or None'''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expire < time.monotonic():
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry.rows
+
+    def put(self, key: tuple, rows: list, generation: int):
+        '''
+        Cache @rows of @key, unless rows of the rule were inserted since
+        @generation was taken (the result may be stale)
+        '''
+        size = _sizeof(rows)
+        if size > self.max_bytes:
+            return
+        rulename, span = key[0], key[1]
+        with self.lock:
+            if self.generations.get(rulename, 0) != generation:
+                return
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = _Entry(rulename, rows, span,
+                                       time.monotonic() + self.ttl, size)
+            self.rules.setdefault(rulename, set()).add(key)
+            self.size += size
+            while len(self.entries) > self.max_entries or \
+                    self.size > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _drop(self, key: tuple):
+        '''Helper function: remove @key, lock must be held'''
+        entry = self.entries.pop(key)
+        self.size -= entry.size
+        keys = self.rules.get(entry.rulename)
+        if keys is not None:
+            keys.discard(key)
+
+    def invalidate(self, rulename: str, epochs: list):
+        '''Drop entries of @rulename whose time range contains @epochs'''
+        epochs = sorted(epochs)
+        if len(epochs) == 0:
+            return
+        with self.lock:
+            self.generations[rulename] = \
+                self.generations.get(rulename, 0) + 1
+            for key in list(self.rules.get(rulename, ())):
+                entry = self.entries[key]
+                lower = 0 if entry.start is None else \
+                    bisect.bisect_left(epochs, entry.start)
+                upper = len(epochs) if entry.end is None else \
+                    bisect.bisect_right(epochs, entry.end)
+                if lower < upper:
+                    self._drop(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        '''Drop all entries'''
+        with self.lock:
+            for rulename in self.rules:
+                self.generations[rulename] = \
+                    self.generations.get(rulename, 0) + 1
+            self.entries.clear()
+            self.rules.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        '''Counters and size of the cache'''
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions,
+                    "invalidations": self.invalidations,
+                    "entries": len(self.entries), "bytes": self.size}
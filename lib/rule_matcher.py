@@ -0,0 +1,200 @@
+'''
+Rule matching engine
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import re
+from pathlib import Path
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # python < 3.11
+    import sre_parse
+
+
+def _literal_prefix(parsed) -> str:
+    '''Literal text which every match must start with'''
+    prefix = []
+    for op, av in parsed:
+        if op is not sre_parse.LITERAL:
+            break
+        prefix.append(chr(av))
+    return ''.join(prefix)
+
+
+def _subpattern_branches(av) -> None | set:
+    '''Literal alternatives of a group, None if the group changes flags'''
+    _, add_flags, del_flags, parsed = av
+    if add_flags or del_flags:
+        return None
+    return _literal_branches(parsed)
+
+
+def _literal_branches(parsed) -> None | set:
+    '''Literal alternatives of a pure literal (sub)pattern, else None'''
+    items = list(parsed)
+    if len(items) == 1 and items[0][0] is sre_parse.BRANCH:
+        alts = set()
+        for branch in items[0][1][1]:
+            sub = _literal_branches(branch)
+            if sub is None:
+                return None
+            alts |= sub
+        return alts
+    if len(items) == 1 and items[0][0] is sre_parse.SUBPATTERN:
+        return _subpattern_branches(items[0][1])
+    text = []
+    for op, av in items:
+        if op is not sre_parse.LITERAL:
+            return None
+        text.append(chr(av))
+    return {''.join(text)}
+
+
+def _literal_tail(parsed) -> tuple:
+    '''
+    Literal alternatives which every match must end with
+    Return (alternatives or None, anchored at end of string)
+    '''
+    items = list(parsed)
+    anchored = False
+    if items and items[-1][0] is sre_parse.AT and \
+       items[-1][1] in (sre_parse.AT_END, sre_parse.AT_END_STRING):
+        anchored = True
+        items.pop()
+
+    tails = {''}
+    while items:
+        op, av = items[-1]
+        if op is sre_parse.LITERAL:
+            alts = {chr(av)}
+        elif op is sre_parse.SUBPATTERN:
+            alts = _subpattern_branches(av)
+        else:
+            alts = None
+        if alts is None or '' in alts:
+            break
+        tails = {alt + tail for alt in alts for tail in tails}
+        items.pop()
+
+    if tails == {''}:
+        return None, anchored
+    return tails, anchored
+
+
+class RuleMatch:
+    '''Result of matching a filepath against one rule'''
+    def __init__(self, rulename: str, rule: dict, match: re.Match,
+                 file: Path):
+        self.rulename = rulename
+        self.rule = rule
+        self.match = match
+        self.file = file
+
+    def get_destination(self, root: str | Path) -> None | Path:
+        '''Generate destination path of the matched file under @root'''
+        if self.rule["folder"] is None:
+            return None
+        folders = [self.rule["folder"][0]]
+        folders.extend(
+            [self.match.group(key) for key in self.rule["folder"][1:]]
+        )
+        return Path(root, *folders, self.file.name)
+
+
+class RuleMatcher:
+    '''
+    Precompiled matcher over all rules of a config
+
+    Every rule `format` is compiled once and matched against file names
+    only, so destination, row and reconcile see the same match. Literal
+    prefixes and literal tails (e.g. `(txt|csv)` suffixes) are indexed so
+    only the rules which can possibly match are tried with the full
+    regex, in config order.
+    '''
+    def __init__(self, rules: dict):
+        self.rules = []
+        self.patterns = []
+        self.prefixes = {}      # length -> {prefix: [rule ids]}
+        self.suffixes = {}      # length -> {suffix: [rule ids]}
+        self.contains = {}      # literal -> [rule ids]
+        self.required = []      # rule id -> number of index hints
+        self.fallback = []      # rule ids without any index hint
+
+        for rulename, rule in rules.items():
+            if "format" not in rule:
+                continue
+            idx = len(self.rules)
+            self.rules.append((rulename, rule))
+            self.patterns.append(re.compile(rule["format"]))
+            self.required.append(self._index(idx, rule["format"]))
+            if self.required[idx] == 0:
+                self.fallback.append(idx)
+
+    def _index(self, idx: int, pattern: str) -> int:
+        '''Helper function: register index hints of rule @idx'''
+        try:
+            parsed = sre_parse.parse(pattern)
+        except re.error:
+            return 0
+        if parsed.state.flags & (re.IGNORECASE | re.MULTILINE):
+            return 0
+
+        hints = 0
+        prefix = _literal_prefix(parsed)
+        if prefix:
+            self.prefixes.setdefault(len(prefix), {})\
+                .setdefault(prefix, []).append(idx)
+            hints += 1
+
+        tails, anchored = _literal_tail(parsed)
+        if tails is not None:
+            for tail in tails:
+                if anchored:
+                    self.suffixes.setdefault(len(tail), {})\
+                        .setdefault(tail, []).append(idx)
+                else:
+                    self.contains.setdefault(tail, []).append(idx)
+            hints += 1
+        return hints
+
+    def candidates(self, filepath: str) -> list:
+        '''Rule ids which may match @filepath, in config order'''
+        hits = {}
+        for length, table in self.prefixes.items():
+            for idx in table.get(filepath[:length], ()):
+                hits[idx] = hits.get(idx, 0) + 1
+
+        # `$` also matches right before a trailing newline
+        tail = filepath[:-1] if filepath.endswith('\n') else filepath
+        found = set()
+        for length, table in self.suffixes.items():
+            for text in {filepath[-length:], tail[-length:]}:
+                found.update(table.get(text, ()))
+        for text, ids in self.contains.items():
+            if text in filepath:
+                found.update(ids)
+        for idx in found:
+            hits[idx] = hits.get(idx, 0) + 1
+
+        ids = [idx for idx, count in hits.items()
+               if count == self.required[idx]]
+        ids.extend(self.fallback)
+        ids.sort()
+        return ids
+
+    def match(self, filepath: str) -> None | RuleMatch:
+        '''
+        Find the first rule whose format matches the file name of
+        @filepath, directories of @filepath are never matched
+        '''
+        filepath = str(filepath)
+        name = Path(filepath).name
+        for idx in self.candidates(name):
+            re_match = self.patterns[idx].match(name)
+            if re_match is not None:
+                rulename, rule = self.rules[idx]
+                return RuleMatch(rulename, rule, re_match, Path(filepath))
+        return None
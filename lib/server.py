@@ -0,0 +1,492 @@
+'''
+FileDB server subsystem
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import os
+import json
+import contextlib
+import time
+import queue
+import socket
+import struct
+import tempfile
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from lib import error
+from lib.error import GeneralException
+from lib.log import SystemLog
+from lib.ingest import AddStatus, DEFAULT_WORKERS
+from lib.common import DEFAULT_BATCH_SIZE, DEFAULT_PAGE_SIZE, \
+    DEFAULT_FETCH_SIZE
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(),
+                              f"filedb-{os.getuid()}.sock")
+DEFAULT_READERS = 8
+DEFAULT_BATCH_DELAY = 0.005
+# frame: 4-byte big-endian length of the JSON body
+HEADER = struct.Struct("!I")
+MAX_FRAME = 256 * 1024 * 1024
+READ_METHODS = ("search", "page", "search_all", "ping")
+WRITE_METHODS = ("add", "add_many")
+
+
+def send_frame(sock: socket.socket, message: dict):
+    '''Send @message as one length-prefixed JSON frame'''
+    data = json.dumps(message, separators=(",", ":"),
+                      ensure_ascii=False).encode("utf-8")
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def recv_frame(f) -> None | dict:
+    '''Next frame of buffered socket file @f, None at end of stream'''
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    (size,) = HEADER.unpack(header)
+    if size > MAX_FRAME:
+        raise GeneralException(f"[FileDBServer] frame of {size} bytes")
+    data = f.read(size)
+    if len(data) < size:
+        return None
+    return json.loads(data)
+
+
+class _Connection:
+    '''One client connection, replies of many threads are serialized'''
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.lock = threading.Lock()
+
+    def reply(self, req_id, result=None, err: None | Exception = None):
+        message = {"id": req_id}
+        if err is None:
+            message["result"] = result
+        else:
+            message["error"] = [type(err).__name__, str(err)]
+        try:
+            with self.lock:
+                send_frame(self.sock, message)
+        except (OSError, TypeError, ValueError) as fail:
+            if err is None and not isinstance(fail, OSError):
+                self.reply(req_id, err=fail)
+
+
+class FileDBServer:
+    '''
+    Serve one FileDB to local processes over a Unix-domain socket
+
+    Requests are frames of {"id", "method", "args", "kwargs"} and are
+    answered with {"id", "result"} or {"id", "error": [type, message]} in
+    completion order, so a client can pipeline many requests on one
+    connection. Searches run in a pool of @readers threads on the caches
+    kept open by this process. add / add_many requests of all clients go
+    to one writer thread, which merges the requests queued within
+    @batch_delay seconds (up to @batch_size files) into one FileDB.ingest;
+    add_many requests with their own batch_size are only merged with
+    requests of the same batch_size. Requests which arrive while the
+    server stops are answered with an error.
+    '''
+    def __init__(self, db, path: str = DEFAULT_SOCKET,
+                 readers: int = DEFAULT_READERS,
+                 workers: int = DEFAULT_WORKERS,
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 batch_delay: float = DEFAULT_BATCH_DELAY):
+        self.db = db
+        self.path = path
+        self.workers = workers
+        self.batch_size = max(1, batch_size)
+        self.batch_delay = batch_delay
+        self.readers = ThreadPoolExecutor(readers, "FileDBServer-read")
+        self.writes = queue.Queue()
+        self.writer = None
+        self.sock = None
+        self.clients = set()
+        self.accepting = True
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.log = SystemLog("FileDBServer", True)
+
+    def _listen(self):
+        '''Helper function: bind the socket, replace a stale one'''
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                raise GeneralException(
+                    f"[FileDBServer] {self.path} is served already")
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.remove(self.path)
+            finally:
+                probe.close()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.sock.listen(128)
+        self.sock.settimeout(0.5)
+
+    def serve_forever(self):
+        '''Accept clients until stop() is called'''
+        self._listen()
+        self._serve()
+
+    def start(self) -> threading.Thread:
+        '''Serve in a background thread, return when the socket is ready'''
+        self._listen()
+        thread = threading.Thread(target=self._serve, name="FileDBServer",
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def _serve(self):
+        '''Helper function: accept loop on the bound socket'''
+        self.writer = threading.Thread(target=self._write_loop,
+                                       name="FileDBServer-write", daemon=True)
+        self.writer.start()
+        self.log.info(f"serving on {self.path}")
+        try:
+            while not self.stopped.is_set():
+                try:
+                    client, _ = self.sock.accept()
+                except socket.timeout:
+                    continue
+                client.settimeout(None)
+                threading.Thread(target=self._serve_client, args=(client,),
+                                 name="FileDBServer-client",
+                                 daemon=True).start()
+        finally:
+            self._shutdown()
+
+    def stop(self):
+        '''
+        Stop serving, requests which are received already are answered
+        before the connections are closed
+        '''
+        self.stopped.set()
+
+    def _shutdown(self):
+        '''Helper function: close the sockets after draining requests'''
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        with self.lock:
+            clients = list(self.clients)
+        for sock in clients:
+            # no more requests, answers can still be sent
+            with contextlib.suppress(OSError):
+                sock.shutdown(socket.SHUT_RD)
+        with self.lock:
+            # requests queued before the end marker are still written
+            self.accepting = False
+            self.writes.put(None)
+        if self.writer is not None:
+            self.writer.join()
+        self.readers.shutdown(True)
+        for sock in clients:
+            with contextlib.suppress(OSError):
+                sock.shutdown(socket.SHUT_RDWR)
+            sock.close()
+        self.log.info("stopped")
+
+    def _serve_client(self, sock: socket.socket):
+        '''Helper function: read requests of one client until it leaves'''
+        conn = _Connection(sock)
+        with self.lock:
+            self.clients.add(sock)
+        try:
+            with sock.makefile("rb") as f:
+                while not self.stopped.is_set():
+                    request = recv_frame(f)
+                    if request is None:
+                        break
+                    self._dispatch(conn, request)
+        except (OSError, ValueError, RuntimeError, GeneralException) as err:
+            self.log.warn(f"client dropped: {err}")
+        finally:
+            with self.lock:
+                # closed by _shutdown once pending answers are sent
+                if not self.stopped.is_set():
+                    self.clients.discard(sock)
+                    sock.close()
+
+    def _dispatch(self, conn: _Connection, request: dict):
+        '''Helper function: queue one request'''
+        req_id = request.get("id")
+        method = request.get("method")
+        args = request.get("args", [])
+        kwargs = request.get("kwargs", {})
+        if method in WRITE_METHODS:
+            try:
+                paths, tags, batch_size = self._write_request(method, args,
+                                                              kwargs)
+            except (TypeError, ValueError) as err:
+                conn.reply(req_id, err=err)
+                return
+            with self.lock:
+                if self.accepting:
+                    self.writes.put((conn, req_id, method, paths, tags,
+                                     batch_size or self.batch_size))
+                    return
+            conn.reply(req_id, err=GeneralException(
+                "[FileDBServer] server is stopping"))
+        elif method in READ_METHODS:
+            try:
+                self.readers.submit(self._read, conn, req_id, method, args,
+                                    kwargs)
+            except RuntimeError:
+                # readers are shut down
+                conn.reply(req_id, err=GeneralException(
+                    "[FileDBServer] server is stopping"))
+        else:
+            conn.reply(req_id, err=GeneralException(
+                f"[FileDBServer] unknown method: {method}"))
+
+    @staticmethod
+    def _write_request(method: str, args: list, kwargs: dict) -> tuple:
+        '''
+        Helper function: (paths, path -> tags, batch_size or None) of an
+        add request
+        '''
+        if method == "add":
+            def parse(filepath, tags=None):
+                return [filepath], {filepath: tags}, None
+        else:
+            def parse(filepaths, tags=None, batch_size=None):
+                if batch_size is not None and (
+                        not isinstance(batch_size, int) or batch_size < 1):
+                    raise ValueError(f"batch_size {batch_size!r}")
+                if isinstance(tags, dict):
+                    return list(filepaths), {
+                        path: tags.get(path) for path in filepaths}, \
+                        batch_size
+                return list(filepaths), {path: tags for path in filepaths}, \
+                    batch_size
+        return parse(*args, **kwargs)
+
+    def _read(self, conn: _Connection, req_id, method: str, args: list,
+              kwargs: dict):
+        '''Helper function: run one search request'''
+        try:
+            if method == "ping":
+                result = "pong"
+            elif method == "search_all":
+                result = list(self.db.search_all(*args, **kwargs))
+            else:
+                result = getattr(self.db, method)(*args, **kwargs)
+        except Exception as err:
+            conn.reply(req_id, err=err)
+            return
+        conn.reply(req_id, result)
+
+    def _next_batch(self, carry: list) -> tuple:
+        '''
+        Helper function: write requests of one batch, requests whose
+        files are already in the batch are moved to @carry
+        Return (batch, stop)
+        '''
+        batch = []
+        files = set()
+        deadline = None
+        stop = False
+        while len(files) < self.batch_size:
+            if len(carry) > 0:
+                item = carry.pop(0)
+            elif len(batch) == 0:
+                item = self.writes.get()
+            else:
+                if deadline is None:
+                    deadline = time.monotonic() + self.batch_delay
+                try:
+                    item = self.writes.get(
+                        timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if item is None:
+                stop = True
+                break
+            if files.intersection(item[3]) or \
+               (len(batch) > 0 and item[5] != batch[0][5]):
+                carry.append(item)
+                break
+            files.update(item[3])
+            batch.append(item)
+        return batch, stop
+
+    def _write_loop(self):
+        '''Helper function: merge queued adds into FileDB.ingest calls'''
+        carry = []
+        stop = False
+        while not stop or len(carry) > 0:
+            batch, stop = self._next_batch(carry)
+            if len(batch) == 0:
+                continue
+            paths = [path for item in batch for path in item[3]]
+            tags = {path: item[4][path] for item in batch for path in item[3]}
+            try:
+                report = self.db.ingest(paths, tags, self.workers,
+                                        batch_size=batch[0][5])
+            except Exception as err:
+                self.log.error(f"ingest of {len(paths)} files failed: {err}")
+                for conn, req_id, *_ in batch:
+                    conn.reply(req_id, err=err)
+                continue
+            for conn, req_id, method, files, *_ in batch:
+                statuses = {path: None if report.get(path) is None
+                            else report[path].name for path in files}
+                conn.reply(req_id, statuses[files[0]] if method == "add"
+                           else statuses)
+
+
+def _status(name: None | str) -> None | AddStatus:
+    '''Helper function: AddStatus of its name'''
+    return None if name is None else AddStatus[name]
+
+
+class FileDBClient:
+    '''
+    Client of FileDBServer with the method signatures of FileDB
+
+    One connection is shared by all threads of the process: requests are
+    sent without waiting for earlier answers and answers are matched by
+    request id. submit() returns a Future to pipeline requests from one
+    thread.
+    '''
+    def __init__(self, path: str = DEFAULT_SOCKET,
+                 timeout: None | float = None):
+        self.path = path
+        self.timeout = timeout
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.pending = {}
+        self.closed = False
+        self.reader = threading.Thread(target=self._read_loop,
+                                       name="FileDBClient-read", daemon=True)
+        self.reader.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _read_loop(self):
+        '''Helper function: resolve futures of answered requests'''
+        err = None
+        try:
+            with self.sock.makefile("rb") as f:
+                while True:
+                    message = recv_frame(f)
+                    if message is None:
+                        break
+                    future = self.pending.pop(message.get("id"), None)
+                    if future is None:
+                        continue
+                    if "error" in message:
+                        kind, text = message["error"]
+                        cls = getattr(error, kind, None)
+                        if not isinstance(cls, type) or \
+                           not issubclass(cls, Exception):
+                            cls = GeneralException
+                            text = f"[{kind}] {text}"
+                        future.set_exception(cls(text))
+                    else:
+                        future.set_result(message.get("result"))
+        except (OSError, ValueError, GeneralException) as fail:
+            err = fail
+        with self.lock:
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(GeneralException(
+                f"[FileDBClient] connection closed: {err or 'end of stream'}"))
+
+    def submit(self, method: str, *args, **kwargs) -> Future:
+        '''Send one request, return the Future of its raw result'''
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise GeneralException("[FileDBClient] connection closed")
+            req_id = next(self.ids)
+            self.pending[req_id] = future
+            try:
+                send_frame(self.sock, {"id": req_id, "method": method,
+                                       "args": args, "kwargs": kwargs})
+            except (OSError, TypeError, ValueError):
+                del self.pending[req_id]
+                raise
+        return future
+
+    def _call(self, method: str, *args, **kwargs):
+        '''Helper function: send one request and wait for its result'''
+        return self.submit(method, *args, **kwargs).result(self.timeout)
+
+    def ping(self) -> str:
+        '''"pong" if the server answers'''
+        return self._call("ping")
+
+    def add(self, filepath: str, tags: None | list = None) -> AddStatus:
+        '''Adding file into database, see FileDB.add'''
+        return _status(self._call("add", str(filepath), tags))
+
+    def add_many(self, filepaths: list, tags: None | list | dict = None,
+                 batch_size: int = DEFAULT_BATCH_SIZE) -> dict:
+        '''Adding many files into database, see FileDB.add_many'''
+        report = self._call("add_many", [str(path) for path in filepaths],
+                            tags, batch_size)
+        return {path: _status(name) for path, name in report.items()}
+
+    def search(self, rulename: str, meta: dict) -> list:
+        '''Search files with @rulename and @meta data'''
+        return [tuple(row) for row in self._call("search", rulename, meta)]
+
+    def page(self, rulename: str, meta: dict, after: None | tuple = None,
+             limit: int = DEFAULT_PAGE_SIZE, order: str = "asc") -> tuple:
+        '''One page of search result, see FileDB.page'''
+        rows, cursor = self._call("page", rulename, meta, after, limit, order)
+        return [tuple(row) for row in rows], \
+            None if cursor is None else tuple(cursor)
+
+    def iter_search(self, rulename: str, meta: dict,
+                    batch_size: int = DEFAULT_FETCH_SIZE,
+                    after: None | tuple = None, limit: None | int = None,
+                    order: str = "asc"):
+        '''
+        Search files with @rulename and @meta data, yield rows ordered by
+        datetime, fetched one page of @batch_size rows at a time
+        '''
+        count = 0
+        while limit is None or count < limit:
+            size = batch_size if limit is None else \
+                min(batch_size, limit - count)
+            rows, after = self.page(rulename, meta, after, size, order)
+            yield from rows
+            count += len(rows)
+            if after is None:
+                return
+
+    def search_all(self, meta: dict, limit: None | int = None,
+                   order: str = "asc", source: bool = True,
+                   rulenames: None | list = None,
+                   batch_size: int = DEFAULT_FETCH_SIZE):
+        '''Search @meta in the caches of all rules, see FileDB.search_all'''
+        rows = self._call("search_all", meta, limit, order, source,
+                          rulenames, batch_size)
+        for row in rows:
+            yield (row[0], tuple(row[1])) if source else tuple(row)
+
+    def close(self):
+        '''Close the connection, unanswered requests fail'''
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        if self.reader is not threading.current_thread():
+            self.reader.join()
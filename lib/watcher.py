@@ -0,0 +1,294 @@
+'''
+Inbox watcher subsystem
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import fnmatch
+import threading
+from lib.log import SystemLog
+
+DEFAULT_SETTLE = 1.0
+DEFAULT_DELAY = 0.5
+DEFAULT_INTERVAL = 0.5
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_IGNORE = (".*", "*.part", "*.tmp", "*.swp")
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT = struct.Struct("iIII")
+
+
+class _Inotify:
+    '''Minimal inotify binding through ctypes, Linux only'''
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is Linux only")
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.poll = select.poll()
+        self.poll.register(self.fd, select.POLLIN)
+
+    def add(self, path: str) -> int:
+        '''Watch directory @path, return watch descriptor'''
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                         WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read(self, timeout: float) -> list:
+        '''Events (wd, mask, name) available within @timeout seconds'''
+        if not self.poll.poll(max(0, int(timeout * 1000))):
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            wd, mask, _, size = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + size].rstrip(b"\0")
+            offset += size
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    '''
+    Watch inbox directories and hand new, fully written files to @handler
+
+    With inotify, a file is ready on close-write or when it is moved in;
+    other new files are ready once their size and mtime did not change for
+    @settle seconds. Without inotify, directories are polled every
+    @interval seconds and only those whose mtime changed are listed again.
+    Ready files are coalesced: @handler gets a list of paths @delay seconds
+    after the first one, or as soon as @batch_size files are ready.
+    '''
+    def __init__(self, paths: list, handler, recursive: bool = True,
+                 settle: float = DEFAULT_SETTLE, delay: float = DEFAULT_DELAY,
+                 interval: float = DEFAULT_INTERVAL,
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 ignore: tuple = DEFAULT_IGNORE, backend: str = "auto"):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.handler = handler
+        self.recursive = recursive
+        self.settle = settle
+        self.delay = delay
+        self.interval = interval
+        self.batch_size = max(1, batch_size)
+        self.ignore = ignore
+        self.log = SystemLog("Watcher", True)
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.inotify = None
+        if backend in ("auto", "inotify"):
+            try:
+                self.inotify = _Inotify()
+            except (OSError, AttributeError) as err:
+                if backend == "inotify":
+                    raise
+                self.log.info(f"inotify unavailable, polling: {err}")
+        self.watches = {}       # wd -> directory
+        self.dirs = {}          # directory -> (mtime_ns, set of names)
+        self.pending = {}       # path -> (size, mtime_ns, last change)
+        self.ready = []
+        self.first_ready = None
+
+    def _ignored(self, name: str) -> bool:
+        '''Helper function: @name matches an ignore pattern'''
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.ignore)
+
+    def _add_dir(self, path: str, now: float):
+        '''Helper function: start watching @path and pick up its files'''
+        if path in self.dirs:
+            return
+        if self.inotify is not None:
+            try:
+                self.watches[self.inotify.add(path)] = path
+            except OSError as err:
+                self.log.warn(f"watch {path} failed: {err}")
+                return
+        self.dirs[path] = (None, set())
+        self._scan(path, now)
+
+    def _scan(self, path: str, now: float):
+        '''Helper function: list @path, track entries which are new'''
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            entries = list(os.scandir(path))
+        except OSError:
+            self._drop_dir(path)
+            return
+        _, known = self.dirs[path]
+        names = set()
+        for entry in entries:
+            names.add(entry.name)
+            if entry.name in known or self._ignored(entry.name):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if self.recursive:
+                        self._add_dir(entry.path, now)
+                elif entry.is_file():
+                    self._track(entry.path, now)
+            except OSError:
+                continue
+        self.dirs[path] = (mtime, names)
+
+    def _drop_dir(self, path: str):
+        '''Helper function: forget removed directory @path'''
+        self.dirs.pop(path, None)
+        for wd in [wd for wd, name in self.watches.items() if name == path]:
+            del self.watches[wd]
+
+    def _track(self, path: str, now: float):
+        '''Helper function: wait for @path to be stable'''
+        if path not in self.pending:
+            self.pending[path] = (None, None, now)
+
+    def _mark_ready(self, path: str, now: float):
+        '''Helper function: queue @path for the handler'''
+        self.pending.pop(path, None)
+        self.ready.append(path)
+        if self.first_ready is None:
+            self.first_ready = now
+
+    def _handle_events(self, now: float):
+        '''Helper function: apply inotify events'''
+        timeout = self.interval if len(self.pending) + len(self.ready) == 0 \
+            else min(self.interval, self.delay, self.settle)
+        for wd, mask, name in self.inotify.read(timeout):
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, list every directory again
+                for path in list(self.dirs.keys()):
+                    self._scan(path, now)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                self._drop_dir(directory)
+                continue
+            path = os.path.join(directory, name)
+            _, known = self.dirs[directory]
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                known.discard(name)
+                self.pending.pop(path, None)
+                continue
+            if self._ignored(name):
+                continue
+            known.add(name)
+            if mask & IN_ISDIR:
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_dir(path, now)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self._mark_ready(path, now)
+            elif mask & (IN_CREATE | IN_MODIFY):
+                self.pending[path] = (None, None, now)
+
+    def _poll_dirs(self, now: float):
+        '''Helper function: list again the directories whose mtime changed'''
+        self.stopped.wait(self.interval)
+        for path in list(self.dirs.keys()):
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                self._drop_dir(path)
+                continue
+            if mtime != self.dirs[path][0]:
+                self._scan(path, now)
+
+    def _check_pending(self, now: float):
+        '''Helper function: ready files whose size and mtime are stable'''
+        for path, (size, mtime, changed) in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime):
+                self.pending[path] = (stat.st_size, stat.st_mtime_ns, now)
+            elif now - changed >= self.settle:
+                self._mark_ready(path, now)
+
+    def _flush(self, now: float, force: bool = False):
+        '''Helper function: hand coalesced ready files to the handler'''
+        while len(self.ready) > 0 and (
+                force or len(self.ready) >= self.batch_size or
+                now - self.first_ready >= self.delay):
+            batch = self.ready[:self.batch_size]
+            self.ready = self.ready[self.batch_size:]
+            self.first_ready = now if len(self.ready) > 0 else None
+            try:
+                self.handler(batch)
+            except Exception as err:
+                self.log.error(f"handler failed on {len(batch)} files: {err}")
+
+    def run(self):
+        '''Watch until stop() is called'''
+        now = time.monotonic()
+        for path in self.paths:
+            self._add_dir(path, now)
+        try:
+            while not self.stopped.is_set():
+                if self.inotify is not None:
+                    self._handle_events(time.monotonic())
+                else:
+                    self._poll_dirs(time.monotonic())
+                now = time.monotonic()
+                self._check_pending(now)
+                self._flush(now)
+            self._flush(time.monotonic(), True)
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
+                self.inotify = None
+
+    def start(self) -> threading.Thread:
+        '''Watch in a background thread'''
+        self.thread = threading.Thread(target=self.run, name="FileDB-watch",
+                                       daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        '''Stop watching, ready files are handed over before it returns'''
+        self.stopped.set()
+        if self.thread is not None and \
+                self.thread is not threading.current_thread():
+            self.thread.join()
@@ -1,122 +1,837 @@
-'''
-File Database source code
-
-Author: Weiru Chen <flamingm321@gmail.com>
-Date: 2024-01-21
-'''
-
-import os
-from lib.error import FileExistInDataBase, UnknownFileType
-from lib.log import SystemLog
-from lib.module_manager import ModuleManager
-from lib.config_manager import ConfigFinder
-from lib.file_manager import FileManager
-
-
-class FileDB:
-    '''File Database: Manager your files. This is user interface'''
-    def __init__(self, config: str) -> None:
-        self.finder = ConfigFinder(config)
-        self.manager = FileManager(config)
-        self.mods = ModuleManager()
-        self.groups = {}
-        self.log = SystemLog("FileDB", True)
-
-    def _load_module_raw(self, rulename: str):
-        '''Helper function: loading specified module/plugin with rulename'''
-        if rulename is None:
-            return
-
-        for key in list(self.groups.keys()):
-            if rulename == key:
-                return
-
-        self.mods.active(self.finder.rule["plugin"])
-        self.groups[rulename] = {
-            "db": self.mods.call(rulename, "Cache",
-                                 cfg=self.finder.rule)
-        }
-
-    def load_module(self, rulename: str) -> bool:
-        '''Loading specified module/plugin with rulename'''
-        if not self.finder.find_rule(rulename):
-            return False
-        self._load_module_raw(rulename)
-        return True
-
-    def add(self, filepath: str, tags: None | list = None):
-        '''
-        Adding file into database
-         @filepath: source file path
-         @tags: tags list for this file
-        '''
-        if self.finder.find_match(filepath) and \
-           "plugin" in self.finder.rule.keys():
-            src = self.finder.file
-            dst = self.finder.get_destination()
-
-            if os.path.exists(dst):
-                msg = FileExistInDataBase(f"{src} is exist in {dst}")
-                self.log.error(msg)
-                self.finder.clear()
-                # raise msg
-                return
-
-            rulename = self.finder.rulename
-            self._load_module_raw(rulename)
-            self.groups[rulename]["db"].add_cache(dst, self.finder.rule, tags)
-            self.manager.move(dst, src)
-        else:
-            # raise UnknownFileType(f"File name: {src}")
-            self.log.warn(UnknownFileType(f"File: {filepath}"))
-            return
-
-    def search(self, rulename: str, meta: dict) -> list:
-        '''Search files with @rulename and @meta data'''
-        if self.load_module(rulename):
-            return self.groups[rulename]["db"].search(meta)
-        return []
-
-
-def main():
-    '''nothing'''
-    # pass
-
-
-if __name__ == "__main__":
-    fs = FileDB("./config.json")
-
-    files = [
-        "./hello_2022_01_30_sadkld.txt",
-        "./hello_2022_02_10_sadkld.txt",
-        "./hello_2022_03_30_sadkld.txt",
-        "./hello_2022_04_30_sadkld.txt",
-    ]
-
-    count = 0
-    for file in files:
-        with open(file, 'w', encoding='utf-8') as fd:
-            fd.write("1234,123,12,1\n")
-            fd.write("1234,123,12,1\n")
-
-        fs.add(file, [f"count={count}"])
-        fs.finder.dump_result()
-        count += 1
-
-    print(fs.search("general", {
-        "starttime": "2022-01-01",
-        "endtime": "2022-03-03"
-        }))
-    print(fs.search("general", {
-        "parameter": ["datetime", "path"],
-        "starttime": "2022-01-01",
-        "endtime": "2022-03-03"
-        }))
-    print(fs.search("general", {
-        "parameter": ["datetime", "tags"],
-        "tags": "count"
-        }))
-    print(fs.search("general", {
-        "parameter": ["datetime", "tags"],
-        "tags": [1, 2]
-        }))
+'''
+File Database source code
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import json
+import sys
+import contextlib
+import functools
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from lib.error import FileExistInDataBase, UnknownFileType, GeneralException
+from lib.log import SystemLog, configure as configure_log, \
+    DEFAULT_MAX_BYTES as DEFAULT_LOG_MAX_BYTES, \
+    DEFAULT_BACKUPS as DEFAULT_LOG_BACKUPS, \
+    DEFAULT_BURST as DEFAULT_LOG_BURST, DEFAULT_WINDOW as DEFAULT_LOG_WINDOW
+from lib.module_manager import ModuleManager
+from lib.config_manager import ConfigFinder, ConfigManager
+from lib.file_manager import FileManager
+from lib.merge import merge_sorted
+from lib import metrics
+from lib.metrics import PrometheusExporter, DEFAULT_INTERVAL as \
+    DEFAULT_METRICS_INTERVAL
+from lib.ingest import AddStatus, IngestPipeline, DEFAULT_WORKERS, \
+    DEFAULT_QUEUE_SIZE, plan_dedup
+from lib.result_cache import ResultCache, DEFAULT_MAX_ENTRIES, DEFAULT_TTL, \
+    DEFAULT_MAX_BYTES
+from lib.common import DEFAULT_BATCH_SIZE, DEFAULT_PAGE_SIZE, \
+    DEFAULT_FETCH_SIZE, to_epoch
+
+DEFAULT_ASYNC_READERS = 8
+DEFAULT_RULE_CONCURRENCY = 4
+# Seconds to wait for more add() calls before running a batch
+DEFAULT_BATCH_DELAY = 0.005
+
+
+class FileDB:
+    '''
+    File Database: Manager your files. This is user interface
+
+    Plugins are imported and rule caches created when a rule is first
+    used. With @lazy, rule cache databases are also opened only on their
+    first query, e.g. rules skipped by search_all are never opened.
+    '''
+    def __init__(self, config: str, lazy: bool = False) -> None:
+        self.lazy = lazy
+        self.config = ConfigManager.shared(config)
+        self.finder = ConfigFinder(self.config)
+        self.manager = FileManager(self.config)
+        self.mods = ModuleManager()
+        self.groups = {}
+        self.lock = threading.RLock()
+        options = self.config.get().get("log")
+        if options is not None:
+            configure_log(options.get("level"), options.get("file"),
+                          options.get("max_bytes", DEFAULT_LOG_MAX_BYTES),
+                          options.get("backups", DEFAULT_LOG_BACKUPS),
+                          options.get("format", "text") == "json",
+                          options.get("burst", DEFAULT_LOG_BURST),
+                          options.get("window", DEFAULT_LOG_WINDOW))
+        self.log = SystemLog("FileDB", True)
+        self.exporter = None
+        options = self.config.get().get("metrics")
+        if options is not None and options.get("enabled", True):
+            metrics.enable()
+            if options.get("prometheus"):
+                self.exporter = PrometheusExporter(
+                    metrics.METRICS, options["prometheus"],
+                    options.get("interval", DEFAULT_METRICS_INTERVAL))
+                self.exporter.start()
+        self.results = None
+        options = self.config.get().get("result_cache")
+        if options is not None:
+            self.results = ResultCache(
+                options.get("entries", DEFAULT_MAX_ENTRIES),
+                options.get("ttl", DEFAULT_TTL),
+                options.get("max_bytes", DEFAULT_MAX_BYTES))
+
+    def metrics(self) -> dict:
+        '''
+        Snapshot of timers (latency histograms in seconds) and counters of
+        this process, empty unless metrics are enabled
+        '''
+        return metrics.snapshot()
+
+    def _load_module_raw(self, rulename: str):
+        '''Helper function: loading specified module/plugin with rulename'''
+        if rulename is None:
+            return
+
+        for key in list(self.groups.keys()):
+            if rulename == key:
+                return
+
+        self.mods.active(self.finder.rule["plugin"])
+        self.groups[rulename] = {
+            "db": self.open_cache(rulename, self.finder.rule)
+        }
+
+    def open_cache(self, rulename: str, rule: dict):
+        '''
+        New plugin cache of @rulename, whose inserts invalidate the search
+        result cache
+        '''
+        if rule.get("partition"):
+            db = self._open_partitioned(rule)
+        elif self.lazy:
+            db = self.mods.call(rule["plugin"], "Cache", cfg=rule, lazy=True)
+        else:
+            db = self.mods.call(rule["plugin"], "Cache", cfg=rule)
+        if self.results is not None and hasattr(db, "listeners"):
+            db.listeners.append(
+                functools.partial(self.results.invalidate, rulename))
+        return db
+
+    def _open_partitioned(self, rule: dict):
+        '''Helper function: time partitioned cache of @rule'''
+        from lib.partition import PartitionedCache, DEFAULT_WORKERS as \
+            DEFAULT_SHARD_WORKERS, DEFAULT_MAX_OPEN
+        options = rule["partition"]
+        if isinstance(options, str):
+            options = {"by": options}
+        return PartitionedCache(
+            rule,
+            lambda cfg, lazy: self.mods.call(rule["plugin"], "Cache",
+                                             cfg=cfg, lazy=lazy),
+            options.get("by", "year"),
+            options.get("workers", DEFAULT_SHARD_WORKERS),
+            options.get("max_open", DEFAULT_MAX_OPEN))
+
+    def load_module(self, rulename: str) -> bool:
+        '''Loading specified module/plugin with rulename'''
+        if rulename in self.groups:
+            return True
+        with self.lock:
+            if not self.finder.find_rule(rulename):
+                return False
+            self._load_module_raw(rulename)
+        return True
+
+    def add(self, filepath: str, tags: None | list = None) -> AddStatus:
+        '''
+        Adding file into database
+         @filepath: source file path
+         @tags: tags list for this file
+        '''
+        with metrics.timer("add"):
+            status = self._add(filepath, tags)
+        metrics.count("files", status=status.name.lower())
+        return status
+
+    def _add(self, filepath: str, tags: None | list = None) -> AddStatus:
+        '''Helper function: adding one file, see add'''
+        if self.finder.find_match(filepath) and \
+           "plugin" in self.finder.rule.keys():
+            src = self.finder.file
+            dst = self.finder.get_destination()
+            rulename = self.finder.rulename
+            self._load_module_raw(rulename)
+            db = self.groups[rulename]["db"]
+
+            status, dst, link, digest = plan_dedup(self.finder.rule, src, dst,
+                                                   db.find_hash)
+            if status == AddStatus.EXISTS:
+                msg = FileExistInDataBase(f"{src} is exist in {dst}")
+                self.log.error(msg)
+                self.finder.clear()
+                # raise msg
+                return status
+            if status == AddStatus.DUPLICATE:
+                self.log.warn(f"{src} is duplicate of a stored file")
+                self.finder.clear()
+                return status
+
+            # a row is only written for a file which is in place
+            if link is None:
+                self.manager.move(dst, src)
+            else:
+                self.manager.link(dst, link, src)
+            db.add_cache(dst, self.finder.rule, tags, self.finder.re_match,
+                         digest)
+            return AddStatus.ADDED
+        else:
+            # raise UnknownFileType(f"File name: {src}")
+            self.log.warn(UnknownFileType(f"File: {filepath}"))
+            return AddStatus.UNKNOWN
+
+    def add_many(self, filepaths: list, tags: None | list | dict = None,
+                 batch_size: int = DEFAULT_BATCH_SIZE) -> dict:
+        '''
+        Adding many files into database with batched index transactions,
+        rows are written for the files of a batch which were moved
+         @filepaths: source file paths
+         @tags: tags list for all files, or a dict of filepath -> tags list
+         @batch_size: number of index rows committed per transaction
+        Return dict of filepath -> AddStatus
+        '''
+        with metrics.timer("add_many"):
+            report = self._add_many(filepaths, tags, batch_size)
+        _count_report(report)
+        return report
+
+    def _add_many(self, filepaths: list, tags: None | list | dict,
+                  batch_size: int) -> dict:
+        '''Helper function: adding many files, see add_many'''
+        report = {filepath: None for filepath in filepaths}
+        plans = {}
+        claimed = set()
+        seen = {}
+        for filepath in filepaths:
+            if not self.finder.find_match(filepath) or \
+               "plugin" not in self.finder.rule.keys():
+                self.log.warn(UnknownFileType(f"File: {filepath}"))
+                report[filepath] = AddStatus.UNKNOWN
+                continue
+
+            src = self.finder.file
+            dst = self.finder.get_destination()
+            rulename = self.finder.rulename
+            self._load_module_raw(rulename)
+            db = self.groups[rulename]["db"]
+            status, dst, link, digest = plan_dedup(
+                self.finder.rule, src, dst,
+                lambda key: seen.get((rulename, key)) or db.find_hash(key))
+            if status is None and dst in claimed:
+                status = AddStatus.EXISTS
+            if status == AddStatus.EXISTS:
+                self.log.error(
+                    FileExistInDataBase(f"{src} is exist in {dst}"))
+            elif status == AddStatus.DUPLICATE:
+                self.log.warn(f"{src} is duplicate of a stored file")
+            if status is not None:
+                report[filepath] = status
+                continue
+            claimed.add(dst)
+            if digest is not None:
+                seen[(rulename, digest)] = str(dst)
+
+            file_tags = tags.get(filepath) if isinstance(tags, dict) else tags
+            plans.setdefault(rulename, (self.finder.rule, []))[1].append(
+                (filepath, src, dst, file_tags, self.finder.re_match, link,
+                 digest))
+
+        for rulename, (rule, items) in plans.items():
+            db = self.groups[rulename]["db"]
+            for i in range(0, len(items), max(1, batch_size)):
+                batch = self._place(items[i:i + batch_size], report)
+                if len(batch) == 0:
+                    continue
+                try:
+                    db.add_cache_many(
+                        [item[2] for item in batch], rule,
+                        {item[2]: item[3] for item in batch},
+                        batch_size,
+                        {item[2]: item[4] for item in batch},
+                        {item[2]: item[6] for item in batch})
+                except Exception as err:
+                    self.log.error(f"[{rulename}] batch insert failed: {err}")
+                    for item in batch:
+                        report[item[0]] = AddStatus.FAILED
+                    continue
+                for item in batch:
+                    report[item[0]] = AddStatus.ADDED
+        return report
+
+    def _place(self, batch: list, report: dict) -> list:
+        '''
+        Helper function: move or link the files of @batch into root, the
+        failed ones are reported as FAILED
+        Return items of the placed files, only those get a row
+        '''
+        errors = self.manager.move_many(
+            [(item[2], item[1]) for item in batch if item[5] is None])
+        placed = []
+        for item in batch:
+            filepath, src, dst, _, _, link, _ = item
+            if link is not None:
+                try:
+                    self.manager.link(dst, link, src)
+                    errors[dst] = None
+                except OSError as err:
+                    errors[dst] = err
+            if errors[dst] is None:
+                placed.append(item)
+            else:
+                self.log.error(f"move {src} -> {dst} failed: {errors[dst]}")
+                report[filepath] = AddStatus.FAILED
+        return placed
+
+    def ingest(self, filepaths: list, tags: None | list | dict = None,
+               workers: int = DEFAULT_WORKERS,
+               queue_size: int = DEFAULT_QUEUE_SIZE,
+               batch_size: int = DEFAULT_BATCH_SIZE) -> dict:
+        '''
+        Adding many files with the parallel ingest pipeline
+         @filepaths: source file paths
+         @tags: tags list for all files, or a dict of filepath -> tags list
+         @workers: number of threads doing stat/mkdir/move work
+         @queue_size: max files in flight per stage (backpressure)
+         @batch_size: number of index rows committed per transaction
+        Return dict of filepath -> AddStatus
+        '''
+        pipeline = IngestPipeline(self, workers, queue_size, batch_size)
+        with metrics.timer("ingest"):
+            report = pipeline.run(filepaths, tags)
+        _count_report(report)
+        return report
+
+    def watch(self, paths: None | list = None,
+              tags: None | list = None, workers: int = DEFAULT_WORKERS,
+              block: bool = True, **kwargs) -> 'Watcher':
+        '''
+        Watch inbox directories and ingest new files in batches
+         @paths: inbox directories, default `inbox` of config
+         @block: watch in this thread until interrupted, else in background
+         @kwargs: Watcher options, e.g. settle, delay, batch_size, backend
+        Return the Watcher, stop() it to end a background watch
+        '''
+        from lib.watcher import Watcher
+        if paths is None:
+            paths = self.config.get().get("inbox", [])
+        if isinstance(paths, str):
+            paths = [paths]
+        watcher = Watcher(paths,
+                          lambda files: self.ingest(files, tags, workers),
+                          **kwargs)
+        if not block:
+            watcher.start()
+            return watcher
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            self.log.info("watch stopped")
+        return watcher
+
+    def verify(self, rulenames: None | list = None, incremental: bool = False,
+               workers: None | int = None) -> dict:
+        '''
+        Report files without row and rows without file of rule caches
+         @incremental: only list directories changed since the last run
+         @workers: directory walker threads, default
+                   lib.reconcile.DEFAULT_WORKERS
+        Return rulename -> lib.reconcile.Report
+        '''
+        from lib.reconcile import Reconciler, DEFAULT_WORKERS
+        return Reconciler(self, workers or DEFAULT_WORKERS).verify(
+            rulenames, incremental)
+
+    def rebuild(self, rulenames: None | list = None,
+                incremental: bool = False, clean: bool = False,
+                workers: None | int = None) -> dict:
+        '''
+        Insert rows of files without row and delete rows without file
+         @clean: drop all rows and rebuild rule caches from the files
+        Return rulename -> lib.reconcile.Report found before repairing
+        '''
+        from lib.reconcile import Reconciler, DEFAULT_WORKERS
+        return Reconciler(self, workers or DEFAULT_WORKERS).repair(
+            rulenames, incremental, clean)
+
+    def archive(self, rulename: str, period: str,
+                force: bool = False) -> dict:
+        '''
+        Pack files of @rulename in @period ("2001" or "2001-01") into one
+        zip container, their paths become "<container>::<member>"
+         @force: also pack a period which is not over yet
+        Return report of lib.archive.Archiver.pack
+        '''
+        from lib.archive import Archiver
+        report = Archiver(self).pack(rulename, period, force)
+        if report["files"] > 0:
+            # snapshots keep paths of rows loaded before
+            with self.lock:
+                self.groups[rulename].pop("snapshot", None)
+        return report
+
+    def read(self, path: str) -> bytes:
+        '''
+        Content of a stored file, archived paths are read from their
+        container without decompressing other members
+        '''
+        from lib.archive import read, split_reference
+        ref = split_reference(path)
+        member = None
+        if ref is not None:
+            result = self.finder.match(ref[1].rsplit("/", 1)[-1])
+            if result is not None and self.load_module(result.rulename):
+                member = self.groups[result.rulename]["db"].find_member(path)
+        return read(path, member)
+
+    def snapshot(self, rulename: str, refresh: bool = True):
+        '''
+        In-memory columnar snapshot of @rulename cache (needs numpy), kept
+        per rule and refreshed with rows inserted since the last call
+        Return lib.columnar.ColumnarSnapshot, None if there is no such rule
+        '''
+        if not self.load_module(rulename):
+            return None
+        from lib.columnar import ColumnarSnapshot
+        group = self.groups[rulename]
+        with self.lock:
+            snapshot = group.get("snapshot")
+            if snapshot is None:
+                group["snapshot"] = ColumnarSnapshot(group["db"])
+                return group["snapshot"]
+        if refresh:
+            snapshot.refresh()
+        return snapshot
+
+    def load(self, rulename: str, meta: None | dict = None,
+             rows: None | list = None, **kwargs):
+        '''
+        Read delimited files of @rulename matching @meta, or of search
+        result @rows, into one NumPy array in datetime order (needs numpy)
+         @kwargs: workers, processes and parse options of
+                  lib.loader.BulkLoader
+        Return lib.loader.Frame
+        '''
+        from lib.loader import BulkLoader
+        return BulkLoader(self, **kwargs).load(rulename, meta, rows)
+
+    def search(self, rulename: str, meta: dict) -> list:
+        '''Search files with @rulename and @meta data'''
+        with metrics.timer("search", rule=rulename) as timer:
+            rows = self._search(rulename, meta)
+            timer.count("search_rows", len(rows))
+        return rows
+
+    def _search(self, rulename: str, meta: dict) -> list:
+        '''Helper function: search, through the result cache if enabled'''
+        if not self.load_module(rulename):
+            return []
+        db = self.groups[rulename]["db"]
+        if self.results is None:
+            return db.search(meta)
+
+        span = (to_epoch(meta["starttime"]) if "starttime" in meta else None,
+                to_epoch(meta["endtime"]) if "endtime" in meta else None)
+        key = self.results.key(rulename, meta, span)
+        rows = self.results.get(key)
+        if rows is not None:
+            return list(rows)
+        generation = self.results.generation(rulename)
+        rows = db.search(meta)
+        self.results.put(key, list(rows), generation)
+        return rows
+
+    def iter_search(self, rulename: str, meta: dict, **kwargs):
+        '''
+        Search files with @rulename and @meta data, yield rows in batches
+        ordered by datetime. @kwargs: batch_size, after, limit, order
+        '''
+        if self.load_module(rulename):
+            yield from self.groups[rulename]["db"].iter_search(meta, **kwargs)
+
+    def page(self, rulename: str, meta: dict, after: None | tuple = None,
+             limit: int = DEFAULT_PAGE_SIZE, order: str = "asc") -> tuple:
+        '''
+        One page of search result, pass the returned cursor as @after to
+        get the next page
+        Return (rows, cursor of next page or None)
+        '''
+        if self.load_module(rulename):
+            return self.groups[rulename]["db"].page(meta, after, limit, order)
+        return [], None
+
+    def search_all(self, meta: dict, limit: None | int = None,
+                   order: str = "asc", source: bool = True,
+                   rulenames: None | list = None,
+                   batch_size: int = DEFAULT_FETCH_SIZE):
+        '''
+        Search @meta in the caches of all rules (or @rulenames) at once,
+        yield rows merged by datetime
+         @limit: max number of rows
+         @order: "asc" or "desc"
+         @source: yield (rulename, row) instead of row
+        Rules without a plugin and caches which can not match @meta, e.g.
+        lacking a requested label, are skipped.
+        '''
+        if rulenames is None:
+            rulenames = list(self.config.get()["rules"].keys())
+        streams = []
+        for rank, rulename in enumerate(rulenames):
+            rule = self.config.get()["rules"].get(rulename, {})
+            if not rule.get("plugin") or not self.load_module(rulename):
+                continue
+            db = self.groups[rulename]["db"]
+            can_match = getattr(db, "can_match", None)
+            if can_match is not None and not can_match(meta):
+                continue
+            streams.append(self._keyed_search(rank, rulename, db, meta,
+                                              limit, order, batch_size))
+
+        rows = merge_sorted(streams, key=lambda item: item[0],
+                            reverse=order.lower() == "desc")
+        try:
+            for _, rulename, row in itertools.islice(rows, limit):
+                yield (rulename, row) if source else row
+        finally:
+            rows.close()
+
+    @staticmethod
+    def _keyed_search(rank: int, rulename: str, db, meta: dict,
+                      limit: None | int, order: str, batch_size: int):
+        '''Helper function: yield ((epoch, rank, id), rulename, row)'''
+        cursor = []
+        for row in db.iter_search(meta, batch_size, limit=limit, order=order,
+                                  cursor=cursor):
+            yield (cursor[0], rank, cursor[1]), rulename, row
+
+
+def _count_report(report: dict):
+    '''Helper function: count files of an add report by status'''
+    if not metrics.METRICS.enabled:
+        return
+    statuses = {}
+    for status in report.values():
+        name = "none" if status is None else status.name.lower()
+        statuses[name] = statuses.get(name, 0) + 1
+    for name, value in statuses.items():
+        metrics.count("files", value, status=name)
+
+
+class AsyncFileDB:
+    '''
+    asyncio facade of FileDB
+
+    Blocking work runs in executors owned by this object: searches in a
+    pool of @readers threads, ingest in one writer thread. Concurrent add()
+    calls are coalesced into batches for FileDB.ingest, which does the
+    filesystem work on @workers threads and has one index writer per rule.
+    At most @rule_concurrency searches of one rule cache run at a time.
+    '''
+    def __init__(self, config: str | FileDB, workers: int = DEFAULT_WORKERS,
+                 readers: int = DEFAULT_ASYNC_READERS,
+                 rule_concurrency: int = DEFAULT_RULE_CONCURRENCY,
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 batch_delay: float = DEFAULT_BATCH_DELAY) -> None:
+        import asyncio
+        self.db = config if isinstance(config, FileDB) else FileDB(config)
+        self.workers = workers
+        self.rule_concurrency = rule_concurrency
+        self.batch_size = max(1, batch_size)
+        self.batch_delay = batch_delay
+        self.readers = ThreadPoolExecutor(readers, "AsyncFileDB-read")
+        self.writer = ThreadPoolExecutor(1, "AsyncFileDB-write")
+        self.limits = {}
+        self.pending = []
+        self.wakeup = asyncio.Event()
+        self.runner = None
+        self.closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    def _limit(self, rulename: str) -> 'asyncio.Semaphore':
+        '''Helper function: concurrency limit of @rulename cache'''
+        import asyncio
+        if rulename not in self.limits:
+            self.limits[rulename] = asyncio.Semaphore(self.rule_concurrency)
+        return self.limits[rulename]
+
+    async def _run(self, executor: ThreadPoolExecutor, func, *args, **kwargs):
+        '''Helper function: run blocking @func in @executor'''
+        if self.closed:
+            raise GeneralException("AsyncFileDB is closed")
+        import asyncio
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, functools.partial(func, *args, **kwargs))
+
+    async def add(self, filepath: str, tags: None | list = None) -> AddStatus:
+        '''Adding file into database, see FileDB.add'''
+        if self.closed:
+            raise GeneralException("AsyncFileDB is closed")
+        import asyncio
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((filepath, tags, future))
+        if self.runner is None or self.runner.done():
+            self.runner = asyncio.create_task(self._run_batches())
+        self.wakeup.set()
+        return await future
+
+    async def add_many(self, filepaths: list,
+                       tags: None | list | dict = None) -> dict:
+        '''Adding many files into database, see FileDB.ingest'''
+        return await self._run(self.writer, self.db.ingest, filepaths, tags,
+                               self.workers, batch_size=self.batch_size)
+
+    def _take_batch(self) -> list:
+        '''Helper function: pop pending adds of one batch'''
+        batch = []
+        names = set()
+        rest = []
+        for item in self.pending:
+            if item[2].done():
+                continue
+            if item[0] in names or len(batch) >= self.batch_size:
+                rest.append(item)
+                continue
+            names.add(item[0])
+            batch.append(item)
+        self.pending = rest
+        return batch
+
+    async def _run_batches(self):
+        '''Helper function: feed coalesced add() calls to FileDB.ingest'''
+        import asyncio
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            await asyncio.sleep(self.batch_delay)
+            while len(self.pending) > 0:
+                batch = self._take_batch()
+                if len(batch) == 0:
+                    continue
+                try:
+                    report = await self._run(
+                        self.writer, self.db.ingest,
+                        [item[0] for item in batch],
+                        {item[0]: item[1] for item in batch},
+                        self.workers, batch_size=self.batch_size)
+                except Exception as err:
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_exception(err)
+                    continue
+                for filepath, _, future in batch:
+                    if not future.done():
+                        future.set_result(report[filepath])
+
+    async def search(self, rulename: str, meta: dict) -> list:
+        '''Search files with @rulename and @meta data'''
+        async with self._limit(rulename):
+            return await self._run(self.readers, self.db.search, rulename,
+                                   meta)
+
+    async def page(self, rulename: str, meta: dict,
+                   after: None | tuple = None,
+                   limit: int = DEFAULT_PAGE_SIZE,
+                   order: str = "asc") -> tuple:
+        '''One page of search result, see FileDB.page'''
+        async with self._limit(rulename):
+            return await self._run(self.readers, self.db.page, rulename,
+                                   meta, after, limit, order)
+
+    async def iter_search(self, rulename: str, meta: dict,
+                          batch_size: int = DEFAULT_FETCH_SIZE,
+                          after: None | tuple = None,
+                          limit: None | int = None, order: str = "asc"):
+        '''
+        Search files with @rulename and @meta data, async iterate rows
+        ordered by datetime, see FileDB.iter_search
+        Every batch is one keyset page, so a suspended stream holds neither
+        a rule slot nor a read connection.
+        '''
+        batch_size = max(1, batch_size)
+        while limit is None or limit > 0:
+            size = batch_size if limit is None else min(batch_size, limit)
+            async with self._limit(rulename):
+                batch, after = await self._run(
+                    self.readers, self.db.page, rulename, meta, after, size,
+                    order)
+            for row in batch:
+                yield row
+            if limit is not None:
+                limit -= len(batch)
+            if after is None:
+                return
+
+    async def aclose(self):
+        '''
+        Stop accepting requests, cancel adds which are not started and wait
+        for running executor work to finish
+        '''
+        if self.closed:
+            return
+        import asyncio
+        self.closed = True
+        if self.runner is not None:
+            self.runner.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.runner
+        for _, _, future in self.pending:
+            future.cancel()
+        self.pending = []
+        for executor in (self.readers, self.writer):
+            await asyncio.to_thread(executor.shutdown, True,
+                                    cancel_futures=True)
+
+
+def demo(config: str):
+    '''Add and search a few demo files'''
+    fs = FileDB(config)
+
+    files = [
+        "./hello_2022_01_30_sadkld.txt",
+        "./hello_2022_02_10_sadkld.txt",
+        "./hello_2022_03_30_sadkld.txt",
+        "./hello_2022_04_30_sadkld.txt",
+    ]
+
+    count = 0
+    for file in files:
+        with open(file, 'w', encoding='utf-8') as fd:
+            fd.write("1234,123,12,1\n")
+            fd.write("1234,123,12,1\n")
+
+        fs.add(file, [f"count={count}"])
+        fs.finder.dump_result()
+        count += 1
+
+    print(fs.search("general", {
+        "starttime": "2022-01-01",
+        "endtime": "2022-03-03"
+        }))
+    print(fs.search("general", {
+        "parameter": ["datetime", "path"],
+        "starttime": "2022-01-01",
+        "endtime": "2022-03-03"
+        }))
+    print(fs.search("general", {
+        "parameter": ["datetime", "tags"],
+        "tags": "count"
+        }))
+    print(fs.search("general", {
+        "parameter": ["datetime", "tags"],
+        "tags": [1, 2]
+        }))
+
+
+def _print_reports(reports: dict, unknown: int, as_json: bool):
+    '''Helper function: print verify / rebuild reports'''
+    if as_json:
+        print(json.dumps({"rules": [report.to_dict()
+                                    for report in reports.values()],
+                          "unknown": unknown}, indent=2))
+        return
+    for rulename, report in reports.items():
+        print(f"{rulename}: {report.files} files, {report.rows} rows, "
+              f"{len(report.missing)} missing, "
+              f"{len(report.orphaned)} orphaned")
+        for path in report.missing:
+            print(f"  missing  {path}")
+        for _, path in report.orphaned:
+            print(f"  orphaned {path}")
+    if unknown > 0:
+        print(f"{unknown} files under root match no rule destination")
+
+
+def main(argv: None | list = None) -> int:
+    '''Command line interface, return exit status'''
+    import argparse
+    from lib.reconcile import Reconciler, DEFAULT_WORKERS as \
+        DEFAULT_RECONCILE_WORKERS
+    parser = argparse.ArgumentParser(prog="filedb",
+                                     description="File Database")
+    parser.add_argument("-c", "--config", default="./config.json",
+                        help="config file, default ./config.json")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    verify = commands.add_parser(
+        "verify", help="report files without row and rows without file")
+    rebuild = commands.add_parser(
+        "rebuild", help="insert missing rows and delete orphaned rows")
+    for command in (verify, rebuild):
+        command.add_argument("-r", "--rule", action="append", dest="rules",
+                             help="rule to check, default all rules")
+        command.add_argument("-i", "--incremental", action="store_true",
+                             help="only list directories changed since "
+                                  "the last run")
+        command.add_argument("-w", "--workers", type=int,
+                             default=DEFAULT_RECONCILE_WORKERS,
+                             help="directory walker threads")
+        command.add_argument("--json", action="store_true",
+                             help="print reports as JSON")
+    rebuild.add_argument("--clean", action="store_true",
+                         help="drop all rows and rebuild from the files")
+    archive = commands.add_parser(
+        "archive", help="pack files of a closed period into a zip container")
+    archive.add_argument("-r", "--rule", required=True,
+                         help="rule whose files are packed")
+    archive.add_argument("period", help="year or month, e.g. 2001-01")
+    archive.add_argument("--force", action="store_true",
+                         help="also pack a period which is not over yet")
+    serve = commands.add_parser(
+        "serve", help="serve add and search requests on a Unix socket")
+    serve.add_argument("-s", "--socket", default=None,
+                       help="socket path, default lib.server.DEFAULT_SOCKET")
+    serve.add_argument("--readers", type=int, default=None,
+                       help="search threads")
+    serve.add_argument("--batch-delay", type=float, default=None,
+                       help="seconds adds of clients are collected into "
+                            "one ingest")
+    commands.add_parser("demo", help="add and search a few demo files")
+
+    args = parser.parse_args(argv)
+    if args.command == "demo":
+        demo(args.config)
+        return 0
+    if args.command == "serve":
+        import signal
+        from lib.server import FileDBServer
+        options = {key: value for key, value in (
+            ("path", args.socket), ("readers", args.readers),
+            ("batch_delay", args.batch_delay)) if value is not None}
+        server = FileDBServer(FileDB(args.config, lazy=True), **options)
+        signal.signal(signal.SIGTERM, lambda *_: server.stop())
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.stop()
+        return 0
+    if args.command == "archive":
+        report = FileDB(args.config, lazy=True).archive(
+            args.rule, args.period, args.force)
+        print(json.dumps(report, indent=2))
+        return 0
+
+    reconciler = Reconciler(FileDB(args.config, lazy=True), args.workers)
+    if args.command == "verify":
+        reports = reconciler.verify(args.rules, args.incremental)
+        _print_reports(reports, len(reconciler.unknown), args.json)
+        return 0 if all(report.ok() for report in reports.values()) else 1
+    reports = reconciler.repair(args.rules, args.incremental, args.clean)
+    _print_reports(reports, len(reconciler.unknown), args.json)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
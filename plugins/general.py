@@ -1,122 +1,647 @@
-'''
-The general version of File Database plugin
-
-Author: Weiru Chen <flamingm321@gmail.com>
-Date: 2024-01-21
-'''
-
-import os
-import uuid
-import re
-import datetime
-from pathlib import Path
-from lib import libindex
-
-
-class Cache:
-    '''Plugin basic class'''
-    def __init__(self, cfg: dict):
-        self.config = cfg
-        path = cfg["cache_path"]
-        if path is None or len(path) == 0:
-            path = f"./caches/{uuid.uuid4()}.db"
-        path = Path(self.config['root'], path)
-        path.parent.mkdir(parents=True, exist_ok=True)
-
-        if not os.path.exists(path):
-            self.index = libindex.Index(path)
-            self.index.init()
-        else:
-            self.index = libindex.Index(path)
-        self._check_columns()
-
-    def _check_columns(self):
-        tbname = self.index.get_default_tablename()
-        db_columns = self.index.get_columns(tbname)
-        columns = []
-        labels = self.config["labels"]
-        for key in labels.keys():
-            for ele in labels[key]:
-                columns.append(ele)
-
-        for ele in columns:
-            if ele not in db_columns:
-                if ele in ["year", "month", "day"]:
-                    # self.index.add_column(tbname, ele, "integer")
-                    print(f"Skip: {ele}")
-
-    def search(self, meta: object) -> list:
-        '''search specified file by @meta data'''
-        tbname = self.index.get_default_tablename()
-        if "parameter" not in meta or meta["parameter"] is None or\
-           meta["parameter"] == []:
-            parameter = "*"
-        else:
-            parameter = meta["parameter"]
-            if isinstance(parameter, list):
-                parameter = ','.join(parameter)
-
-        and_conditions = []
-        or_conditions = []
-        conditions = ""
-        if "starttime" in meta and "endtime" in meta:
-            st = meta["starttime"]
-            et = meta["endtime"]
-            and_conditions.append(f'datetime between "{st}" and "{et}"')
-        elif "starttime" in meta:
-            st = meta["starttime"]
-            and_conditions.append(f'datetime >= "{st}"')
-        elif "endtime" in meta:
-            et = meta["endtime"]
-            and_conditions.append(f'datetime <= "{et}"')
-
-        if "tags" in meta:
-            tags = None
-            if isinstance(meta["tags"], str):
-                tags = meta["tags"].split(',')
-            if isinstance(meta["tags"], list):
-                tags = meta["tags"]
-            if tags is not None:
-                for tag in tags:
-                    or_conditions.append(f'tags LIKE "%{tag}%"')
-
-        # combine all conditions
-        tmp = ""
-        if len(or_conditions) > 0:
-            tmp = ' or '.join(or_conditions)
-            and_conditions.append(tmp)
-        if len(and_conditions) > 0:
-            tmp = ' and '.join(and_conditions)
-            conditions = f"where {tmp}"
-        query = f"SELECT {parameter} from {tbname} {conditions};"
-
-        self.index.query(query)
-        return self.index.fa()
-
-    def add_cache(self, file: str | Path, cfg: dict, tags: None | list = None):
-        '''Add file meta data'''
-        file = file if isinstance(file, Path) else Path(file)
-        finder = re.match(cfg["format"], file.name)
-
-        # We known that year, month, and day in the file
-        groups = finder.groupdict().keys()
-        current_time = datetime.datetime.now()
-        year = int(finder.group("year")) if "year" in groups\
-            else current_time.year
-        month = int(finder.group("month")) if "month" in groups\
-            else current_time.month
-        day = int(finder.group("day")) if "day" in groups else current_time.day
-        hour = int(finder.group("hour")) if "hour" in groups else 0
-        minute = int(finder.group("minute")) if "minute" in groups else 0
-        second = int(finder.group("second")) if "second" in groups else 0
-
-        tbname = self.index.get_default_tablename()
-        dt = datetime.datetime(year, month, day, hour, minute, second)\
-            .strftime('"%Y-%m-%d %H:%M:%S"')
-        if tags is not None and len(tags) > 0:
-            tag = ','.join(tags)
-            self.index.query(f"""INSERT INTO {tbname} (datetime, path, tags)
-                         VALUES ({dt}, \"{file.absolute()}\", \"{tag}\");""")
-        else:
-            self.index.query(f"""INSERT INTO {tbname} (datetime, path) VALUES
-                         ({dt}, \"{file.absolute()}\");""")
+'''
+The general version of File Database plugin
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import os
+import uuid
+import re
+import datetime
+import threading
+from pathlib import Path
+from lib import libindex
+from lib.log import SystemLog
+from lib.common import to_epoch, DEFAULT_BATCH_SIZE, \
+    DEFAULT_FETCH_SIZE, DEFAULT_PAGE_SIZE, ARCHIVE_SEP
+TAG_TABLE = "tags"
+BASE_COLUMNS = ["id", "datetime", "path", "tags", "hash", "epoch"]
+# member of the zip container of archived files, see lib.archive
+ARCHIVE_COLUMNS = ["member_offset", "member_size", "member_method"]
+TIME_LABELS = ["year", "month", "day", "hour", "minute", "second"]
+TIMEFORMAT = "%Y-%m-%d %H:%M:%S"
+# ids are grouped in blocks of ID_SPAN, a cache inserts in block of id_base
+ID_SPAN = 10 ** 9
+
+
+def label_value(label: str, value, dt: None | str = None):
+    '''
+    Typed value of @label column: time labels are integer, taken from @dt
+    ("%Y-%m-%d %H:%M:%S") if @value is missing
+    '''
+    if label not in TIME_LABELS:
+        return value
+    if value is not None:
+        return int(value)
+    if dt is None:
+        return None
+    return getattr(datetime.datetime.strptime(dt, TIMEFORMAT), label)
+
+
+def split_tag(tag: str) -> tuple:
+    '''Split "key=value" tag into (key, value), value is None if no "="'''
+    key, sep, value = str(tag).strip().partition('=')
+    return (key, value if sep else None)
+
+
+def _prefix_condition(column: str, prefix: str) -> tuple:
+    '''Helper function: index friendly `column` starts with @prefix'''
+    if len(prefix) == 0:
+        return f"{column} IS NOT NULL", []
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return f"({column} >= ? AND {column} < ?)", [prefix, upper]
+
+
+def tag_condition(tag) -> tuple:
+    '''
+    SQL condition on the tag table for one tag query term
+     - "key=value": exact key and value
+     - "key=val*": exact key, value prefix
+     - "=value": exact value of any key
+     - "key*": key prefix
+     - "key": exact key, or exact value of any key
+    Return (condition, parameters)
+    '''
+    key, value = split_tag(tag)
+    if value is None:
+        if key.endswith('*'):
+            return _prefix_condition("key", key[:-1])
+        return "(key = ? OR value = ?)", [key, key]
+    if value.endswith('*'):
+        cond, params = _prefix_condition("value", value[:-1])
+    else:
+        cond, params = "value = ?", [value]
+    if len(key) == 0:
+        return cond, params
+    return f"(key = ? AND {cond})", [key] + params
+
+
+class Cache:
+    '''
+    Plugin basic class
+
+    With @lazy, the cache database is opened, migrated and checked for new
+    label columns on first use of `index` instead of in the constructor.
+    '''
+    def __init__(self, cfg: dict, lazy: bool = False):
+        self.config = cfg
+        path = cfg["cache_path"]
+        if path is None or len(path) == 0:
+            path = f"./caches/{uuid.uuid4()}.db"
+        self.path = Path(self.config['root'], path)
+
+        # functions called with the epochs of every committed insert batch
+        self.listeners = []
+        self.log = SystemLog("Cache", True)
+        self.labels = self._get_labels()
+        self.columns = ["datetime", "path", "tags", "hash", "epoch"] + \
+            [label for label in self.labels if label not in ["epoch"]]
+        # ids of inserted rows are above @id_base (see lib.partition)
+        self.id_base = 0
+        self._index = None
+        self._ready = False
+        self._open_lock = threading.RLock()
+        if not lazy:
+            self._open()
+
+    @property
+    def index(self) -> libindex.Index:
+        '''Cache database, opened on first use'''
+        if not self._ready:
+            self._open()
+        return self._index
+
+    def _open(self):
+        '''Helper function: open and upgrade the cache database once'''
+        with self._open_lock:
+            # also returns to migrations of the opening thread
+            if self._index is not None:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            sqlite = dict(self.config.get("sqlite", {}))
+            self._index = libindex.Index(
+                self.path, sqlite,
+                sqlite.pop("readers", libindex.DEFAULT_READERS))
+            try:
+                self._index.migrate(self.migrations())
+                self._check_columns()
+            except Exception:
+                self._index.close()
+                self._index = None
+                raise
+            self._ready = True
+
+    def close(self):
+        '''Close the cache database, it is opened again on next use'''
+        with self._open_lock:
+            if self._index is None:
+                return
+            self._ready = False
+            self._index.close()
+            self._index = None
+
+    def cache_files(self) -> list:
+        '''Database files of this cache'''
+        return [str(self.path.absolute())]
+
+    def rows(self, columns: str = "id, path",
+             batch_size: int = DEFAULT_FETCH_SIZE, after: int | dict = 0):
+        '''
+        Yield lists of up to @batch_size rows of @columns of every file
+         @after: only rows whose id is larger, or dict of id block
+                 (id // ID_SPAN) -> last id
+        '''
+        if isinstance(after, dict):
+            after = after.get(self.id_base // ID_SPAN, 0)
+        tbname = self.index.get_default_tablename()
+        yield from self.index.iterate(
+            f"SELECT {columns} FROM {tbname} WHERE id > ?;", (after,),
+            batch_size)
+
+    def max_id(self) -> int:
+        '''Largest id of a row, 0 if empty'''
+        tbname = self.index.get_default_tablename()
+        return self.index.read(
+            f"SELECT coalesce(max(id), 0) FROM {tbname};")[0][0]
+
+    def _get_labels(self) -> list:
+        '''Helper function: label columns in config order'''
+        labels = []
+        for key in self.config.get("labels", {}).keys():
+            for ele in self.config["labels"][key]:
+                if ele in labels or ele in BASE_COLUMNS:
+                    continue
+                if re.fullmatch(r"[A-Za-z_]\w*", ele) is None:
+                    self.log.warn(f"Skip: label {ele!r} is not a column name")
+                    continue
+                labels.append(ele)
+        return labels
+
+    def migrations(self) -> list:
+        '''Schema migrations, the n-th function upgrades version n to n+1'''
+        return [
+            self._migrate_contents,
+            self._migrate_tags,
+            self._migrate_epoch,
+            self._migrate_archive,
+            self._migrate_path,
+        ]
+
+    def _migrate_contents(self, db):
+        '''Version 1: contents table with indexed content hash'''
+        tbname = self.index.get_default_tablename()
+        self.index.init(tbname)
+        if "hash" not in self.index.get_columns(tbname):
+            db.execute(f"ALTER TABLE {tbname} ADD hash text;")
+        self.index.add_index(tbname, "hash")
+
+    def _migrate_tags(self, db):
+        '''Version 2: normalized tag table, filled from `tags` column'''
+        if self.index.has_table(TAG_TABLE):
+            return
+        tbname = self.index.get_default_tablename()
+        db.execute(f"""CREATE TABLE {TAG_TABLE} (
+                       file_id integer NOT NULL,
+                       key text NOT NULL,
+                       value text);""")
+        db.execute(f"""CREATE INDEX idx_{TAG_TABLE}_key_value
+                       ON {TAG_TABLE} (key, value, file_id);""")
+        db.execute(f"""CREATE INDEX idx_{TAG_TABLE}_value
+                       ON {TAG_TABLE} (value, file_id);""")
+        db.execute(f"""CREATE INDEX idx_{TAG_TABLE}_file_id
+                       ON {TAG_TABLE} (file_id);""")
+        rows = db.execute(f"""SELECT id, tags FROM {tbname}
+                              WHERE tags IS NOT NULL;""")
+        db.executemany(
+            f"INSERT INTO {TAG_TABLE} (file_id, key, value) "
+            f"VALUES (?, ?, ?);",
+            [(file_id,) + split_tag(tag)
+             for file_id, tags in rows.fetchall()
+             for tag in tags.split(',') if len(tag) > 0])
+
+    def _migrate_epoch(self, db):
+        '''Version 3: integer epoch time with covering time index'''
+        tbname = self.index.get_default_tablename()
+        if "epoch" not in self.index.get_columns(tbname):
+            db.execute(f"ALTER TABLE {tbname} ADD epoch integer;")
+        # datetime text is treated as UTC, same as to_epoch
+        db.execute(f"""UPDATE {tbname}
+                       SET epoch = CAST(strftime('%s', datetime) AS integer)
+                       WHERE epoch IS NULL;""")
+        db.execute(f"""CREATE INDEX IF NOT EXISTS idx_{tbname}_epoch
+                       ON {tbname} (epoch, datetime, path);""")
+
+    def _migrate_archive(self, db):
+        '''Version 4 (5 with netcdf): archive member columns'''
+        tbname = self.index.get_default_tablename()
+        columns = self.index.get_columns(tbname)
+        for column in ARCHIVE_COLUMNS:
+            if column not in columns:
+                db.execute(f"ALTER TABLE {tbname} ADD {column} integer;")
+        db.execute(f"""CREATE INDEX IF NOT EXISTS idx_{tbname}_member
+                       ON {tbname} (path) WHERE member_offset IS NOT NULL;""")
+
+    def _migrate_path(self, db):
+        '''
+        Version 5 (6 with netcdf): path index of find_files / find_member,
+        replaces the partial index of archived rows
+        '''
+        tbname = self.index.get_default_tablename()
+        db.execute(f"""CREATE INDEX IF NOT EXISTS idx_{tbname}_path
+                       ON {tbname} (path);""")
+        db.execute(f"DROP INDEX IF EXISTS idx_{tbname}_member;")
+
+    def _check_columns(self):
+        '''Add, fill and index label columns which are new in config'''
+        tbname = self.index.get_default_tablename()
+        db_columns = self.index.get_columns(tbname)
+        missing = [ele for ele in self.labels if ele not in db_columns]
+        if len(missing) == 0:
+            return
+
+        with self.index.transaction() as db:
+            for ele in missing:
+                dtype = "integer" if ele in TIME_LABELS else "text"
+                db.execute(f"ALTER TABLE {tbname} ADD {ele} {dtype};")
+                db.execute(f"""CREATE INDEX IF NOT EXISTS idx_{tbname}_{ele}
+                               ON {tbname} ({ele}, epoch);""")
+
+            # fill label columns of existing rows from their file name
+            pattern = re.compile(self.config["format"]) \
+                if "format" in self.config else None
+            filename = self.config.get("labels", {}).get("filename", [])
+            rows = db.execute(
+                f"SELECT id, datetime, path FROM {tbname};").fetchall()
+            values = []
+            for file_id, dt, path in rows:
+                found = pattern.match(Path(path).name) if pattern else None
+                groups = found.groupdict() if found else {}
+                record = []
+                for ele in missing:
+                    record.append(label_value(ele, groups.get(ele), dt)
+                                  if ele in filename or ele in TIME_LABELS
+                                  else None)
+                values.append(tuple(record) + (file_id,))
+            assign = ', '.join([f"{ele} = ?" for ele in missing])
+            db.executemany(f"UPDATE {tbname} SET {assign} WHERE id = ?;",
+                           values)
+
+    def find_hash(self, digest: str) -> None | str:
+        '''
+        Path of a stored file whose content hash is @digest, archived
+        files ("<container>::<member>") count while their container exists
+        '''
+        tbname = self.index.get_default_tablename()
+        rows = self.index.read(
+            f"SELECT path FROM {tbname} WHERE hash = ?;", (digest,))
+        for row in rows:
+            if os.path.exists(row[0].partition(ARCHIVE_SEP)[0]):
+                return row[0]
+        return None
+
+    def _build_query(self, meta: object) -> tuple:
+        '''Helper function: (selected columns, conditions, parameters)'''
+        if "parameter" not in meta or meta["parameter"] is None or\
+           meta["parameter"] == []:
+            parameter = "*"
+        else:
+            parameter = meta["parameter"]
+            if isinstance(parameter, list):
+                parameter = ','.join(parameter)
+
+        and_conditions = []
+        params = []
+        if "starttime" in meta and "endtime" in meta:
+            and_conditions.append('epoch between ? and ?')
+            params.extend([to_epoch(meta["starttime"]),
+                           to_epoch(meta["endtime"])])
+        elif "starttime" in meta:
+            and_conditions.append('epoch >= ?')
+            params.append(to_epoch(meta["starttime"]))
+        elif "endtime" in meta:
+            and_conditions.append('epoch <= ?')
+            params.append(to_epoch(meta["endtime"]))
+
+        for label, value in meta.get("labels", {}).items():
+            if label not in self.labels:
+                continue
+            if isinstance(value, (list, tuple)):
+                marks = ', '.join(['?'] * len(value))
+                and_conditions.append(f"{label} IN ({marks})")
+                params.extend([label_value(label, ele) for ele in value])
+            else:
+                and_conditions.append(f"{label} = ?")
+                params.append(label_value(label, value))
+
+        if "tags" in meta:
+            cond, tag_params = self._tags_condition(meta["tags"])
+            if cond is not None:
+                and_conditions.append(cond)
+                params.extend(tag_params)
+        return parameter, and_conditions, params
+
+    def can_match(self, meta: object) -> bool:
+        '''
+        False if no row of this cache can match @meta: it lacks requested
+        labels or columns, or its time span is out of the requested range
+        '''
+        for label in meta.get("labels", {}):
+            if label not in self.labels:
+                return False
+        parameter = meta.get("parameter")
+        if isinstance(parameter, str):
+            parameter = [ele.strip() for ele in parameter.split(',')]
+        for column in parameter or []:
+            if column != "id" and column not in self.columns and \
+               column not in ARCHIVE_COLUMNS:
+                return False
+
+        if "starttime" not in meta and "endtime" not in meta:
+            return True
+        tbname = self.index.get_default_tablename()
+        first, last = self.index.read(
+            f"SELECT min(epoch), max(epoch) FROM {tbname};")[0]
+        if first is None:
+            return False
+        if "starttime" in meta and last < to_epoch(meta["starttime"]):
+            return False
+        if "endtime" in meta and first > to_epoch(meta["endtime"]):
+            return False
+        return True
+
+    def search(self, meta: object) -> list:
+        '''search specified file by @meta data'''
+        tbname = self.index.get_default_tablename()
+        parameter, and_conditions, params = self._build_query(meta)
+
+        # combine all conditions
+        conditions = ""
+        if len(and_conditions) > 0:
+            tmp = ' and '.join(and_conditions)
+            conditions = f"where {tmp}"
+        query = f"SELECT {parameter} from {tbname} {conditions};"
+        return self.index.read(query, params)
+
+    def iter_search(self, meta: object, batch_size: int = DEFAULT_FETCH_SIZE,
+                    after: None | tuple = None, limit: None | int = None,
+                    order: str = "asc", cursor: None | list = None):
+        '''
+        Search specified file by @meta data, yield rows ordered by
+        (epoch, id) and fetched @batch_size rows at a time
+         @after: keyset cursor (datetime or epoch, id), rows after it
+         @limit: max number of rows
+         @order: "asc" or "desc"
+         @cursor: if given, set to [epoch, id] of the last yielded row
+        '''
+        tbname = self.index.get_default_tablename()
+        parameter, and_conditions, params = self._build_query(meta)
+        desc = order.lower() == "desc"
+        if after is not None:
+            and_conditions.append(
+                f"(epoch, id) {'<' if desc else '>'} (?, ?)")
+            params.extend([to_epoch(after[0]), int(after[1])])
+
+        conditions = ""
+        if len(and_conditions) > 0:
+            conditions = f"where {' and '.join(and_conditions)}"
+        direction = "DESC" if desc else "ASC"
+        query = f"""SELECT epoch, id, {parameter} from {tbname} {conditions}
+                    ORDER BY epoch {direction}, id {direction}"""
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(int(limit))
+
+        for rows in self.index.iterate(query + ";", params, batch_size):
+            for row in rows:
+                if cursor is not None:
+                    cursor[:] = [row[0], row[1]]
+                yield row[2:]
+
+    def page(self, meta: object, after: None | tuple = None,
+             limit: int = DEFAULT_PAGE_SIZE, order: str = "asc") -> tuple:
+        '''
+        One page of search result
+        Return (rows, cursor of next page or None if no more rows)
+        '''
+        cursor = []
+        rows = list(self.iter_search(meta, limit, after, limit, order,
+                                     cursor))
+        if len(rows) < limit:
+            return rows, None
+        return rows, tuple(cursor)
+
+    def _tags_condition(self, tags: str | list | dict) -> tuple:
+        '''
+        Helper function: contents condition of tag query, which is
+         - "a,b" or ["a", "b"]: file has any of the tags
+         - {"any": [...], "all": [...]}: any of `any` and all of `all`
+        Return (condition or None, parameters)
+        '''
+        if isinstance(tags, str):
+            tags = {"any": tags.split(',')}
+        elif isinstance(tags, (list, tuple)):
+            tags = {"any": tags}
+        elif not isinstance(tags, dict):
+            return None, []
+
+        groups = []
+        if tags.get("any"):
+            groups.append(tags["any"])
+        groups.extend([[tag] for tag in tags.get("all", [])])
+
+        conditions = []
+        params = []
+        for group in groups:
+            terms = [tag_condition(tag) for tag in group]
+            tmp = ' or '.join([term[0] for term in terms])
+            conditions.append(
+                f"id IN (SELECT file_id FROM {TAG_TABLE} WHERE {tmp})")
+            for term in terms:
+                params.extend(term[1])
+        if len(conditions) == 0:
+            return None, []
+        return ' and '.join(conditions), params
+
+    def make_record(self, file: str | Path, cfg: dict,
+                    tags: None | list = None,
+                    match: None | re.Match = None,
+                    digest: None | str = None) -> tuple:
+        '''
+        Build the row of @file, values are in order of Cache.columns:
+        (datetime, path, tags, hash, epoch, *labels)
+         @match: rule match result reused instead of matching file name again
+         @digest: content hash of @file
+        '''
+        file = file if isinstance(file, Path) else Path(file)
+        finder = match if match is not None else\
+            re.match(cfg["format"], file.name)
+
+        # We known that year, month, and day in the file
+        groups = finder.groupdict().keys()
+        current_time = datetime.datetime.now()
+        year = int(finder.group("year")) if "year" in groups\
+            else current_time.year
+        month = int(finder.group("month")) if "month" in groups\
+            else current_time.month
+        day = int(finder.group("day")) if "day" in groups else current_time.day
+        hour = int(finder.group("hour")) if "hour" in groups else 0
+        minute = int(finder.group("minute")) if "minute" in groups else 0
+        second = int(finder.group("second")) if "second" in groups else 0
+
+        moment = datetime.datetime(year, month, day, hour, minute, second)
+        dt = moment.strftime(TIMEFORMAT)
+        tag = ','.join(tags) if tags is not None and len(tags) > 0 else None
+
+        values = finder.groupdict()
+        filename = cfg.get("labels", {}).get("filename", [])
+        labels = tuple([label_value(ele, values.get(ele), dt)
+                        if ele in filename or ele in TIME_LABELS else None
+                        for ele in self.labels])
+        return (dt, str(file.absolute()), tag, digest, to_epoch(moment)) + \
+            labels
+
+    def insert_records(self, records: list,
+                       batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+        '''Insert rows built by make_record, one transaction per batch'''
+        tbname = self.index.get_default_tablename()
+        marks = ', '.join(['?'] * len(self.columns))
+        query = f"""INSERT INTO {tbname} ({', '.join(self.columns)})
+                    VALUES ({marks});"""
+        tag_query = f"""INSERT INTO {TAG_TABLE} (file_id, key, value)
+                        VALUES (?, ?, ?);"""
+        batch_size = max(1, batch_size)
+        for i in range(0, len(records), batch_size):
+            batch = records[i:i + batch_size]
+            with self.index.transaction() as db:
+                # ids of one executemany in a write transaction are sequential
+                first = self._next_id(db)
+                if first <= self.id_base:
+                    self._set_sequence(db, self.id_base)
+                    first = self.id_base + 1
+                db.executemany(query, batch)
+                db.executemany(tag_query, [
+                    (first + n,) + split_tag(tag)
+                    for n, record in enumerate(batch) if record[2]
+                    for tag in record[2].split(',') if len(tag) > 0])
+            for listener in self.listeners:
+                listener([record[4] for record in batch])
+        return len(records)
+
+    def delete_records(self, ids: list,
+                       batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+        '''Delete rows of @ids and their tags, one transaction per batch'''
+        tbname = self.index.get_default_tablename()
+        batch_size = max(1, batch_size)
+        for i in range(0, len(ids), batch_size):
+            batch = list(ids[i:i + batch_size])
+            marks = ', '.join(['?'] * len(batch))
+            with self.index.transaction() as db:
+                epochs = [row[0] for row in db.execute(
+                    f"SELECT epoch FROM {tbname} WHERE id IN ({marks});",
+                    batch)]
+                db.execute(f"DELETE FROM {TAG_TABLE} "
+                           f"WHERE file_id IN ({marks});", batch)
+                db.execute(f"DELETE FROM {tbname} WHERE id IN ({marks});",
+                           batch)
+            for listener in self.listeners:
+                listener(epochs)
+        return len(ids)
+
+    def set_members(self, members: list,
+                    batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+        '''
+        Point rows at archive members, one transaction per batch
+         @members: list of (id, path, offset, size, method)
+        '''
+        tbname = self.index.get_default_tablename()
+        query = f"""UPDATE {tbname} SET path = ?, member_offset = ?,
+                    member_size = ?, member_method = ? WHERE id = ?;"""
+        batch_size = max(1, batch_size)
+        for i in range(0, len(members), batch_size):
+            batch = members[i:i + batch_size]
+            marks = ', '.join(['?'] * len(batch))
+            with self.index.transaction() as db:
+                epochs = [row[0] for row in db.execute(
+                    f"SELECT epoch FROM {tbname} WHERE id IN ({marks});",
+                    [member[0] for member in batch])]
+                db.executemany(query, [tuple(member[1:]) + (member[0],)
+                                       for member in batch])
+            for listener in self.listeners:
+                listener(epochs)
+        return len(members)
+
+    def find_member(self, path: str) -> None | tuple:
+        '''(offset, size, method) of archived @path, None if not archived'''
+        tbname = self.index.get_default_tablename()
+        rows = self.index.read(
+            f"""SELECT member_offset, member_size, member_method FROM {tbname}
+                WHERE path = ? AND member_offset IS NOT NULL;""", (path,))
+        return tuple(rows[0]) if len(rows) > 0 else None
+
+    def find_files(self, keys: list, column: str = "id",
+                   batch_size: int = DEFAULT_BATCH_SIZE) -> dict:
+        '''
+        {key: (path, epoch, member)} of the rows whose @column ("id" or
+        "path") is in @keys, member is (offset, size, method) of archived
+        files, else None
+        '''
+        tbname = self.index.get_default_tablename()
+        keys = list(dict.fromkeys(keys))
+        batch_size = max(1, batch_size)
+        files = {}
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            marks = ', '.join(['?'] * len(batch))
+            rows = self.index.read(
+                f"""SELECT {column}, path, epoch, member_offset, member_size,
+                    member_method FROM {tbname}
+                    WHERE {column} IN ({marks});""", batch)
+            for key, path, epoch, *member in rows:
+                files[key] = (path, epoch,
+                              tuple(member) if member[0] is not None
+                              else None)
+        return files
+
+    def _next_id(self, db) -> int:
+        '''Helper function: id of the next inserted contents row'''
+        tbname = self.index.get_default_tablename()
+        row = db.execute(f"""SELECT max(
+            coalesce((SELECT seq FROM sqlite_sequence WHERE name = ?), 0),
+            coalesce((SELECT max(id) FROM {tbname}), 0));""", (tbname,))
+        return row.fetchone()[0] + 1
+
+    def _set_sequence(self, db, value: int):
+        '''Helper function: next autoincrement id is @value + 1'''
+        tbname = self.index.get_default_tablename()
+        cur = db.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = ?;",
+                         (value, tbname))
+        if cur.rowcount == 0:
+            db.execute("INSERT INTO sqlite_sequence (name, seq) "
+                       "VALUES (?, ?);", (tbname, value))
+
+    def add_cache(self, file: str | Path, cfg: dict, tags: None | list = None,
+                  match: None | re.Match = None, digest: None | str = None):
+        '''Add file meta data'''
+        self.insert_records([self.make_record(file, cfg, tags, match, digest)])
+
+    def add_cache_many(self, files: list, cfg: dict,
+                       tags: None | list | dict = None,
+                       batch_size: int = DEFAULT_BATCH_SIZE,
+                       matches: None | dict = None,
+                       digests: None | dict = None) -> int:
+        '''
+        Add meta data of many files with batched transactions
+         @tags: one tags list for all files, or a dict of file -> tags list
+         @matches: dict of file -> rule match result
+         @digests: dict of file -> content hash
+        '''
+        records = []
+        matches = {} if matches is None else matches
+        digests = {} if digests is None else digests
+        for file in files:
+            file_tags = tags.get(file) if isinstance(tags, dict) else tags
+            records.append(self.make_record(file, cfg, file_tags,
+                                            matches.get(file),
+                                            digests.get(file)))
+        return self.insert_records(records, batch_size)
@@ -0,0 +1,397 @@
+'''
+The NetCDF version of File Database plugin
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import os
+import re
+import json
+import struct
+import datetime
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from plugins import general
+from lib.log import SystemLog
+
+DEFAULT_WORKERS = 4
+NETCDF_COLUMNS = ["time_start", "time_end", "header"]
+HDF5_MAGIC = b"\x89HDF\r\n\x1a\n"
+STREAMING = 0xFFFFFFFF
+
+NC_DIMENSION = 0x0A
+NC_VARIABLE = 0x0B
+NC_ATTRIBUTE = 0x0C
+# nc_type -> (name, struct format, size)
+NC_TYPES = {
+    1: ("byte", "b", 1),
+    2: ("char", "c", 1),
+    3: ("short", "h", 2),
+    4: ("int", "i", 4),
+    5: ("float", "f", 4),
+    6: ("double", "d", 8),
+    7: ("ubyte", "B", 1),
+    8: ("ushort", "H", 2),
+    9: ("uint", "I", 4),
+    10: ("int64", "q", 8),
+    11: ("uint64", "Q", 8),
+}
+FORMATS = {1: "classic", 2: "64bit_offset", 5: "64bit_data"}
+TIME_UNITS = {
+    "second": 1, "seconds": 1, "sec": 1, "secs": 1, "s": 1,
+    "minute": 60, "minutes": 60, "min": 60, "mins": 60,
+    "hour": 3600, "hours": 3600, "hr": 3600, "hrs": 3600, "h": 3600,
+    "day": 86400, "days": 86400, "d": 86400,
+}
+
+
+class _Header:
+    '''Reader of a classic / 64-bit offset / 64-bit data NetCDF header'''
+    def __init__(self, f, version: int):
+        self.f = f
+        self.version = version
+        self.size = 8 if version == 5 else 4       # NON_NEG
+        self.offset = 4 if version == 1 else 8     # OFFSET
+
+    def read(self, size: int) -> bytes:
+        data = self.f.read(size)
+        if len(data) != size:
+            raise ValueError("truncated NetCDF header")
+        return data
+
+    def uint(self, size: int) -> int:
+        return int.from_bytes(self.read(size), "big")
+
+    def name(self) -> str:
+        size = self.uint(self.size)
+        data = self.read(size)
+        self.read(-size % 4)
+        return data.decode("utf-8", "replace")
+
+    def values(self, nc_type: int, count: int):
+        name, fmt, size = NC_TYPES[nc_type]
+        data = self.read(count * size)
+        self.read(-count * size % 4)
+        if name == "char":
+            return data.rstrip(b"\x00").decode("utf-8", "replace")
+        values = list(struct.unpack(f">{count}{fmt}", data))
+        return values[0] if count == 1 else values
+
+    def items(self, tag: int) -> int:
+        found, count = self.uint(4), self.uint(self.size)
+        if found == 0 and count == 0:
+            return 0
+        if found != tag:
+            raise ValueError(f"bad NetCDF header tag {found:#x}")
+        return count
+
+    def attributes(self) -> dict:
+        attrs = {}
+        for _ in range(self.items(NC_ATTRIBUTE)):
+            name = self.name()
+            nc_type = self.uint(4)
+            attrs[name] = self.values(nc_type, self.uint(self.size))
+        return attrs
+
+
+def _parse_units(units: str) -> None | tuple:
+    '''Helper function: "<unit> since <time>" -> (seconds, epoch of time)'''
+    found = re.fullmatch(r"\s*(\w+)\s+since\s+(.+?)\s*", str(units))
+    if found is None or found.group(1).lower() not in TIME_UNITS:
+        return None
+    reference = _parse_time(found.group(2))
+    if reference is None:
+        return None
+    return TIME_UNITS[found.group(1).lower()], reference
+
+
+def _parse_time(value) -> None | int:
+    '''Helper function: epoch of a CF/ISO time string, None if unknown'''
+    text = re.sub(r"\s*(UTC|GMT|Z)$", "", str(value).strip())
+    text = re.sub(r"^(\d+)-(\d+)-(\d+)", lambda m: "%04d-%02d-%02d" % tuple(
+        int(ele) for ele in m.groups()), text)
+    try:
+        return general.to_epoch(datetime.datetime.fromisoformat(text))
+    except ValueError:
+        return None
+
+
+def _coverage(meta: dict, values) -> tuple:
+    '''Helper function: (time_start, time_end) from attributes or @values'''
+    attrs = meta["attributes"]
+    if "time_coverage_start" in attrs and "time_coverage_end" in attrs:
+        start = _parse_time(attrs["time_coverage_start"])
+        end = _parse_time(attrs["time_coverage_end"])
+        if start is not None and end is not None:
+            return start, end
+
+    for name, var in meta["variables"].items():
+        units = _parse_units(var["attributes"].get("units", ""))
+        if var["dimensions"] != [name] or units is None:
+            continue
+        found = values(name)
+        if found is None:
+            return None, None
+        scale, reference = units
+        first, last = [int(reference + ele * scale) for ele in found]
+        return min(first, last), max(first, last)
+    return None, None
+
+
+def read_classic(path: str | Path) -> dict:
+    '''
+    Metadata of a classic format NetCDF file, read from its header only.
+    Besides the header, only the first and last value of the time
+    coordinate variable are read for the time coverage.
+    '''
+    with open(path, "rb") as f:
+        magic = f.read(4)
+        if magic[:3] != b"CDF" or magic[3] not in FORMATS:
+            raise ValueError(f"{path} is not a classic NetCDF file")
+        header = _Header(f, magic[3])
+        numrecs = header.uint(header.size)
+
+        dimensions = {}
+        for _ in range(header.items(NC_DIMENSION)):
+            name = header.name()
+            dimensions[name] = header.uint(header.size)
+        records = [name for name, size in dimensions.items() if size == 0]
+        if numrecs != STREAMING:
+            for name in records:
+                dimensions[name] = numrecs
+
+        attributes = header.attributes()
+        variables = {}
+        layout = {}
+        recsize = 0
+        for _ in range(header.items(NC_VARIABLE)):
+            name = header.name()
+            dimids = [header.uint(header.size)
+                      for _ in range(header.uint(header.size))]
+            dims = list(dimensions.keys())
+            var_dims = [dims[idx] for idx in dimids]
+            var_attrs = header.attributes()
+            nc_type = header.uint(4)
+            vsize = header.uint(header.size)
+            begin = header.uint(header.offset)
+            variables[name] = {"type": NC_TYPES[nc_type][0],
+                               "dimensions": var_dims,
+                               "attributes": var_attrs}
+            record = len(var_dims) > 0 and var_dims[0] in records
+            layout[name] = (nc_type, begin, record)
+            if record:
+                recsize += vsize
+        if sum(entry[2] for entry in layout.values()) == 1:
+            # a single record variable is not padded
+            for name, (nc_type, _, record) in layout.items():
+                if record:
+                    dims = variables[name]["dimensions"]
+                    recsize = NC_TYPES[nc_type][2]
+                    for dim in dims[1:]:
+                        recsize *= dimensions[dim]
+
+        meta = {"format": FORMATS[magic[3]], "dimensions": dimensions,
+                "attributes": attributes, "variables": variables}
+
+        def values(name):
+            nc_type, begin, record = layout[name]
+            _, fmt, size = NC_TYPES[nc_type]
+            count = dimensions[variables[name]["dimensions"][0]]
+            if NC_TYPES[nc_type][0] == "char" or count in (0, STREAMING):
+                return None
+            step = recsize if record else size
+            found = []
+            for offset in (begin, begin + (count - 1) * step):
+                f.seek(offset)
+                data = f.read(size)
+                if len(data) != size:
+                    return None
+                found.append(struct.unpack(f">{fmt}", data)[0])
+            return found
+
+        meta["time_start"], meta["time_end"] = _coverage(meta, values)
+    return meta
+
+
+def read_netcdf4(path: str | Path) -> dict:
+    '''Metadata of a NetCDF-4 (HDF5) file, needs the optional netCDF4'''
+    try:
+        import netCDF4
+    except ImportError:
+        return {"format": "netcdf4", "dimensions": {}, "attributes": {},
+                "variables": {}, "time_start": None, "time_end": None}
+
+    def plain(value):
+        if hasattr(value, "tolist"):
+            return value.tolist()
+        return value
+
+    with netCDF4.Dataset(path) as dataset:
+        meta = {
+            "format": dataset.data_model.lower(),
+            "dimensions": {name: len(dim)
+                           for name, dim in dataset.dimensions.items()},
+            "attributes": {name: plain(dataset.getncattr(name))
+                           for name in dataset.ncattrs()},
+            "variables": {
+                name: {"type": str(var.dtype),
+                       "dimensions": list(var.dimensions),
+                       "attributes": {key: plain(var.getncattr(key))
+                                      for key in var.ncattrs()}}
+                for name, var in dataset.variables.items()},
+        }
+
+        def values(name):
+            var = dataset.variables[name]
+            if var.size == 0:
+                return None
+            var.set_auto_mask(False)
+            return [float(var[0]), float(var[-1])]
+
+        meta["time_start"], meta["time_end"] = _coverage(meta, values)
+    return meta
+
+
+def read_metadata(path: str | Path) -> dict:
+    '''Header metadata of a NetCDF file of any format'''
+    with open(path, "rb") as f:
+        magic = f.read(8)
+    if magic == HDF5_MAGIC:
+        return read_netcdf4(path)
+    return read_classic(path)
+
+
+def _safe_metadata(path: str) -> dict:
+    '''Helper function: read_metadata which reports errors in the result'''
+    try:
+        return read_metadata(path)
+    except (OSError, ValueError, KeyError, IndexError, struct.error) as err:
+        return {"error": f"{type(err).__name__}: {err}"}
+
+
+def _column_value(value):
+    '''Helper function: attribute value stored in a label column'''
+    if isinstance(value, (list, tuple)):
+        return json.dumps(value)
+    return value
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def _pool(workers: int) -> ProcessPoolExecutor:
+    '''Helper function: process pool shared by all netcdf caches'''
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            # spawn: the parent has sqlite connections and worker threads
+            _POOL = ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context("spawn"))
+        return _POOL
+
+
+class Cache(general.Cache):
+    '''
+    NetCDF plugin: general cache with header metadata
+
+    Columns `time_start` / `time_end` hold the epoch time coverage and
+    `header` holds dimensions, attributes and variables as JSON. Labels of
+    `labels.metadata` are filled from the global attributes of the same
+    name. Headers of a batch are read in a process pool of `netcdf.workers`
+    processes.
+    '''
+    def __init__(self, cfg: dict, lazy: bool = False):
+        super().__init__(cfg, lazy)
+        self.columns = self.columns + NETCDF_COLUMNS
+        self.metadata = self.config.get("labels", {}).get("metadata", [])
+        self.workers = self.config.get("netcdf", {}).get("workers",
+                                                          DEFAULT_WORKERS)
+        self.log = SystemLog("NetCDF", True)
+
+    def _get_labels(self) -> list:
+        '''Helper function: label columns, without netcdf columns'''
+        return [label for label in super()._get_labels()
+                if label not in NETCDF_COLUMNS]
+
+    def migrations(self) -> list:
+        '''General schema migrations with the netcdf one as version 4'''
+        migrations = super().migrations()
+        return migrations[:3] + [self._migrate_netcdf] + migrations[3:]
+
+    def _migrate_netcdf(self, db):
+        '''Version 4: time coverage and header columns'''
+        tbname = self.index.get_default_tablename()
+        columns = self.index.get_columns(tbname)
+        for column, dtype in zip(NETCDF_COLUMNS, ["integer", "integer",
+                                                  "text"]):
+            if column not in columns:
+                db.execute(f"ALTER TABLE {tbname} ADD {column} {dtype};")
+        db.execute(f"""CREATE INDEX IF NOT EXISTS idx_{tbname}_coverage
+                       ON {tbname} (time_start, time_end);""")
+
+    def _build_query(self, meta: object) -> tuple:
+        '''
+        Besides general meta, "coverage": (start, end) selects files whose
+        time coverage overlaps the range
+        '''
+        parameter, and_conditions, params = super()._build_query(meta)
+        if meta.get("coverage") is not None:
+            start, end = meta["coverage"]
+            and_conditions.append("time_start <= ? and time_end >= ?")
+            params.extend([general.to_epoch(end), general.to_epoch(start)])
+        return parameter, and_conditions, params
+
+    def read_headers(self, paths: list) -> list:
+        '''Metadata of @paths, read in the process pool if there are many'''
+        if len(paths) < 2 or self.workers <= 1:
+            return [_safe_metadata(path) for path in paths]
+        return list(_pool(self.workers).map(_safe_metadata, paths))
+
+    def make_record(self, file: str | Path, cfg: dict,
+                    tags: None | list = None,
+                    match: None | re.Match = None,
+                    digest: None | str = None,
+                    header: None | dict = None) -> tuple:
+        '''
+        General record followed by (time_start, time_end, header)
+         @header: metadata of @file if it is already read
+        '''
+        record = super().make_record(file, cfg, tags, match, digest)
+        if header is None:
+            header = _safe_metadata(str(file))
+        if "error" in header:
+            self.log.warn(f"Skip: header of {file}, {header['error']}")
+
+        attrs = header.get("attributes", {})
+        record = record[:5] + tuple(
+            _column_value(attrs[label])
+            if label in self.metadata and label in attrs else value
+            for label, value in zip(self.labels, record[5:]))
+        return record + (header.get("time_start"), header.get("time_end"),
+                         json.dumps(header, default=str))
+
+    def add_cache(self, file: str | Path, cfg: dict, tags: None | list = None,
+                  match: None | re.Match = None, digest: None | str = None):
+        '''Add file meta data'''
+        self.insert_records([self.make_record(file, cfg, tags, match, digest)])
+
+    def add_cache_many(self, files: list, cfg: dict,
+                       tags: None | list | dict = None,
+                       batch_size: int = general.DEFAULT_BATCH_SIZE,
+                       matches: None | dict = None,
+                       digests: None | dict = None) -> int:
+        '''Add meta data of many files, headers are read in parallel'''
+        matches = {} if matches is None else matches
+        digests = {} if digests is None else digests
+        headers = self.read_headers([str(file) for file in files])
+        records = []
+        for file, header in zip(files, headers):
+            file_tags = tags.get(file) if isinstance(tags, dict) else tags
+            records.append(self.make_record(file, cfg, file_tags,
+                                            matches.get(file),
+                                            digests.get(file), header))
+        return self.insert_records(records, batch_size)
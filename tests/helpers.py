@@ -0,0 +1,57 @@
+'''
+Test helpers
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+
+class FileDBTestCase(unittest.TestCase):
+    '''
+    FileDB on a fresh root, inbox and config (rules of the repository
+    config.json) in a temporary directory for every test
+    '''
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="filedb-test-")
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.inbox = os.path.join(self.tmp, "inbox")
+        os.makedirs(self.inbox)
+        with open(ROOT / "config.json", encoding="utf-8") as f:
+            cfg = json.load(f)
+        cfg["root"] = os.path.join(self.tmp, "out")
+        self.configure(cfg)
+        self.config = os.path.join(self.tmp, "config.json")
+        with open(self.config, "w", encoding="utf-8") as f:
+            json.dump(cfg, f)
+        self._db = None
+
+    def configure(self, cfg: dict):
+        '''Change the test config before it is written'''
+
+    @property
+    def db(self):
+        '''FileDB of the test config, created on first use'''
+        if self._db is None:
+            from main import FileDB
+            self._db = FileDB(self.config)
+        return self._db
+
+    def make(self, name: str, content: str | bytes = "1,2,3\n") -> str:
+        '''Write inbox file @name, return its path'''
+        path = os.path.join(self.inbox, name)
+        mode = "wb" if isinstance(content, bytes) else "w"
+        with open(path, mode) as f:
+            f.write(content)
+        return path
@@ -0,0 +1,80 @@
+'''
+Adding files: rule match, destination and row
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import os
+import unittest
+from tests.helpers import FileDBTestCase
+from lib.ingest import AddStatus
+
+
+class FailedMoveTest(FileDBTestCase):
+    '''Files which can not be moved into root get no row'''
+    def paths(self) -> list:
+        return [row[0] for row in self.db.search("general",
+                                                 {"parameter": ["path"]})]
+
+    def test_add_many_missing_file(self):
+        good = self.make("data_2001_01_02.csv")
+        missing = os.path.join(self.inbox, "missing_2001_01_01.txt")
+        report = self.db.add_many([missing, good])
+        self.assertEqual(report[missing], AddStatus.FAILED)
+        self.assertEqual(report[good], AddStatus.ADDED)
+        paths = self.paths()
+        self.assertEqual(len(paths), 1)
+        self.assertTrue(paths[0].endswith("data_2001_01_02.csv"))
+        self.assertTrue(os.path.exists(paths[0]))
+
+    def test_add_missing_file(self):
+        missing = os.path.join(self.inbox, "missing_2001_01_01.txt")
+        with self.assertRaises(OSError):
+            self.db.add(missing)
+        self.assertEqual(self.paths(), [])
+
+
+class DatedDirectoryTest(FileDBTestCase):
+    '''Dates of the source directories are not the file datetime'''
+    def make_dated(self, name: str) -> str:
+        folder = os.path.join(self.inbox, "2019_05_05")
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, name)
+        with open(path, "w") as f:
+            f.write("1,2,3\n")
+        return path
+
+    def check(self, name: str, status: AddStatus):
+        self.assertEqual(status, AddStatus.ADDED)
+        rows = self.db.search("general", {"parameter": ["datetime", "path",
+                                                        "year", "day"]})
+        self.assertEqual(len(rows), 1)
+        dt, path, year, day = rows[0]
+        self.assertEqual(dt, "2022-01-30 00:00:00")
+        self.assertEqual((year, day), (2022, 30))
+        self.assertEqual(path, os.path.join(self.tmp, "out", "general",
+                                            "2022", "01", "30", name))
+        self.assertTrue(os.path.exists(path))
+
+    def test_add(self):
+        name = "hello_2022_01_30_x.txt"
+        self.check(name, self.db.add(self.make_dated(name)))
+
+    def test_add_many(self):
+        name = "hello_2022_01_30_x.txt"
+        path = self.make_dated(name)
+        self.check(name, self.db.add_many([path])[path])
+
+    def test_ingest(self):
+        name = "hello_2022_01_30_x.txt"
+        path = self.make_dated(name)
+        self.check(name, self.db.ingest([path])[path])
+
+    def test_name_without_date(self):
+        path = self.make_dated("readme.txt")
+        self.assertEqual(self.db.add(path), AddStatus.UNKNOWN)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+'''
+asyncio facade of FileDB
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import asyncio
+import unittest
+from tests.helpers import FileDBTestCase
+
+
+class AsyncIterSearchTest(FileDBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db.add_many([self.make(f"data_2001_{month:02d}_{day:02d}.csv")
+                          for month in range(1, 6)
+                          for day in range(1, 11)])
+
+    async def collect(self, adb, **kwargs) -> list:
+        return [row async for row in adb.iter_search(
+            "general", {"parameter": ["path"]}, **kwargs)]
+
+    def run_streams(self, count: int, **kwargs) -> list:
+        from main import AsyncFileDB
+
+        async def main():
+            async with AsyncFileDB(self.db) as adb:
+                return await asyncio.wait_for(asyncio.gather(
+                    *[self.collect(adb, **kwargs) for _ in range(count)]),
+                    30)
+        return asyncio.run(main())
+
+    def test_more_streams_than_read_connections(self):
+        expected = [row[0] for row in self.db.iter_search(
+            "general", {"parameter": ["path"]})]
+        self.assertEqual(len(expected), 50)
+        for rows in self.run_streams(12, batch_size=2):
+            self.assertEqual([row[0] for row in rows], expected)
+
+    def test_limit_after_and_order(self):
+        rows = self.run_streams(1, batch_size=3, limit=7, order="desc")[0]
+        expected = list(self.db.iter_search(
+            "general", {"parameter": ["path"]}, limit=7, order="desc"))
+        self.assertEqual([tuple(row) for row in rows],
+                         [tuple(row) for row in expected])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+'''
+General plugin cache schema
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import json
+import unittest
+from unittest import mock
+from tests.helpers import FileDBTestCase
+from lib.log import SystemLog
+
+
+class LabelTest(FileDBTestCase):
+    def configure(self, cfg: dict):
+        cfg["rules"]["general"]["labels"]["metadata"] = ["station", "bad-name"]
+
+    def test_invalid_label_is_logged_and_skipped(self):
+        from plugins.general import Cache
+        with open(self.config, encoding="utf-8") as f:
+            config = json.load(f)
+        cfg = dict(config["rules"]["general"], root=config["root"])
+        with mock.patch.object(SystemLog, "warn") as warn:
+            cache = Cache(cfg, lazy=True)
+        self.assertEqual(cache.labels, ["year", "month", "day", "station"])
+        warn.assert_called_once()
+        self.assertIn("bad-name", warn.call_args.args[0])
+
+
+class PathIndexTest(FileDBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db.add_many([self.make(f"data_2001_01_{day:02d}.csv")
+                          for day in range(1, 6)])
+        self.cache = self.db.groups["general"]["db"]
+
+    def test_find_files_by_path_uses_the_index(self):
+        tbname = self.cache.index.get_default_tablename()
+        plan = self.cache.index.read(
+            f"""EXPLAIN QUERY PLAN SELECT path, epoch FROM {tbname}
+                WHERE path IN (?, ?);""", ("a", "b"))
+        self.assertTrue(any(f"idx_{tbname}_path" in row[-1] for row in plan))
+        self.assertFalse(any(row[-1].startswith("SCAN") for row in plan))
+
+    def test_find_files_by_path(self):
+        rows = self.cache.search({"parameter": ["path"]})
+        paths = [row[0] for row in rows]
+        files = self.cache.find_files(paths + ["missing"], "path",
+                                      batch_size=2)
+        self.assertEqual(sorted(files), sorted(paths))
+        self.assertTrue(all(member is None
+                            for _, _, member in files.values()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,27 @@
+'''
+Batched ingest through the rule writers
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import unittest
+from tests.helpers import FileDBTestCase
+from lib.ingest import AddStatus
+
+
+class IngestTest(FileDBTestCase):
+    def test_ingest_reuses_the_rule_cache(self):
+        opened = []
+        open_cache = self.db.open_cache
+        self.db.open_cache = lambda *args: \
+            opened.append(args[0]) or open_cache(*args)
+        for day in range(1, 4):
+            report = self.db.ingest([self.make(f"data_2001_01_0{day}.csv")])
+            self.assertEqual(list(report.values()), [AddStatus.ADDED])
+        self.assertEqual(opened, ["general"])
+        self.assertEqual(len(self.db.search("general", {})), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+'''
+Bulk loading of search results
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import unittest
+from tests.helpers import FileDBTestCase
+from lib.error import GeneralException
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+@unittest.skipIf(np is None, "numpy is needed for bulk loading")
+class BulkLoadTest(FileDBTestCase):
+    def setUp(self):
+        super().setUp()
+        for day in [3, 1, 2]:
+            self.db.add(self.make(f"data_2001_01_0{day}.csv",
+                                  f"{day},1\n{day},2\n"))
+
+    def check(self, frame):
+        self.assertEqual(frame.counts.tolist(), [2, 2, 2])
+        self.assertEqual(frame.values[:, 0].tolist(), [1, 1, 2, 2, 3, 3])
+        self.assertEqual(frame.epochs.tolist(), sorted(frame.epochs))
+
+    def test_load_by_meta(self):
+        self.check(self.db.load("general", {}))
+
+    def test_load_default_search_rows(self):
+        self.check(self.db.load("general", rows=self.db.search("general",
+                                                                {})))
+
+    def test_load_path_rows(self):
+        rows = self.db.search("general", {"parameter": ["path", "epoch"]})
+        self.check(self.db.load("general", rows=rows))
+        self.check(self.db.load("general", rows=[row[0] for row in rows]))
+
+    def test_load_archived_rows(self):
+        self.db.archive("general", "2001")
+        rows = self.db.search("general", {})
+        self.assertIn("::", rows[0][2])
+        self.check(self.db.load("general", rows=rows))
+
+    def test_rejects_unknown_rows(self):
+        with self.assertRaises(GeneralException):
+            self.db.load("general", rows=[("2001-01-01", "x")])
+        with self.assertRaises(GeneralException):
+            self.db.load("general", rows=["/nowhere/data_2001_01_01.csv"])
+
+
+class PartitionedBulkLoadTest(BulkLoadTest):
+    def configure(self, cfg: dict):
+        cfg["rules"]["general"]["partition"] = "month"
+
+    def setUp(self):
+        super().setUp()
+        self.db.add(self.make("data_2001_02_01.csv", "4,1\n4,2\n"))
+
+    def check(self, frame):
+        self.assertEqual(frame.counts.tolist(), [2, 2, 2, 2])
+        self.assertEqual(frame.values[:, 0].tolist(),
+                         [1, 1, 2, 2, 3, 3, 4, 4])
+
+
+if __name__ == "__main__":
+    unittest.main()
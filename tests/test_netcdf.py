@@ -0,0 +1,247 @@
+'''
+NetCDF header reader and plugin
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from unittest import mock
+from tests.helpers import FileDBTestCase
+from plugins.netcdf import read_classic, read_metadata, NC_TYPES
+
+NC_CODES = {name: code for code, (name, _, _) in NC_TYPES.items()}
+HOURS = "hours since 2001-1-1 00:00:00"
+EPOCH_2001 = 978307200
+
+
+def _pad(data: bytes) -> bytes:
+    return data + b"\0" * (-len(data) % 4)
+
+
+class NetCDFWriter:
+    '''Classic (1), 64-bit offset (2) or 64-bit data (5) NetCDF file'''
+    def __init__(self, version: int = 1):
+        self.version = version
+        self.size = ">q" if version == 5 else ">i"
+        self.offset = ">i" if version == 1 else ">q"
+        self.dims = []
+        self.attrs = {}
+        self.variables = []
+
+    def dim(self, name: str, size: int):
+        '''Dimension, size 0 is the unlimited record dimension'''
+        self.dims.append((name, size))
+
+    def var(self, name: str, dims: list, dtype: str, values: list,
+            attrs: None | dict = None):
+        self.variables.append((name, dims, dtype, values, attrs or {}))
+
+    def _int(self, value: int) -> bytes:
+        return struct.pack(self.size, value)
+
+    def _name(self, text: str) -> bytes:
+        data = text.encode()
+        return self._int(len(data)) + _pad(data)
+
+    def _values(self, dtype: str, values) -> bytes:
+        if dtype == "char":
+            return values.encode()
+        fmt = NC_TYPES[NC_CODES[dtype]][1]
+        return struct.pack(f">{len(values)}{fmt}", *values)
+
+    def _attrs(self, attrs: dict) -> bytes:
+        if len(attrs) == 0:
+            return struct.pack(">i", 0) + self._int(0)
+        data = struct.pack(">i", 0x0C) + self._int(len(attrs))
+        for name, value in attrs.items():
+            dtype = "char" if isinstance(value, str) else \
+                "double" if isinstance(value, float) else "int"
+            count = len(value) if isinstance(value, str) else 1
+            values = value if isinstance(value, str) else [value]
+            data += self._name(name) + struct.pack(">i", NC_CODES[dtype]) + \
+                self._int(count) + _pad(self._values(dtype, values))
+        return data
+
+    def _header(self, numrecs: int, layout: list) -> bytes:
+        data = b"CDF" + bytes([self.version]) + self._int(numrecs)
+        data += struct.pack(">i", 0x0A) + self._int(len(self.dims))
+        for name, size in self.dims:
+            data += self._name(name) + self._int(size)
+        data += self._attrs(self.attrs)
+        data += struct.pack(">i", 0x0B) + self._int(len(self.variables))
+        names = [name for name, _ in self.dims]
+        for (name, dims, dtype, _, attrs), (vsize, begin) in \
+                zip(self.variables, layout):
+            data += self._name(name) + self._int(len(dims))
+            data += b"".join(self._int(names.index(dim)) for dim in dims)
+            data += self._attrs(attrs) + struct.pack(">i", NC_CODES[dtype])
+            data += self._int(vsize) + struct.pack(self.offset, begin)
+        return data
+
+    def build(self, numrecs: None | int = None) -> bytes:
+        sizes = dict(self.dims)
+        record = [len(dims) > 0 and sizes[dims[0]] == 0
+                  for _, dims, _, _, _ in self.variables]
+        slabs = []
+        for (_, dims, dtype, values, _), is_record in \
+                zip(self.variables, record):
+            data = self._values(dtype, values)
+            count = numrecs if is_record else 1
+            step = len(data) // max(1, count)
+            slabs.append([data[idx * step:(idx + 1) * step]
+                          for idx in range(count)])
+        single = sum(record) == 1
+        vsizes = [len(_pad(slab[0])) if len(slab) > 0 else 0
+                  for slab in slabs]
+
+        layout = [(0, 0)] * len(self.variables)
+        size = len(self._header(numrecs or 0, layout))
+        begin = size
+        for idx, is_record in enumerate(record):
+            if not is_record:
+                layout[idx] = (vsizes[idx], begin)
+                begin += vsizes[idx]
+        for idx, is_record in enumerate(record):
+            if is_record:
+                layout[idx] = (vsizes[idx], begin)
+                begin += vsizes[idx]
+
+        data = self._header(numrecs or 0, layout)
+        for slab, is_record in zip(slabs, record):
+            if not is_record:
+                data += _pad(slab[0])
+        for rec in range(numrecs or 0):
+            for slab, is_record in zip(slabs, record):
+                if is_record:
+                    data += slab[rec] if single else _pad(slab[rec])
+        return data
+
+
+class ReadClassicTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="filedb-test-")
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+
+    def write(self, data: bytes) -> str:
+        path = os.path.join(self.tmp, f"t{len(os.listdir(self.tmp))}.nc")
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def sample(self, version: int = 1, record: bool = True) -> bytes:
+        writer = NetCDFWriter(version)
+        writer.dim("time", 0 if record else 3)
+        writer.dim("x", 2)
+        writer.attrs = {"title": "T", "version": 3, "scale": 0.5}
+        writer.var("time", ["time"], "double", [0.0, 24.0, 48.0],
+                   {"units": HOURS})
+        writer.var("temp", ["time", "x"], "float", [1, 2, 3, 4, 5, 6],
+                   {"units": "K"})
+        writer.var("x", ["x"], "short", [7, 8])
+        return writer.build(3 if record else None)
+
+    def check(self, meta: dict, record: bool = True):
+        self.assertEqual(meta["dimensions"], {"time": 3, "x": 2})
+        self.assertEqual(meta["attributes"],
+                         {"title": "T", "version": 3, "scale": 0.5})
+        self.assertEqual(list(meta["variables"]), ["time", "temp", "x"])
+        self.assertEqual(meta["variables"]["temp"],
+                         {"type": "float", "dimensions": ["time", "x"],
+                          "attributes": {"units": "K"}})
+        self.assertEqual(meta["variables"]["x"],
+                         {"type": "short", "dimensions": ["x"],
+                          "attributes": {}})
+        self.assertEqual(meta["time_start"], EPOCH_2001)
+        self.assertEqual(meta["time_end"], EPOCH_2001 + 2 * 86400)
+
+    def test_lists_of_record_file(self):
+        meta = read_classic(self.write(self.sample()))
+        self.assertEqual(meta["format"], "classic")
+        self.check(meta)
+
+    def test_fixed_time_dimension(self):
+        self.check(read_classic(self.write(self.sample(record=False))))
+
+    def test_64bit_offset(self):
+        meta = read_metadata(self.write(self.sample(version=2)))
+        self.assertEqual(meta["format"], "64bit_offset")
+        self.check(meta)
+
+    def test_64bit_data(self):
+        meta = read_metadata(self.write(self.sample(version=5)))
+        self.assertEqual(meta["format"], "64bit_data")
+        self.check(meta)
+
+    def test_single_record_variable_is_not_padded(self):
+        writer = NetCDFWriter()
+        writer.dim("time", 0)
+        writer.var("time", ["time"], "short", [0, 6, 12, 18, 24],
+                   {"units": HOURS})
+        meta = read_classic(self.write(writer.build(5)))
+        self.assertEqual(meta["dimensions"], {"time": 5})
+        self.assertEqual((meta["time_start"], meta["time_end"]),
+                         (EPOCH_2001, EPOCH_2001 + 86400))
+
+    def test_empty_record_dimension(self):
+        writer = NetCDFWriter()
+        writer.dim("time", 0)
+        writer.var("time", ["time"], "double", [], {"units": HOURS})
+        meta = read_classic(self.write(writer.build(0)))
+        self.assertEqual(meta["dimensions"], {"time": 0})
+        self.assertEqual((meta["time_start"], meta["time_end"]),
+                         (None, None))
+
+    def test_coverage_attributes_win(self):
+        writer = NetCDFWriter()
+        writer.dim("time", 0)
+        writer.attrs = {"time_coverage_start": "2010-01-01T00:00:00Z",
+                        "time_coverage_end": "2010-01-02"}
+        writer.var("time", ["time"], "double", [0.0], {"units": HOURS})
+        meta = read_classic(self.write(writer.build(1)))
+        self.assertEqual((meta["time_start"], meta["time_end"]),
+                         (1262304000, 1262390400))
+
+    def test_truncated_and_corrupt_headers(self):
+        data = self.sample()
+        with self.assertRaises(ValueError):
+            read_classic(self.write(data[:60]))
+        with self.assertRaises(ValueError):
+            read_classic(self.write(b"CDF\x03" + data[4:]))
+        corrupt = data[:8] + struct.pack(">i", 0x0B) + data[12:]
+        with self.assertRaises(ValueError):
+            read_classic(self.write(corrupt))
+
+
+class NetCDFCacheTest(FileDBTestCase):
+    def test_unreadable_header_is_logged(self):
+        self.db.load_module("netcdf")
+        cache = self.db.groups["netcdf"]["db"]
+        with mock.patch.object(cache.log, "warn") as warn:
+            self.db.add(self.make("temp_2001_01_01.nc", b"CDF\x01\0\0"))
+        warn.assert_called_once()
+        self.assertIn("temp_2001_01_01.nc", warn.call_args[0][0])
+        rows = self.db.search("netcdf", {"parameter": ["path",
+                                                       "time_start"]})
+        self.assertEqual(len(rows), 1)
+        self.assertIsNone(rows[0][1])
+
+    def test_header_columns(self):
+        writer = NetCDFWriter()
+        writer.dim("time", 0)
+        writer.attrs = {"title": "T"}
+        writer.var("time", ["time"], "double", [0.0, 24.0],
+                   {"units": HOURS})
+        self.db.ingest([self.make("temp_2001_01_01.nc", writer.build(2))])
+        rows = self.db.search("netcdf", {
+            "parameter": ["time_start", "time_end"],
+            "coverage": ["2001-01-01 12:00:00", "2001-01-05"]})
+        self.assertEqual(rows, [(EPOCH_2001, EPOCH_2001 + 86400)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+'''
+Streaming and keyset paginated search
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import unittest
+from tests.helpers import FileDBTestCase
+
+
+class PaginationTest(FileDBTestCase):
+    def setUp(self):
+        super().setUp()
+        # several files share a datetime, so order must fall back to id
+        names = [f"hello_{2000 + idx % 3}_{idx % 2 + 1:02d}_01_{idx}.txt"
+                 for idx in range(23)]
+        self.db.add_many([self.make(name) for name in names])
+        rows = self.db.search("general", {"parameter": ["epoch", "id"]})
+        self.expected = sorted(rows)
+
+    def paged(self, limit: int, order: str = "asc") -> list:
+        rows, cursor, pages = [], None, 0
+        while True:
+            page, cursor = self.db.page(
+                "general", {"parameter": ["epoch", "id"]}, cursor, limit,
+                order)
+            rows.extend(page)
+            pages += 1
+            self.assertLessEqual(len(page), limit)
+            if cursor is None:
+                return rows
+            self.assertLess(pages, 100)
+
+    def test_iter_search_order(self):
+        meta = {"parameter": ["epoch", "id"]}
+        rows = list(self.db.iter_search("general", meta, batch_size=4))
+        self.assertEqual(rows, self.expected)
+        rows = list(self.db.iter_search("general", meta, order="desc"))
+        self.assertEqual(rows, self.expected[::-1])
+
+    def test_limit_and_after(self):
+        meta = {"parameter": ["epoch", "id"]}
+        self.assertEqual(
+            list(self.db.iter_search("general", meta, limit=5)),
+            self.expected[:5])
+        after = self.expected[6]
+        self.assertEqual(
+            list(self.db.iter_search("general", meta, after=after)),
+            self.expected[7:])
+        self.assertEqual(
+            list(self.db.iter_search("general", meta, after=after,
+                                     order="desc")),
+            self.expected[:6][::-1])
+
+    def test_pages_cover_every_row_once(self):
+        for limit in (1, 4, 23, 50):
+            self.assertEqual(self.paged(limit), self.expected)
+        self.assertEqual(self.paged(5, "desc"), self.expected[::-1])
+
+    def test_time_range(self):
+        meta = {"parameter": ["epoch", "id"], "starttime": "2001-01-01",
+                "endtime": "2001-12-31T23:59:59"}
+        rows = list(self.db.iter_search("general", meta, batch_size=2))
+        self.assertEqual(rows, [row for row in self.expected
+                                if 978307200 <= row[0] < 1009843200])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+'''
+Time partitioned rule caches
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import os
+import sqlite3
+import unittest
+from tests.helpers import FileDBTestCase
+from lib.ingest import AddStatus
+from lib.partition import Partition, DIGEST_INDEX
+from plugins.general import ID_SPAN
+
+ORDINAL_2001_01 = 2001 * 12
+
+
+class PartitionTest(unittest.TestCase):
+    def test_ordinal_label_parse(self):
+        epoch = 980985600       # 2001-02-01
+        self.assertEqual(Partition.MONTH.ordinal(epoch), ORDINAL_2001_01 + 1)
+        self.assertEqual(Partition.YEAR.ordinal(epoch), ORDINAL_2001_01)
+        self.assertEqual(Partition.MONTH.label(ORDINAL_2001_01 + 1),
+                         "2001-02")
+        self.assertEqual(Partition.YEAR.label(ORDINAL_2001_01), "2001")
+        self.assertEqual(Partition.MONTH.parse("2001-02"),
+                         ORDINAL_2001_01 + 1)
+        self.assertIsNone(Partition.MONTH.parse(DIGEST_INDEX))
+        self.assertIsNone(Partition.YEAR.parse(DIGEST_INDEX))
+        first, last = Partition.MONTH.span(ORDINAL_2001_01 + 1)
+        self.assertEqual((first, last), (epoch, 983404800 - 1))
+
+
+class PartitionedCacheTest(FileDBTestCase):
+    MONTHS = 4
+
+    def configure(self, cfg: dict):
+        cfg["rules"]["general"]["partition"] = {"by": "month",
+                                                "max_open": 2}
+        cfg["rules"]["general"]["dedup"] = {"policy": "skip"}
+
+    def setUp(self):
+        super().setUp()
+        self.db.add_many([self.make(f"data_2001_{month:02d}_{day:02d}.csv",
+                                    f"{month},{day}\n")
+                          for month in range(1, self.MONTHS + 1)
+                          for day in (1, 2)])
+
+    @property
+    def cache(self):
+        return self.db.groups["general"]["db"]
+
+    def reopen(self):
+        '''New FileDB on the same files, no shard is open'''
+        self.cache.close()
+        self._db = None
+        self.db.load_module("general")
+        self.assertEqual(len(self.cache.opened), 0)
+
+    def test_id_blocks(self):
+        rows = self.db.search("general", {"parameter": ["id", "epoch"]})
+        self.assertEqual(len(rows), 2 * self.MONTHS)
+        for file_id, epoch in rows:
+            ordinal = Partition.MONTH.ordinal(epoch)
+            self.assertEqual(file_id // ID_SPAN, ordinal)
+        self.assertEqual(len({row[0] for row in rows}), len(rows))
+
+        path = os.path.join(self.tmp, "out", "general", "cache",
+                            "2001-01.db")
+        with sqlite3.connect(path) as conn:
+            seq = conn.execute("SELECT seq FROM sqlite_sequence "
+                               "WHERE name = 'contents';").fetchone()[0]
+        self.assertEqual(seq, ORDINAL_2001_01 * ID_SPAN + 2)
+
+        # ids continue in their block after deletes and a reopen
+        ids = [row[0] for row in self.db.search(
+            "general", {"parameter": ["id"], "endtime": "2001-01-31"})]
+        self.cache.delete_records(ids)
+        self.reopen()
+        self.db.add(self.make("data_2001_01_03.csv", "9,9\n"))
+        rows = self.db.search("general", {"parameter": ["id"],
+                                          "endtime": "2001-01-31"})
+        self.assertEqual(rows, [(ORDINAL_2001_01 * ID_SPAN + 3,)])
+        self.assertEqual(self.cache.max_id(),
+                         (ORDINAL_2001_01 + self.MONTHS - 1) * ID_SPAN + 2)
+
+    def test_pruning(self):
+        self.reopen()
+        rows = self.db.search("general", {"starttime": "2001-02-01",
+                                          "endtime": "2001-02-28"})
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(list(self.cache.opened), [ORDINAL_2001_01 + 1])
+        self.assertFalse(self.cache.can_match({"starttime": "2002-01-01"}))
+        self.assertEqual(self.db.search("general",
+                                        {"starttime": "2002-01-01"}), [])
+        self.assertEqual(list(self.cache.opened), [ORDINAL_2001_01 + 1])
+
+    def test_eviction(self):
+        self.reopen()
+        rows = list(self.db.iter_search("general", {"parameter": ["id"]}))
+        self.assertEqual(len(rows), 2 * self.MONTHS)
+        self.assertEqual(list(self.cache.opened),
+                         [ORDINAL_2001_01 + 2, ORDINAL_2001_01 + 3])
+        for ordinal, shard in self.cache.shards.items():
+            self.assertEqual(shard._index is not None,
+                             ordinal in self.cache.opened)
+        self.assertEqual(len(self.db.search("general", {})),
+                         2 * self.MONTHS)
+        self.assertLessEqual(len(self.cache.opened), 2)
+
+    def test_dedup_opens_only_the_shard_of_the_hash(self):
+        self.reopen()
+        duplicate = self.make("data_2001_04_05.csv", "2,1\n")
+        self.assertEqual(self.db.add(duplicate), AddStatus.DUPLICATE)
+        self.assertEqual(list(self.cache.opened), [ORDINAL_2001_01 + 1])
+
+        self.reopen()
+        self.assertEqual(self.db.add(self.make("data_2001_04_06.csv",
+                                               "new\n")), AddStatus.ADDED)
+        self.assertEqual(list(self.cache.opened), [ORDINAL_2001_01 + 3])
+
+    def test_digest_index_is_filled_from_existing_shards(self):
+        self.cache.close()
+        for suffix in ["", "-wal", "-shm"]:
+            path = os.path.join(self.tmp, "out", "general", "cache",
+                                f"{DIGEST_INDEX}.db{suffix}")
+            if os.path.exists(path):
+                os.remove(path)
+        self.reopen()
+        duplicate = self.make("data_2001_04_05.csv", "3,2\n")
+        self.assertEqual(self.db.add(duplicate), AddStatus.DUPLICATE)
+        self.assertTrue(self.db.verify(["general"])["general"].ok())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+'''
+Verify and rebuild of rule caches against the storage root
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import os
+import unittest
+from tests.helpers import FileDBTestCase
+
+
+class AddReconcileTest(FileDBTestCase):
+    '''Files stored by add, add_many and ingest are found by reconcile'''
+    def configure(self, cfg: dict):
+        cfg["rules"]["general"]["dedup"] = {"policy": "keep"}
+
+    def dated(self, name: str, content: str = "1,2,3\n") -> str:
+        folder = os.path.join(self.inbox, "2019_05_05")
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def paths(self) -> list:
+        return sorted(row[0] for row in self.db.search(
+            "general", {"parameter": ["path"]}))
+
+    def test_add_verify_rebuild(self):
+        self.db.add(self.dated("hello_2022_01_30_a.txt"))
+        self.db.add_many([self.dated("hello_2022_02_01_b.txt"),
+                          self.make("hello_2022_02_02_c.txt")])
+        self.db.ingest([self.dated("hello_2022_02_03_d.txt")])
+        # same name, other content: stored beside it under a hashed name
+        self.db.add(self.dated("hello_2022_01_30_a.txt", "4,5,6\n"))
+        paths = self.paths()
+        self.assertEqual(len(paths), 5)
+
+        for report in [self.db.verify(["general"])["general"],
+                       self.db.rebuild(["general"])["general"],
+                       self.db.verify(["general"])["general"]]:
+            self.assertEqual(report.missing, [])
+            self.assertEqual(report.orphaned, [])
+            self.assertEqual(report.files, 5)
+        self.assertEqual(self.paths(), paths)
+
+    def test_rebuild_repairs(self):
+        self.db.add(self.make("hello_2022_01_30_a.txt"))
+        self.db.add(self.make("hello_2022_01_31_b.txt"))
+        missing, orphaned = self.paths()
+        os.remove(orphaned)
+        self.db.search("general", {})
+        cache = self.db.groups["general"]["db"]
+        tbname = cache.index.get_default_tablename()
+        with cache.index.transaction() as db:
+            db.execute(f"DELETE FROM {tbname} WHERE path = ?;", (missing,))
+
+        report = self.db.rebuild(["general"])["general"]
+        self.assertEqual(report.missing, [missing])
+        self.assertEqual([path for _, path in report.orphaned], [orphaned])
+        self.assertEqual(self.paths(), [missing])
+        self.assertTrue(self.db.verify(["general"])["general"].ok())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+'''
+Search result cache keys and invalidation
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import struct
+import unittest
+from tests.helpers import FileDBTestCase
+from lib.result_cache import ResultCache, normalize_meta
+
+
+def _name(text: str) -> bytes:
+    data = text.encode()
+    return struct.pack(">i", len(data)) + data + b"\0" * (-len(data) % 4)
+
+
+def netcdf_header(start: str, end: str) -> bytes:
+    '''Classic NetCDF file with only time coverage global attributes'''
+    attrs = b""
+    for name, value in (("time_coverage_start", start),
+                        ("time_coverage_end", end)):
+        data = value.encode()
+        attrs += _name(name) + struct.pack(">ii", 2, len(data)) + data + \
+            b"\0" * (-len(data) % 4)
+    return b"CDF\x01" + struct.pack(">i", 0) + struct.pack(">ii", 0, 0) + \
+        struct.pack(">ii", 0x0C, 2) + attrs + struct.pack(">ii", 0, 0)
+
+
+class NormalizeMetaTest(unittest.TestCase):
+    def test_equivalent_tags_share_a_key(self):
+        self.assertEqual(normalize_meta({"tags": "a,b"}),
+                         normalize_meta({"tags": {"any": ["b", "a"]}}))
+
+    def test_other_meta_keys_are_part_of_the_key(self):
+        self.assertNotEqual(
+            normalize_meta({"coverage": ["2001-01-01", "2001-12-31"]}),
+            normalize_meta({"coverage": ["2010-01-01", "2010-12-31"]}))
+        self.assertEqual(
+            normalize_meta({"coverage": ("2001-01-01", "2001-12-31")}),
+            normalize_meta({"coverage": ["2001-01-01", "2001-12-31"]}))
+
+    def test_other_meta_keys_open_the_span(self):
+        key = ResultCache.key("netcdf", {"starttime": 0, "endtime": 10,
+                                         "coverage": [0, 10]}, (0, 10))
+        self.assertEqual(key[1], (None, None))
+        key = ResultCache.key("netcdf", {"starttime": 0, "endtime": 10},
+                              (0, 10))
+        self.assertEqual(key[1], (0, 10))
+
+
+class CoverageCacheTest(FileDBTestCase):
+    def configure(self, cfg: dict):
+        cfg["result_cache"] = {}
+
+    def add(self, name: str, start: str, end: str):
+        self.db.add(self.make(name, netcdf_header(start, end)))
+
+    def search(self, meta: dict) -> list:
+        return sorted(row[0] for row in self.db.search(
+            "netcdf", dict(meta, parameter=["path"])))
+
+    def test_coverage_queries_do_not_share_entries(self):
+        self.add("temp_2001_01_01.nc", "2001-01-01", "2001-12-31")
+        self.add("temp_2001_02_01.nc", "2010-01-01", "2010-12-31")
+        first = self.search({"coverage": ["2001-03-01", "2001-04-01"]})
+        second = self.search({"coverage": ["2010-03-01", "2010-04-01"]})
+        self.assertEqual(len(first), 1)
+        self.assertEqual(len(second), 1)
+        self.assertNotEqual(first, second)
+        self.assertTrue(second[0].endswith("temp_2001_02_01.nc"))
+
+    def test_insert_outside_the_range_drops_coverage_entries(self):
+        self.add("temp_2001_01_01.nc", "2010-01-01", "2010-12-31")
+        meta = {"starttime": "2001-01-01", "endtime": "2001-12-31",
+                "coverage": ["2010-03-01", "2010-04-01"]}
+        self.assertEqual(len(self.search(meta)), 1)
+        self.assertEqual(len(self.search(meta)), 1)
+        self.assertEqual(self.db.results.stats()["hits"], 1)
+
+        # file name epoch 1999 is outside starttime / endtime
+        self.add("temp_1999_01_01.nc", "2010-01-01", "2010-12-31")
+        self.assertGreaterEqual(self.db.results.stats()["invalidations"], 1)
+        self.assertEqual(self.db.results.stats()["entries"], 0)
+        meta = {"coverage": ["2010-03-01", "2010-04-01"]}
+        self.assertEqual(len(self.search(meta)), 2)
+        self.add("temp_1998_01_01.nc", "2010-01-01", "2010-12-31")
+        self.assertEqual(len(self.search(meta)), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+'''
+Indexed rule matching
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import re
+import json
+import random
+import unittest
+from pathlib import Path
+from lib.rule_matcher import RuleMatcher
+from tests.helpers import ROOT
+
+NAMES = [
+    "hello_2022_01_30_x.txt", "data_2001_1_2.csv", "a_2001_01_01.txt.bak",
+    "temp_2001_01_01.nc", "temp_2001_01_01.NC", "2001_01_01.nc",
+    "x_2001_01_01.csv\n", "readme.txt", "", "nc", "_2001_01_01.txt",
+    "report_2020_12_31_final.CSV", "Report_2020_12_31.txt", "log.2001.txt",
+    "img_2001_01_01.png", "a\nb_2001_01_01.txt", "abc.nc", "Abc.Nc",
+]
+
+RULES = {
+    "unknown": {"type": "unknown", "folder": ["unknown"]},
+    "prefix": {"format": r"report_(?P<year>\d{4}).*"},
+    "suffix": {"format": r".*\.png$"},
+    "alternation": {"format": r".*?_(?P<year>\d{4})_.*\.(txt|csv)"},
+    "nested": {"format": r"(?:abc|log)\.(?:nc|(20|19)01\.txt)"},
+    "ignorecase": {"format": r"(?i)report_.*\.csv"},
+    "multiline": {"format": r"(?m)^b_.*txt$"},
+    "grouped_flags": {"format": r"abc\.(?i:nc)"},
+    "no_hint": {"format": r"\w+\.\w+"},
+    "empty_tail": {"format": r"temp(_\d+)*(|x)"},
+}
+
+
+def brute_force(rules: dict, filepath: str):
+    '''First rule in config order whose format matches the file name'''
+    name = Path(filepath).name
+    for rulename, rule in rules.items():
+        if "format" not in rule:
+            continue
+        found = re.match(rule["format"], name)
+        if found is not None:
+            return rulename, found.groupdict()
+    return None
+
+
+class RuleMatcherTest(unittest.TestCase):
+    def check(self, rules: dict, names: list):
+        matcher = RuleMatcher(rules)
+        for name in names:
+            for filepath in [name, f"/inbox/2019_05_05/{name}"]:
+                result = matcher.match(filepath)
+                found = None if result is None else \
+                    (result.rulename, result.match.groupdict())
+                self.assertEqual(found, brute_force(rules, filepath),
+                                 repr(filepath))
+
+    def test_config_rules(self):
+        with open(ROOT / "config.json", encoding="utf-8") as f:
+            rules = json.load(f)["rules"]
+        self.check(rules, NAMES)
+
+    def test_rule_orders(self):
+        order = list(RULES)
+        shuffle = random.Random(0).shuffle
+        for _ in range(50):
+            self.check({key: RULES[key] for key in order}, NAMES)
+            shuffle(order)
+
+    def test_index_prunes_candidates(self):
+        matcher = RuleMatcher(RULES)
+        rulenames = [rule[0] for rule in matcher.rules]
+        ids = matcher.candidates("readme.txt")
+        self.assertEqual([rulenames[idx] for idx in ids],
+                         ["alternation", "nested", "ignorecase", "multiline",
+                          "no_hint"])
+        ids = matcher.candidates("report_2020.png")
+        self.assertIn(rulenames.index("prefix"), ids)
+        self.assertIn(rulenames.index("suffix"), ids)
+
+    def test_flags_bypass_the_index(self):
+        matcher = RuleMatcher({"ignorecase": RULES["ignorecase"],
+                               "multiline": RULES["multiline"]})
+        self.assertEqual(matcher.fallback, [0, 1])
+        self.assertEqual(matcher.match("REPORT_1.CSV").rulename,
+                         "ignorecase")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+'''
+FileDBServer framing, pipelining and error propagation
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import io
+import os
+import socket
+import struct
+import unittest
+from unittest import mock
+from tests.helpers import FileDBTestCase
+from lib.error import GeneralException
+from lib.server import (FileDBServer, FileDBClient, _Connection, send_frame,
+                        recv_frame, HEADER, MAX_FRAME)
+
+
+class FramingTest(unittest.TestCase):
+    def setUp(self):
+        self.left, self.right = socket.socketpair()
+        self.addCleanup(self.left.close)
+        self.addCleanup(self.right.close)
+
+    def test_round_trip(self):
+        messages = [{"id": 1, "method": "ping", "args": [], "kwargs": {}},
+                    {"id": 2, "result": {"ä.csv": "ADDED"}}]
+        for message in messages:
+            send_frame(self.left, message)
+        self.left.close()
+        with self.right.makefile("rb") as f:
+            self.assertEqual(recv_frame(f), messages[0])
+            self.assertEqual(recv_frame(f), messages[1])
+            self.assertIsNone(recv_frame(f))
+
+    def test_truncated_frame_is_end_of_stream(self):
+        f = io.BytesIO(HEADER.pack(10) + b'{"id"')
+        self.assertIsNone(recv_frame(f))
+        self.assertIsNone(recv_frame(io.BytesIO(b"\0\0")))
+
+    def test_oversized_frame(self):
+        with self.assertRaises(GeneralException):
+            recv_frame(io.BytesIO(struct.pack("!I", MAX_FRAME + 1)))
+
+
+class ServerTest(FileDBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = FileDBServer(self.db, os.path.join(self.tmp, "s.sock"),
+                                   readers=2, batch_delay=0.05)
+        thread = self.server.start()
+        self.addCleanup(thread.join, 10)
+        self.addCleanup(self.server.stop)
+        self.client = FileDBClient(self.server.path, timeout=30)
+        self.addCleanup(self.client.close)
+
+    def paths(self, rows: list) -> list:
+        return sorted(os.path.basename(row[0]) for row in rows)
+
+    def test_add_and_search(self):
+        from main import AddStatus
+        self.assertEqual(self.client.ping(), "pong")
+        self.assertEqual(self.client.add(self.make("data_2001_01_01.csv")),
+                         AddStatus.ADDED)
+        files = [self.make(f"data_2001_02_{day:02d}.csv")
+                 for day in range(1, 4)]
+        report = self.client.add_many(files, tags=["x"])
+        self.assertEqual(set(report.values()), {AddStatus.ADDED})
+        rows = self.client.search("general", {"parameter": ["path"]})
+        self.assertEqual(self.paths(rows), [
+            "data_2001_01_01.csv", "data_2001_02_01.csv",
+            "data_2001_02_02.csv", "data_2001_02_03.csv"])
+        rows = self.client.search("general", {"parameter": ["path"],
+                                              "tags": "x"})
+        self.assertEqual(len(rows), 3)
+        rows = list(self.client.iter_search(
+            "general", {"parameter": ["path"]}, batch_size=1, limit=3))
+        self.assertEqual(len(rows), 3)
+
+    def test_pipelined_requests(self):
+        files = [self.make(f"data_2001_03_{day:02d}.csv")
+                 for day in range(1, 9)]
+        futures = [self.client.submit("add", path) for path in files]
+        futures += [self.client.submit("ping") for _ in range(8)]
+        results = [future.result(30) for future in futures]
+        self.assertEqual(results, ["ADDED"] * 8 + ["pong"] * 8)
+        rows = self.client.search("general", {"parameter": ["path"]})
+        self.assertEqual(len(rows), 8)
+
+    def test_errors_are_propagated(self):
+        with self.assertRaisesRegex(GeneralException, "unknown method"):
+            self.client.submit("drop").result(30)
+        with self.assertRaisesRegex(GeneralException, "TypeError"):
+            self.client.submit("add").result(30)
+        with self.assertRaisesRegex(GeneralException, "ValueError"):
+            self.client.submit("add_many", [], None, 0).result(30)
+        # raised in a reader thread
+        with self.assertRaisesRegex(GeneralException, "TypeError"):
+            self.client.submit("search", "general").result(30)
+        # the connection is still usable
+        self.assertEqual(self.client.ping(), "pong")
+
+    def test_add_many_batch_size(self):
+        files = [self.make(f"data_2001_04_{day:02d}.csv")
+                 for day in range(1, 4)]
+        with mock.patch.object(self.db, "ingest",
+                               wraps=self.db.ingest) as ingest:
+            self.client.add_many(files, batch_size=2)
+        self.assertEqual(ingest.call_args.kwargs["batch_size"], 2)
+
+
+class ShutdownTest(FileDBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = FileDBServer(self.db, os.path.join(self.tmp, "s.sock"))
+        self.left, self.right = socket.socketpair()
+        self.addCleanup(self.left.close)
+        self.addCleanup(self.right.close)
+        self.conn = _Connection(self.left)
+
+    def answer(self, request: dict) -> dict:
+        self.server._dispatch(self.conn, request)
+        with self.right.makefile("rb") as f:
+            return recv_frame(f)
+
+    def test_read_after_readers_stopped(self):
+        self.server.readers.shutdown(True)
+        message = self.answer({"id": 7, "method": "ping"})
+        self.assertEqual(message["id"], 7)
+        self.assertEqual(message["error"][0], "GeneralException")
+        self.assertIn("stopping", message["error"][1])
+
+    def test_write_after_writer_stopped(self):
+        self.server._shutdown()
+        message = self.answer({"id": 8, "method": "add",
+                               "args": [self.make("data_2001_01_01.csv")]})
+        self.assertEqual(message["id"], 8)
+        self.assertIn("stopping", message["error"][1])
+
+
+if __name__ == "__main__":
+    unittest.main()
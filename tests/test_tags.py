@@ -0,0 +1,84 @@
+'''
+Tag storage and tag queries
+
+Author: Weiru Chen <flamingm321@gmail.com>
+Date: 2024-01-21
+'''
+
+import os
+import sqlite3
+import unittest
+from tests.helpers import FileDBTestCase
+
+
+class TagSearchTest(FileDBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.files = {}
+        for day, tags in ((1, ["count=1", "color=red"]),
+                          (2, ["count=10", "color=blue"]),
+                          (3, ["count=2", "archived"]),
+                          (4, None)):
+            name = f"hello_2001_01_{day:02d}_a.txt"
+            self.db.add(self.make(name), tags)
+            self.files[day] = name
+
+    def names(self, tags) -> list:
+        rows = self.db.search("general", {"parameter": ["path"],
+                                          "tags": tags})
+        return sorted(os.path.basename(row[0]) for row in rows)
+
+    def days(self, *days) -> list:
+        return sorted(self.files[day] for day in days)
+
+    def test_exact_value_is_not_a_prefix(self):
+        self.assertEqual(self.names("count=1"), self.days(1))
+        self.assertEqual(self.names(["count=10"]), self.days(2))
+
+    def test_prefix(self):
+        self.assertEqual(self.names("count=1*"), self.days(1, 2))
+        self.assertEqual(self.names("col*"), self.days(1, 2))
+
+    def test_key_and_value_terms(self):
+        self.assertEqual(self.names("count"), self.days(1, 2, 3))
+        self.assertEqual(self.names("archived"), self.days(3))
+        self.assertEqual(self.names("=red"), self.days(1))
+
+    def test_any_and_all(self):
+        self.assertEqual(self.names("count=1,count=2"), self.days(1, 3))
+        self.assertEqual(self.names({"any": ["color=red", "archived"]}),
+                         self.days(1, 3))
+        self.assertEqual(self.names({"all": ["count=1*", "color=blue"]}),
+                         self.days(2))
+        self.assertEqual(self.names({"all": ["count=1", "color=blue"]}), [])
+
+
+class TagMigrationTest(FileDBTestCase):
+    def test_legacy_tags_column_is_migrated(self):
+        rule = self.db.config.get()["rules"]["general"]
+        path = os.path.join(self.db.config.get()["root"],
+                            rule["cache_path"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        db = sqlite3.connect(path)
+        db.execute("""CREATE TABLE contents (
+                      id integer primary key autoincrement, datetime text,
+                      path text NOT NULL, tags text);""")
+        db.executemany(
+            "INSERT INTO contents (datetime, path, tags) VALUES (?, ?, ?);",
+            [("2001-01-01 00:00:00", "/a/hello_2001_01_01_a.txt",
+              "count=1,color=red"),
+             ("2001-01-02 00:00:00", "/a/hello_2001_01_02_a.txt",
+              "count=10")])
+        db.commit()
+        db.close()
+
+        rows = self.db.search("general", {"parameter": ["path", "epoch"],
+                                          "tags": "count=1"})
+        self.assertEqual(rows, [("/a/hello_2001_01_01_a.txt", 978307200)])
+        rows = self.db.search("general", {"parameter": ["path"],
+                                          "tags": "=red"})
+        self.assertEqual(len(rows), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()